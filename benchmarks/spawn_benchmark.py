@@ -0,0 +1,65 @@
+#!/usr/bin/python2
+
+"""Compares the spawn rate of the fork and posix_spawn process paths.
+
+This starts the same Exec() action repeatedly through
+MinimalSubprocess.fork_exec() and MinimalSubprocess.spawn_exec() and reports
+the number of processes started per second for each. A ballast of python
+objects can be allocated first to show how fork cost grows with the size of
+the daemon's heap.
+
+Usage:
+  PYTHONPATH=twitcher python2 benchmarks/spawn_benchmark.py [-n 500] [-m 256]
+"""
+
+import optparse
+import time
+
+import core
+import reaper
+import spawn
+
+
+def run(method, count, action):
+  """Starts count processes with the given method and waits for them.
+
+  Returns:
+    The number of processes started per second.
+  """
+  r = reaper.Reaper()
+  core.set_default_reaper(r)
+  start = time.time()
+  for _ in xrange(count):
+    p = core.MinimalSubprocess('benchmark', '')
+    if method == 'fork':
+      p.fork_exec(action)
+    else:
+      p.spawn_exec(action.argv)
+  elapsed = time.time() - start
+  while r:
+    r.reap()
+    time.sleep(0.01)
+  return count / elapsed
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-n', '--count', type='int', dest='count', default=500,
+                    help='Number of processes to start with each method.')
+  parser.add_option('-m', '--ballast_mb', type='int', dest='ballast_mb',
+                    default=0, help='Megabytes of heap to allocate first.')
+  options, _ = parser.parse_args()
+
+  ballast = [' ' * 1024 for _ in xrange(options.ballast_mb * 1024)]
+  action = spawn.ExecAction(['true'])
+  print 'heap ballast: %d MB' % options.ballast_mb
+  print 'fork_exec:  %8.1f spawns/sec' % run('fork', options.count, action)
+  if spawn.available():
+    print 'spawn_exec: %8.1f spawns/sec' % run('spawn', options.count, action)
+  else:
+    print 'spawn_exec: posix_spawn is not available on this system.'
+  del ballast
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+#!/usr/bin/python26
+
+"""Load aware admission control for actions.
+
+Concurrency limits cap how much twitcher runs, but not when. If a config
+push lands while the host is already struggling, starting dozens of actions
+makes things worse. The AdmissionController sits in front of every run and,
+while the host is under pressure, holds back runs from low priority watches.
+Pressure is read from the kernel's pressure stall information
+(/proc/pressure/cpu, memory and io) where thresholds are given for those,
+and from /proc/loadavg, divided by the number of CPUs, for the load
+threshold.
+
+Held back runs are checked again periodically and start, in the order they
+arrived, once pressure drops. A run is never held for longer than the
+maximum deferral so updates are delayed rather than lost. The number of
+deferred runs and how long they waited are recorded in the stats module.
+"""
+
+import logging
+import os
+import time
+
+# twitcher modules
+import scheduler
+import stats
+
+
+# The number of seconds between pressure checks while runs are deferred.
+DEFAULT_CHECK_INTERVAL = 5
+
+# The longest a run may be deferred for, in seconds.
+DEFAULT_MAX_DEFERRAL = 300
+
+_PRESSURE_PATH = '/proc/pressure/%s'
+_LOADAVG_PATH = '/proc/loadavg'
+
+
+def read_pressure(resource):
+  """Returns the 10 second 'some' stall percentage of a resource.
+
+  Args:
+    resource: 'cpu', 'memory' or 'io'.
+
+  Returns:
+    A float, or None if pressure information isn't available.
+  """
+  try:
+    f = open(_PRESSURE_PATH % resource)
+    try:
+      for line in f:
+        fields = line.split()
+        if fields and fields[0] == 'some':
+          for field in fields[1:]:
+            name, _, value = field.partition('=')
+            if name == 'avg10':
+              return float(value)
+    finally:
+      f.close()
+  except (IOError, ValueError):
+    pass
+  return None
+
+
+def read_load():
+  """Returns the one minute load average per CPU, or None."""
+  try:
+    f = open(_LOADAVG_PATH)
+    try:
+      load = float(f.read().split()[0])
+    finally:
+      f.close()
+  except (IOError, ValueError, IndexError):
+    return None
+  try:
+    cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+  except (ValueError, OSError):
+    cpus = 1
+  return load / max(cpus, 1)
+
+
+class Deferral(object):
+  """A run held back by the AdmissionController.
+
+  Args:
+    run: Called with the deferral once the run may go ahead.
+    desc: The description used for logging.
+  """
+  def __init__(self, run, desc):
+    self.run = run
+    self.desc = desc
+    self.deferred = time.time()
+    self.cancelled = False
+
+
+class AdmissionController(object):
+  """Defers low priority runs while the host is under pressure.
+
+  All functions are expected to be called from the reactor thread.
+
+  Args:
+    reactor_obj: The reactor used for the periodic checks.
+    cpu: The cpu pressure (percent) above which runs are deferred.
+    memory: The memory pressure (percent) above which runs are deferred.
+    io: The io pressure (percent) above which runs are deferred.
+    load: The load average per CPU above which runs are deferred.
+    max_deferral: The most seconds a run may be deferred.
+    defer_priority: Runs of this priority or lower are deferred.
+    check_interval: Seconds between checks while runs are deferred.
+  """
+  def __init__(self, reactor_obj, cpu=None, memory=None, io=None, load=None,
+               max_deferral=DEFAULT_MAX_DEFERRAL,
+               defer_priority=scheduler.LOW,
+               check_interval=DEFAULT_CHECK_INTERVAL):
+    self._reactor = reactor_obj
+    self._thresholds = [(r, t) for r, t in (('cpu', cpu), ('memory', memory),
+                                            ('io', io))
+                        if t is not None]
+    self._load = load
+    self._max_deferral = max_deferral
+    self._defer_priority = defer_priority
+    self._check_interval = check_interval
+    self._deferred = []
+    self._timer = None
+    stats.set_gauge('admission.deferred_now', lambda: len(self._deferred))
+
+  def overloaded(self):
+    """Returns a description of the pressure above its threshold, or None."""
+    for resource, threshold in self._thresholds:
+      value = read_pressure(resource)
+      if value is not None and value > threshold:
+        return '%s pressure %.1f%% > %.1f%%' % (resource, value, threshold)
+    if self._load is not None:
+      value = read_load()
+      if value is not None and value > self._load:
+        return 'load %.2f per cpu > %.2f' % (value, self._load)
+    return None
+
+  def admit(self, priority, desc, run):
+    """Runs run now, or defers it if the host is under pressure.
+
+    Args:
+      priority: The scheduler priority of the watch.
+      desc: The description used for logging.
+      run: Called once the run may go ahead, with the Deferral if it was
+           deferred or None if it wasn't.
+
+    Returns:
+      A Deferral that may be passed to cancel(), or None if run was called
+      straight away.
+    """
+    if priority < self._defer_priority:
+      run(None)
+      return None
+    reason = self.overloaded()
+    if reason is None:
+      run(None)
+      return None
+    logging.warning('Deferring "%s": %s', desc, reason)
+    stats.increment('admission.deferred')
+    deferral = Deferral(run, desc)
+    self._deferred.append(deferral)
+    if self._timer is None:
+      self._timer = self._reactor.call_later(self._check_interval,
+                                             self._check)
+    return deferral
+
+  def cancel(self, deferral):
+    """Forgets a deferred run that is no longer wanted."""
+    deferral.cancelled = True
+    if deferral in self._deferred:
+      self._deferred.remove(deferral)
+
+  def _check(self):
+    """Releases deferred runs once pressure drops or they waited too long."""
+    self._timer = None
+    now = time.time()
+    overloaded = self.overloaded() is not None
+    ready = []
+    for deferral in list(self._deferred):
+      waited = now - deferral.deferred
+      if not overloaded or waited >= self._max_deferral:
+        if overloaded:
+          logging.warning('Starting "%s" despite pressure; deferred for '
+                          '%.0f seconds.', deferral.desc, waited)
+          stats.increment('admission.forced')
+        self._deferred.remove(deferral)
+        stats.record('admission.defer_time', waited)
+        ready.append(deferral)
+    for deferral in ready:
+      try:
+        deferral.run(deferral)
+      except Exception:
+        logging.exception('Unhandled exception starting "%s"', deferral.desc)
+    if self._deferred and self._timer is None:
+      self._timer = self._reactor.call_later(self._check_interval,
+                                             self._check)
@@ -0,0 +1,136 @@
+#!/usr/bin/python26
+
+"""Buffers every version of a znode for the BATCH run mode.
+
+In QUEUE mode only the latest data is run once the current run finishes,
+so versions that arrive in between are lost. In BATCH mode the watch is
+re-armed and the data fetched every time it fires, even while the action
+runs, and each version is kept here. The next run is then given all of
+them at once on stdin in one of two formats:
+
+  LENGTH_PREFIXED: For each version a 4 byte big endian stat version, a 4
+                   byte big endian length, then that many bytes of data.
+  JSON_LINES: One JSON object per line, {"version": 3, "data": "..."}.
+              Data that isn't valid UTF-8 is given base64 encoded as
+              "data_base64" instead.
+
+Watch groups (see config.RegisterWatchGroup) use the same formats to give a
+run the znodes that changed, with a path in place of the version.
+
+A run is given at most max_count versions or max_bytes bytes of data (but
+always at least one version); anything beyond that is left for the next
+run. Zookeeper watches only say that something changed, so versions that
+are replaced before the data can be fetched are still never seen.
+"""
+
+import base64
+import json
+import struct
+
+# twitcher modules
+import stats
+
+
+LENGTH_PREFIXED = 1
+JSON_LINES = 2
+
+_HEADER = struct.Struct('>iI')
+_LENGTH = struct.Struct('>I')
+
+
+class Batch(object):
+  """The versions of a znode waiting for the next run.
+
+  Args:
+    format: LENGTH_PREFIXED or JSON_LINES.
+    max_count: The most versions given to one run, or None.
+    max_bytes: The most bytes of data given to one run, or None.
+  """
+  def __init__(self, format=LENGTH_PREFIXED, max_count=None, max_bytes=None):
+    self._format = format
+    self._max_count = max_count
+    self._max_bytes = max_bytes
+    self._versions = []
+
+  def __len__(self):
+    return len(self._versions)
+
+  def add(self, version, data):
+    """Keeps a version of the znode.
+
+    Args:
+      version: The stat version of the data, or -1 if it isn't known.
+      data: The contents of the znode.
+
+    Returns:
+      Nothing.
+    """
+    if (version >= 0 and self._versions and
+        self._versions[-1][0] == version):
+      # Fetched again without changing.
+      return
+    self._versions.append((version, data))
+    stats.increment('batch.versions')
+
+  def clear(self):
+    """Forgets every buffered version."""
+    self._versions = []
+
+  def take(self):
+    """Removes the versions for the next run and returns them encoded.
+
+    Returns:
+      A string to give the run on stdin.
+    """
+    count = 0
+    size = 0
+    for _, data in self._versions:
+      if count and ((self._max_count is not None and
+                     count >= self._max_count) or
+                    (self._max_bytes is not None and
+                     size + len(data) > self._max_bytes)):
+        break
+      count += 1
+      size += len(data)
+    taken = self._versions[:count]
+    self._versions = self._versions[count:]
+    stats.record('batch.size', count)
+    if self._versions:
+      stats.increment('batch.split')
+    if self._format == JSON_LINES:
+      return ''.join(_json_line(version, data) for version, data in taken)
+    return ''.join(_HEADER.pack(version, len(data)) + data
+                   for version, data in taken)
+
+
+def encode_paths(items, format=LENGTH_PREFIXED):
+  """Encodes the changed znodes of a watch group.
+
+  With LENGTH_PREFIXED each znode is a 4 byte big endian length and the
+  path, then a 4 byte big endian length and the data. With JSON_LINES each
+  is a line like {"data": "...", "path": "/svc/a/config"}.
+
+  Args:
+    items: A list of (path, data) tuples.
+    format: LENGTH_PREFIXED or JSON_LINES.
+
+  Returns:
+    A string to give the run on stdin.
+  """
+  if format == JSON_LINES:
+    return ''.join(_json_line(None, data, path) for path, data in items)
+  return ''.join(_LENGTH.pack(len(path)) + path + _LENGTH.pack(len(data)) +
+                 data for path, data in items)
+
+
+def _json_line(version, data, path=None):
+  """Returns one version, or one znode, encoded as a line of JSON."""
+  if path is None:
+    entry = {'version': version}
+  else:
+    entry = {'path': path}
+  try:
+    entry['data'] = data.decode('utf-8')
+  except UnicodeDecodeError:
+    entry['data_base64'] = base64.b64encode(data)
+  return json.dumps(entry, sort_keys=True) + '\n'
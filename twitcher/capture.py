@@ -0,0 +1,203 @@
+#!/usr/bin/python26
+
+"""Bounded capture of child process stdout and stderr.
+
+By default children have stdout and stderr pointed at /dev/null. Watches that
+enable capture instead get a pipe for each, registered with the reactor and
+read in non blocking chunks. Data is kept in a fixed size buffer per stream
+and complete lines are written to the log, subject to a per watch line rate.
+If a child writes a line longer than the buffer, or writes lines faster than
+the rate allows, the excess is dropped and counted rather than stored, so
+memory use is bounded no matter how chatty an action is.
+"""
+
+import errno
+import logging
+import os
+import time
+
+# twitcher modules
+import fds
+import reactor
+
+
+# The default size of the buffer kept for each stream of a child.
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# The default number of lines per second a watch may log.
+DEFAULT_LINE_RATE = 10
+
+_READ_SIZE = 4096
+
+# The most reads done for one stream per reactor wakeup, so a single chatty
+# child can't starve the rest of the loop.
+_MAX_READS = 16
+
+
+class LineRateLimiter(object):
+  """A token bucket limiting how many lines a watch may log.
+
+  Args:
+    rate: The number of lines per second allowed on average.
+    burst: The number of lines that may be logged at once. Defaults to rate.
+  """
+  def __init__(self, rate, burst=None):
+    self._rate = float(rate)
+    self._burst = float(burst or max(rate, 1))
+    self._tokens = self._burst
+    self._last = time.time()
+    self.suppressed = 0
+
+  def allow(self):
+    """Returns True if another line may be logged now."""
+    now = time.time()
+    self._tokens = min(self._burst, self._tokens + (now - self._last) *
+                       self._rate)
+    self._last = now
+    if self._tokens >= 1:
+      self._tokens -= 1
+      return True
+    self.suppressed += 1
+    return False
+
+  def take_suppressed(self):
+    """Returns and resets the number of lines suppressed so far."""
+    suppressed = self.suppressed
+    self.suppressed = 0
+    return suppressed
+
+
+class _Stream(object):
+  """Reads one output stream of a child into a bounded buffer.
+
+  Args:
+    capture: The OutputCapture that owns this stream.
+    name: 'stdout' or 'stderr'.
+    fd: The read end of the pipe.
+  """
+  def __init__(self, capture, name, fd):
+    self._capture = capture
+    self.name = name
+    self.fd = fd
+    self._buffer = bytearray()
+    self.dropped = 0
+
+  def read(self, fd, events):
+    """Called by the reactor when the pipe is readable."""
+    for _ in xrange(_MAX_READS):
+      try:
+        data = os.read(self.fd, _READ_SIZE)
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          return
+        data = ''
+      if not data:
+        self.close()
+        return
+      self._buffer.extend(data)
+      self._emit_lines()
+      overflow = len(self._buffer) - self._capture.buffer_size
+      if overflow > 0:
+        del self._buffer[:overflow]
+        self.dropped += overflow
+
+  def _emit_lines(self):
+    """Logs every complete line in the buffer."""
+    start = 0
+    while True:
+      end = self._buffer.find('\n', start)
+      if end < 0:
+        break
+      self._capture.log(self.name, str(self._buffer[start:end]))
+      start = end + 1
+    if start:
+      del self._buffer[:start]
+
+  def close(self):
+    """Flushes any partial line and closes the pipe."""
+    if self.fd is None:
+      return
+    if self._buffer:
+      self._capture.log(self.name, str(self._buffer))
+      self._buffer = bytearray()
+    self._capture.reactor.unregister(self.fd)
+    os.close(self.fd)
+    self.fd = None
+    if self.dropped:
+      logging.warning('%s [%s]: dropped %d bytes of overlong output.',
+                      self._capture.desc, self.name, self.dropped)
+    self._capture.report_suppressed()
+
+
+class OutputCapture(object):
+  """Captures stdout and stderr of one child process.
+
+  Args:
+    desc: The description of the process, used when logging.
+    limiter: The LineRateLimiter shared by every process of the watch.
+    buffer_size: The maximum number of bytes buffered per stream.
+    reactor_obj: The reactor the pipes should be registered with.
+    streams: The names of the streams to capture.
+  """
+  def __init__(self, desc, limiter, buffer_size, reactor_obj,
+               streams=('stdout', 'stderr')):
+    self.desc = desc
+    self.buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+    self.reactor = reactor_obj
+    self._limiter = limiter
+    self._stream_names = streams
+    self._streams = []
+    self._child_fds = []
+
+  def child_fds(self):
+    """Creates the pipes and returns the (stdout, stderr) ends for the child.
+
+    The descriptors are close-on-exec; they only survive in the child as
+    the dup2 targets 1 and 2. Streams that aren't captured are None.
+    """
+    result = []
+    for name in ('stdout', 'stderr'):
+      if name not in self._stream_names:
+        result.append(None)
+        continue
+      r, w = os.pipe()
+      fds.set_cloexec(r)
+      fds.set_cloexec(w)
+      reactor.set_nonblocking(r)
+      self._streams.append(_Stream(self, name, r))
+      self._child_fds.append(w)
+      result.append(w)
+    return tuple(result)
+
+  def started(self):
+    """Called in the parent once the child exists.
+
+    This closes the child's ends of the pipes and starts reading ours.
+    """
+    for fd in self._child_fds:
+      os.close(fd)
+    self._child_fds = []
+    for stream in self._streams:
+      self.reactor.register(stream.fd, reactor.READ, stream.read)
+
+  def close(self):
+    """Closes every pipe. Used if the child failed to start."""
+    for fd in self._child_fds:
+      os.close(fd)
+    self._child_fds = []
+    for stream in self._streams:
+      stream.close()
+
+  def report_suppressed(self):
+    """Logs how many lines the rate limit has dropped, if any."""
+    suppressed = self._limiter.take_suppressed()
+    if suppressed:
+      logging.warning('%s: suppressed %d lines of output (rate limit).',
+                      self.desc, suppressed)
+
+  def log(self, name, line):
+    """Logs a line of output if the watch's rate limit allows it."""
+    if not self._limiter.allow():
+      return
+    self.report_suppressed()
+    logging.warning('%s [%s]: %s', self.desc, name, line)
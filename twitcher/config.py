@@ -6,13 +6,20 @@ Author: Brady Catherman (brady@twitter.com)
 """
 
 import logging
-import os
 import types
 
 # twitcher module libs
 import core
+import batch
+import capture
 import inotify
+import resources
+import scheduler
+import spawn
+import worker
 import zkwrapper
+from semaphore import DistributedSemaphore
+from splay import Splay
 
 
 class _NamespaceConfig(object):
@@ -35,11 +42,22 @@ class _NamespaceConfig(object):
   def __init__(self, config_file):
     self._configurations = []
     self._config_file = config_file
+    self._max_concurrency = None
 
   def RegisterWatch(self, znode=None, action=None, pipe_stdin=None,
                     run_on_load=None, run_mode=None, description=None,
                     uid=None, gid=None, watch_type=None, notify_signal=None,
-                    timeout=None):
+                    timeout=None, stdin_mode=None, capture_output=None,
+                    capture_buffer_size=None, capture_line_rate=None,
+                    priority=None, max_concurrent=None, quiet_period=None,
+                    max_delay=None, splay=None, splay_path=None,
+                    splay_interval=None, cluster_limit=None,
+                    cluster_lock_path=None, nice=None, ionice_class=None,
+                    ionice_level=None, cpu_affinity=None, rlimits=None,
+                    cgroup=None, cpu_max=None, memory_max=None,
+                    worker_ack=None, in_process=None, kill_grace=None,
+                    batch_format=None, batch_max_count=None,
+                    batch_max_bytes=None, skip_unchanged=None, _group=None):
     """Registers a watch and action on a given znode.
 
     This is the main function configuration files are expected to work with.
@@ -53,7 +71,8 @@ class _NamespaceConfig(object):
       pipe_stdin: Pipe the contents of the znode to stdin when the
                   'action' function run.
       run_on_load: Should the action function be run when the config file
-                   is loaded or reloaded.
+                   is loaded or reloaded. If 'if_changed' then it only runs
+                   if the data differs from the last run in the state file.
       run_mode: Defines what should happen if the znode updates while the
                 script is still running. The options are:
             QUEUE: Queue the update and run the action once the current action
@@ -63,6 +82,13 @@ class _NamespaceConfig(object):
                       an action is already running.
             DISCARD: Ignore any watches that fire while the action script
                      is already running.
+            PERSISTENT: Keep one long running worker process and write
+                        each update to its stdin as a length prefixed
+                        frame.
+            RESTART: Terminate the running action when the watch fires and
+                     run it again with the latest contents once it exits.
+            BATCH: Keep every version received while the action runs and
+                   give them all to the next run on stdin.
       description: The string description of this object. This will be used
                    for logging.
       uid: The user id to run the process as.
@@ -75,6 +101,66 @@ class _NamespaceConfig(object):
                      the znode is modified. This only matters in QUEUE mode.
       timeout: The number of seconds to allow the process to run before
                killing it.
+      stdin_mode: Defines how the znode contents are given to the action.
+            STDIN_PIPE: Write the contents into a pipe (the default).
+            STDIN_MEMFD: Place the contents in a sealed memfd which becomes
+                         stdin, so twitcher doesn't have to pump the data.
+      capture_output: If True then stdout and stderr of the action are
+                      written to the twitcher log rather than /dev/null.
+      capture_buffer_size: The most bytes of output buffered per stream.
+                           Longer lines are truncated.
+      capture_line_rate: The most lines per second of output logged for this
+                         watch. Excess lines are dropped and counted.
+      priority: The order in which queued actions are started when the
+                daemon wide concurrency limit has been reached. The options
+                are PRIORITY_HIGH, PRIORITY_NORMAL (default) and PRIORITY_LOW.
+      max_concurrent: The most processes this watch may run at once. This
+                      mostly matters in PARALLEL mode.
+      quiet_period: If set then notifications are collected and the action
+                    runs once, with the latest data, after the znode has
+                    been quiet for this many seconds.
+      max_delay: If set then collected notifications are never held for
+                 longer than this many seconds after the first one.
+      splay: If set then each host waits a stable, host specific number of
+             seconds below this before acting on a notification.
+      splay_path: If set then hosts register under this znode and the
+                  splay is spread evenly across the registered hosts.
+      splay_interval: With splay_path, the window grows by this many
+                      seconds for each registered host (capped at splay).
+      cluster_limit: If set then the action runs on at most this many hosts
+                     at once. Other hosts queue until a slot frees up.
+      cluster_lock_path: The znode the hosts sharing cluster_limit queue
+                         under. Required with cluster_limit.
+      nice: The nice value (-20 to 19) the action runs at.
+      ionice_class: The I/O scheduling class of the action. The options are
+                    IOPRIO_CLASS_RT, IOPRIO_CLASS_BE and IOPRIO_CLASS_IDLE.
+      ionice_level: The priority (0 to 7) within ionice_class.
+      cpu_affinity: A list of the CPU numbers (0 to 1023) the action may run
+                    on.
+      rlimits: A dictionary of resource limits such as {'nofile': 1024}.
+               Values are a number or a (soft, hard) tuple.
+      cgroup: A cgroup v2 directory (relative to /sys/fs/cgroup) that every
+              run is placed in. Timeouts kill everything in the run's cgroup.
+      cpu_max: The CPUs the cgroup may use, either a number of CPUs or a
+               cpu.max string.
+      memory_max: The memory limit of the cgroup in bytes, or a memory.max
+                  string.
+      worker_ack: In PERSISTENT mode, if True then the worker writes a line
+                  to stdout once it has handled each update.
+      in_process: If True then the action function is called, with the
+                  znode contents as its argument, on a thread inside the
+                  daemon rather than in a forked process. Children the
+                  function starts itself are left for it to wait for.
+      kill_grace: The number of seconds between SIGTERM and SIGKILL when the
+                  action is terminated by a timeout or a restart.
+      batch_format: In BATCH mode, how versions are written to stdin. The
+                    options are BATCH_LENGTH_PREFIXED (the default) and
+                    BATCH_JSON_LINES.
+      batch_max_count: In BATCH mode, the most versions given to one run.
+      batch_max_bytes: In BATCH mode, the most bytes of data given to one
+                       run.
+      skip_unchanged: If True then the action isn't run when the znode's
+                      contents are the same as they were for the last run.
 
     Returns:
       Nothing.
@@ -83,15 +169,22 @@ class _NamespaceConfig(object):
         'RegisterWatch: znode must be a string.')
     assert (type(action) == types.FunctionType or
             type(action) == types.UnboundMethodType or
-            type(action) == types.LambdaType), (
+            type(action) == types.LambdaType or
+            isinstance(action, spawn.ExecAction)), (
         'RegisterWatch: action must be a function, method or lambda.')
     assert pipe_stdin is None or type(pipe_stdin) == types.BooleanType, (
         'RegisterWatch: pipe_stdin must be one of True or False.')
-    assert run_on_load is None or type(run_on_load) == types.BooleanType, (
-        'RegisterWatch: run_on_load must be one of True of False.')
+    assert (run_on_load is None or type(run_on_load) == types.BooleanType or
+            (run_on_load == 'if_changed' and run_mode is not core.BATCH and
+             _group is None)), (
+        'RegisterWatch: run_on_load must be one of True, False or '
+        '\'if_changed\' (which can not be used with BATCH or groups).')
     assert (run_mode is None or run_mode is core.QUEUE or
-            run_mode is core.PARALLEL or run_mode is core.DISCARD), (
-        'RegisterWatch: run_mode is not one of QUEUE, PARALLEL or DISCARD.')
+            run_mode is core.PARALLEL or run_mode is core.DISCARD or
+            run_mode is core.PERSISTENT or run_mode is core.RESTART or
+            run_mode is core.BATCH), (
+        'RegisterWatch: run_mode is not one of QUEUE, PARALLEL, DISCARD, '
+        'PERSISTENT, RESTART or BATCH.')
     assert description is None or type(description) == types.StringType, (
         'RegisterWatch: Description must be a string.')
     assert (uid is None or
@@ -113,12 +206,156 @@ class _NamespaceConfig(object):
             type(timeout) == types.IntType or
             type(timeout) == types.FloatType), (
         'RegisterWatch: timeout must be a number.')
+    assert (stdin_mode is None or stdin_mode is core.STDIN_PIPE or
+            stdin_mode is core.STDIN_MEMFD), (
+        'RegisterWatch: stdin_mode is not one of STDIN_PIPE or STDIN_MEMFD.')
+    assert (capture_output is None or
+            type(capture_output) == types.BooleanType), (
+        'RegisterWatch: capture_output must be one of True or False.')
+    assert (capture_buffer_size is None or
+            (type(capture_buffer_size) == types.IntType and
+             capture_buffer_size > 0)), (
+        'RegisterWatch: capture_buffer_size must be a positive int.')
+    assert (capture_line_rate is None or
+            ((type(capture_line_rate) == types.IntType or
+              type(capture_line_rate) == types.FloatType) and
+             capture_line_rate > 0)), (
+        'RegisterWatch: capture_line_rate must be a positive number.')
+    assert (priority is None or priority is scheduler.HIGH or
+            priority is scheduler.NORMAL or priority is scheduler.LOW), (
+        'RegisterWatch: priority is not one of PRIORITY_HIGH, '
+        'PRIORITY_NORMAL or PRIORITY_LOW.')
+    assert (max_concurrent is None or
+            (type(max_concurrent) == types.IntType and max_concurrent > 0)), (
+        'RegisterWatch: max_concurrent must be a positive int.')
+    assert (quiet_period is None or
+            ((type(quiet_period) == types.IntType or
+              type(quiet_period) == types.FloatType) and
+             quiet_period >= 0)), (
+        'RegisterWatch: quiet_period must be a number.')
+    assert (max_delay is None or
+            ((type(max_delay) == types.IntType or
+              type(max_delay) == types.FloatType) and
+             max_delay >= 0)), (
+        'RegisterWatch: max_delay must be a number.')
+    assert (splay is None or
+            ((type(splay) == types.IntType or type(splay) == types.FloatType)
+             and splay >= 0)), (
+        'RegisterWatch: splay must be a number.')
+    assert splay_path is None or type(splay_path) == types.StringType, (
+        'RegisterWatch: splay_path must be a string.')
+    assert (splay_interval is None or
+            ((type(splay_interval) == types.IntType or
+              type(splay_interval) == types.FloatType) and
+             splay_interval >= 0 and splay_path is not None)), (
+        'RegisterWatch: splay_interval must be a number and needs splay_path.')
+    assert (splay_path is None or splay is not None or
+            splay_interval is not None), (
+        'RegisterWatch: splay_path needs splay or splay_interval.')
+    assert (cluster_limit is None or
+            (type(cluster_limit) == types.IntType and cluster_limit > 0)), (
+        'RegisterWatch: cluster_limit must be a positive int.')
+    assert ((cluster_limit is None) == (cluster_lock_path is None) and
+            (cluster_lock_path is None or
+             type(cluster_lock_path) == types.StringType)), (
+        'RegisterWatch: cluster_limit and cluster_lock_path (a string) must '
+        'be given together.')
+    assert (nice is None or
+            (type(nice) == types.IntType and nice >= -20 and nice <= 19)), (
+        'RegisterWatch: nice must be an int from -20 to 19.')
+    assert (ionice_class is None or
+            ionice_class is resources.IOPRIO_CLASS_RT or
+            ionice_class is resources.IOPRIO_CLASS_BE or
+            ionice_class is resources.IOPRIO_CLASS_IDLE), (
+        'RegisterWatch: ionice_class is not one of IOPRIO_CLASS_RT, '
+        'IOPRIO_CLASS_BE or IOPRIO_CLASS_IDLE.')
+    assert (ionice_level is None or
+            (type(ionice_level) == types.IntType and ionice_level >= 0 and
+             ionice_level <= 7 and ionice_class is not None)), (
+        'RegisterWatch: ionice_level must be an int from 0 to 7 and needs '
+        'ionice_class.')
+    assert (cpu_affinity is None or
+            (type(cpu_affinity) == types.ListType and cpu_affinity and
+             not [c for c in cpu_affinity
+                  if type(c) != types.IntType or c < 0 or
+                  c >= resources._CPU_SETSIZE])), (
+        'RegisterWatch: cpu_affinity must be a list of CPU numbers from 0 '
+        'to %d.' % (resources._CPU_SETSIZE - 1))
+    assert (rlimits is None or
+            (type(rlimits) == types.DictType and
+             not [n for n in rlimits
+                  if not hasattr(resources.resource,
+                                 'RLIMIT_' + str(n).upper())])), (
+        'RegisterWatch: rlimits must be a dictionary of resource limits.')
+    assert cgroup is None or type(cgroup) == types.StringType, (
+        'RegisterWatch: cgroup must be a string.')
+    assert (cpu_max is None or
+            (cgroup is not None and
+             (type(cpu_max) == types.StringType or
+              ((type(cpu_max) == types.IntType or
+                type(cpu_max) == types.FloatType) and cpu_max > 0)))), (
+        'RegisterWatch: cpu_max must be a number or string and needs cgroup.')
+    assert (memory_max is None or
+            (cgroup is not None and
+             (type(memory_max) == types.StringType or
+              (type(memory_max) in (types.IntType, types.LongType) and
+               memory_max > 0)))), (
+        'RegisterWatch: memory_max must be a number or string and needs '
+        'cgroup.')
+    assert (worker_ack is None or
+            (type(worker_ack) == types.BooleanType and
+             run_mode is core.PERSISTENT)), (
+        'RegisterWatch: worker_ack must be True or False and needs '
+        'run_mode=PERSISTENT.')
+    assert in_process is None or type(in_process) == types.BooleanType, (
+        'RegisterWatch: in_process must be one of True or False.')
+    assert (not in_process or
+            (not isinstance(action, spawn.ExecAction) and
+             run_mode is not core.PERSISTENT)), (
+        'RegisterWatch: in_process needs a function action and can not be '
+        'used with Exec() or run_mode=PERSISTENT.')
+    assert (not in_process or
+            not [x for x in (uid, gid, notify_signal, stdin_mode,
+                             capture_output, nice, ionice_class,
+                             cpu_affinity, rlimits, cgroup)
+                 if x is not None]), (
+        'RegisterWatch: in_process can not be used with uid, gid, '
+        'notify_signal, stdin_mode, capture_output or resource limits.')
+    assert (kill_grace is None or
+            ((type(kill_grace) == types.IntType or
+              type(kill_grace) == types.FloatType) and kill_grace >= 0)), (
+        'RegisterWatch: kill_grace must be a number.')
+    assert (run_mode is not core.BATCH or
+            (watch_type is not core.WATCH_CHILDREN and
+             pipe_stdin is not False)), (
+        'RegisterWatch: run_mode=BATCH needs watch_type=WATCH_DATA and '
+        'pipe_stdin.')
+    assert (batch_format is None or
+            ((batch_format is batch.LENGTH_PREFIXED or
+              batch_format is batch.JSON_LINES) and
+             run_mode is core.BATCH)), (
+        'RegisterWatch: batch_format is not one of BATCH_LENGTH_PREFIXED or '
+        'BATCH_JSON_LINES, or run_mode is not BATCH.')
+    assert (batch_max_count is None or
+            (type(batch_max_count) == types.IntType and batch_max_count > 0
+             and run_mode is core.BATCH)), (
+        'RegisterWatch: batch_max_count must be a positive int and needs '
+        'run_mode=BATCH.')
+    assert (batch_max_bytes is None or
+            (type(batch_max_bytes) == types.IntType and batch_max_bytes > 0
+             and run_mode is core.BATCH)), (
+        'RegisterWatch: batch_max_bytes must be a positive int and needs '
+        'run_mode=BATCH.')
+    assert (skip_unchanged is None or
+            type(skip_unchanged) == types.BooleanType), (
+        'RegisterWatch: skip_unchanged must be one of True or False.')
 
     if description is None:
       description = '%s-%s' % (self._config_file, len(self._configurations) + 1)
 
     kwargs = {}
     kwargs['description'] = description
+    kwargs['group'] = self._config_file
     if pipe_stdin is not None:
       kwargs['pipe_stdin'] = pipe_stdin
     if run_on_load is not None:
@@ -133,19 +370,132 @@ class _NamespaceConfig(object):
       kwargs['notify_signal'] = notify_signal
     if timeout is not None:
       kwargs['timeout'] = timeout
-
-    if watch_type is core.WATCH_CHILDREN:
+    if stdin_mode is not None:
+      kwargs['stdin_mode'] = stdin_mode
+    if capture_output is not None:
+      kwargs['capture_output'] = capture_output
+    if capture_buffer_size is not None:
+      kwargs['capture_buffer_size'] = capture_buffer_size
+    if capture_line_rate is not None:
+      kwargs['capture_line_rate'] = capture_line_rate
+    if priority is not None:
+      kwargs['priority'] = priority
+    if max_concurrent is not None:
+      kwargs['max_concurrent'] = max_concurrent
+    if quiet_period is not None:
+      kwargs['quiet_period'] = quiet_period
+    if max_delay is not None:
+      kwargs['max_delay'] = max_delay
+    if in_process is not None:
+      kwargs['in_process'] = in_process
+    if kill_grace is not None:
+      kwargs['kill_grace'] = kill_grace
+    if skip_unchanged is not None:
+      kwargs['skip_unchanged'] = skip_unchanged
+    if run_mode is core.BATCH:
+      kwargs['batch'] = batch.Batch(batch_format or batch.LENGTH_PREFIXED,
+                                    batch_max_count, batch_max_bytes)
+    if splay is not None or splay_interval is not None:
+      kwargs['splay'] = Splay(znode, splay, splay_path, splay_interval)
+    if cluster_limit is not None:
+      kwargs['semaphore'] = DistributedSemaphore(cluster_lock_path,
+                                                 cluster_limit)
+    if [x for x in (nice, ionice_class, cpu_affinity, rlimits, cgroup)
+        if x is not None]:
+      kwargs['resources'] = resources.ResourceLimits(
+          nice=nice, ionice_class=ionice_class, ionice_level=ionice_level,
+          cpu_affinity=cpu_affinity, rlimits=rlimits, cgroup=cgroup,
+          cpu_max=cpu_max, memory_max=memory_max)
+    if run_mode is core.PERSISTENT:
+      kwargs['worker'] = worker.PersistentWorker(
+          description, action, uid=uid, gid=gid, ack=bool(worker_ack),
+          timeout=timeout, capture_output=bool(capture_output),
+          capture_buffer_size=(capture_buffer_size or
+                               capture.DEFAULT_BUFFER_SIZE),
+          capture_line_rate=capture_line_rate or capture.DEFAULT_LINE_RATE,
+          resources=kwargs.get('resources'))
+
+    if _group is not None:
+        # Called by RegisterWatchGroup with (znodes, group_format).
+        config = core.TwitcherGroupObject(_group[0], action,
+                                          group_format=_group[1], **kwargs)
+    elif watch_type is core.WATCH_CHILDREN:
         config = core.TwitcherChildrenObject(znode, action, **kwargs)
     else:
         config = core.TwitcherObject(znode, action, **kwargs)
     self._configurations.append(config)
 
+  def RegisterWatchGroup(self, znodes=None, action=None, group_format=None,
+                         **kwargs):
+    """Registers one action for a group of related znodes.
+
+    A notification on any of the znodes leads to a single run of the action
+    for the whole group. The run is given every znode that changed since
+    the last run, with its data, on stdin. run_mode applies to the group: a
+    notification for any znode while the action runs is queued (QUEUE),
+    ignored (DISCARD) or restarts it (RESTART).
+
+    Args:
+      znodes: The list of znodes to watch.
+      action: The function that should be called when any of them update.
+      group_format: How the changed znodes are written to stdin. The
+                    options are BATCH_LENGTH_PREFIXED (the default) and
+                    BATCH_JSON_LINES.
+      Any other RegisterWatch argument except watch_type, pipe_stdin,
+      skip_unchanged and the PERSISTENT and BATCH options.
+
+    Returns:
+      Nothing.
+    """
+    assert (type(znodes) == types.ListType and znodes and
+            not [z for z in znodes if type(z) != types.StringType] and
+            len(set(znodes)) == len(znodes)), (
+        'RegisterWatchGroup: znodes must be a list of distinct strings.')
+    assert (group_format is None or group_format is batch.LENGTH_PREFIXED or
+            group_format is batch.JSON_LINES), (
+        'RegisterWatchGroup: group_format is not one of '
+        'BATCH_LENGTH_PREFIXED or BATCH_JSON_LINES.')
+    run_mode = kwargs.get('run_mode')
+    assert (run_mode is None or run_mode is core.QUEUE or
+            run_mode is core.DISCARD or run_mode is core.RESTART), (
+        'RegisterWatchGroup: run_mode is not one of QUEUE, DISCARD or '
+        'RESTART.')
+    assert not [k for k in ('znode', 'watch_type', 'pipe_stdin', 'worker_ack',
+                            'batch_format', 'batch_max_count',
+                            'batch_max_bytes', 'skip_unchanged', '_group')
+                if k in kwargs], (
+        'RegisterWatchGroup: znode, watch_type, pipe_stdin, skip_unchanged '
+        'and the PERSISTENT and BATCH options can not be used.')
+    self.RegisterWatch(znode=znodes[0], action=action,
+                       _group=(znodes, group_format or batch.LENGTH_PREFIXED),
+                       **kwargs)
+
+  def SetMaxConcurrency(self, limit):
+    """Limits how many processes the watches of this file may run at once.
+
+    Args:
+      limit: The most processes, across every watch registered in this
+             config file, that may run at the same time, or None for no
+             limit.
+
+    Returns:
+      Nothing.
+    """
+    assert limit is None or (type(limit) == types.IntType and limit > 0), (
+        'SetMaxConcurrency: limit must be a positive int or None.')
+    self._max_concurrency = limit
+
+  def get_max_concurrency(self):
+    """Returns the limit set with SetMaxConcurrency() or None."""
+    return self._max_concurrency
+
   def Exec(self, command):
-    """Returns a lambda that will execute the given command.
+    """Returns an action that will execute the given command.
 
     This function is a simple tool intended to be used in configurations
-    files. This will return a lambda so the user doesn't have to write
-    a function that executes anything.
+    files. This will return a callable so the user doesn't have to write
+    a function that executes anything. Since the command is known up front
+    twitcher can start it with posix_spawn rather than forking itself.
 
     Args:
       command: The command to run. If this is a string then the command will
@@ -153,11 +503,11 @@ class _NamespaceConfig(object):
                executed directly.
 
     Returns:
-      A Lambda that will run the given command.
+      A spawn.ExecAction that will run the given command.
     """
     if isinstance(command, str):
       command = ['/bin/sh', '-c', command]
-    return (lambda: os.execlp(command[0], *command))
+    return spawn.ExecAction(command)
 
   def get_configurations(self):
     """Returns a list of all configurations registered.
@@ -200,11 +550,26 @@ class ConfigFile(inotify.WatchClass):
     exec_globals = {
         'Exec': namespace_config.Exec,
         'RegisterWatch': namespace_config.RegisterWatch,
+        'RegisterWatchGroup': namespace_config.RegisterWatchGroup,
+        'SetMaxConcurrency': namespace_config.SetMaxConcurrency,
         'QUEUE': core.QUEUE,
         'PARALLEL': core.PARALLEL,
         'DISCARD': core.DISCARD,
+        'PERSISTENT': core.PERSISTENT,
+        'RESTART': core.RESTART,
+        'BATCH': core.BATCH,
+        'BATCH_LENGTH_PREFIXED': batch.LENGTH_PREFIXED,
+        'BATCH_JSON_LINES': batch.JSON_LINES,
         'WATCH_DATA': core.WATCH_DATA,
         'WATCH_CHILDREN': core.WATCH_CHILDREN,
+        'STDIN_PIPE': core.STDIN_PIPE,
+        'STDIN_MEMFD': core.STDIN_MEMFD,
+        'PRIORITY_HIGH': scheduler.HIGH,
+        'PRIORITY_NORMAL': scheduler.NORMAL,
+        'PRIORITY_LOW': scheduler.LOW,
+        'IOPRIO_CLASS_RT': resources.IOPRIO_CLASS_RT,
+        'IOPRIO_CLASS_BE': resources.IOPRIO_CLASS_BE,
+        'IOPRIO_CLASS_IDLE': resources.IOPRIO_CLASS_IDLE,
         }
     try:
       execfile(self._filename, exec_globals, {})
@@ -213,11 +578,30 @@ class ConfigFile(inotify.WatchClass):
         o.init()
     except Exception, e:
       logging.error('Exception processing %s: %s' % (self._filename, e))
+      for o in namespace_config.get_configurations():
+        o.close()
       return
 
+    for o in self._config_objects:
+      o.close()
+    if core.default_registry is not None:
+      core.default_registry.replace(self._config_objects, objects)
+    if core.default_scheduler is not None:
+      core.default_scheduler.set_group_limit(
+          self._filename, namespace_config.get_max_concurrency())
     self._config_objects = objects
     logging.warning('Successfully loaded configs from %s', self._filename)
 
+  def unload(self):
+    """Called when the config file has been removed from disk."""
+    for o in self._config_objects:
+      o.close()
+    if core.default_registry is not None:
+      core.default_registry.replace(self._config_objects, [])
+    if core.default_scheduler is not None:
+      core.default_scheduler.set_group_limit(self._filename, None)
+    self._config_objects = []
+
   def get_configurations(self):
     """Returns all configurations (TwitcherObjects) from this file."""
     return self._config_objects
@@ -8,29 +8,61 @@ here is the TwitcherObject which acts as a simple wrapper for each watch.
 Author: Brady Catherman (brady@twitter.com)
 """
 
+import errno
+import functools
 import grp
+import hashlib
 import logging
 import os
-import resource
 import threading
 import types
 import pwd
 import signal
-import sys
 import time
 import zookeeper
 
 # Twitcher object
+import batch
+import capture
+import fds
+import payload
+import reactor
+import scheduler
+import spawn
+import stats
+import threadpool
 import zkwrapper
 
 
 # The default ZKWrapper object to use when registering watches.
 default_zkwrapper = None
 
-# The default file descriptor to send '\0' to if we span a new process.
-# This is used to allow select to restart which will pick up the new
-# stdin that needs written too.
-default_ping_fd = None
+# The default Reactor object used to watch child process file descriptors.
+default_reactor = None
+
+# The default Reaper object that collects exited children.
+default_reaper = None
+
+# The default ObjectRegistry that tracks every loaded TwitcherObject.
+default_registry = None
+
+# The default Zygote object used to start Exec() actions, if enabled.
+default_zygote = None
+
+# The default Scheduler that decides when actions may start.
+default_scheduler = None
+
+# The default AdmissionController that defers runs under load, if enabled.
+default_admission = None
+
+# The default ThreadPool that runs in process actions.
+default_thread_pool = None
+
+# The default StateFile recording each watch's last run, if enabled.
+default_state = None
+
+# The number of seconds between SIGTERM and SIGKILL when stopping a child.
+DEFAULT_KILL_GRACE = 5
 
 def set_default_zkwrapper(obj):
   """Sets the value of default_zkwrapper."""
@@ -38,19 +70,101 @@ def set_default_zkwrapper(obj):
   default_zkwrapper = obj
 
 
-def set_default_ping_fd(fd):
-  """Sets the value of default_ping_fd."""
-  global default_ping_fd
-  default_ping_fd = fd
+def set_default_reactor(obj):
+  """Sets the value of default_reactor."""
+  global default_reactor
+  default_reactor = obj
+
+
+def set_default_scheduler(obj):
+  """Sets the value of default_scheduler."""
+  global default_scheduler
+  default_scheduler = obj
+
+
+def set_default_admission(obj):
+  """Sets the value of default_admission."""
+  global default_admission
+  default_admission = obj
+
+
+def set_default_thread_pool(obj):
+  """Sets the value of default_thread_pool."""
+  global default_thread_pool
+  default_thread_pool = obj
+
+
+def set_default_state(obj):
+  """Sets the value of default_state."""
+  global default_state
+  default_state = obj
+
+
+def set_default_zygote(obj):
+  """Sets the value of default_zygote."""
+  global default_zygote
+  default_zygote = obj
+
+
+def _log_spawn_timing(desc, method, seconds):
+  """The default spawn_timing_hook; logs the setup time at debug level."""
+  logging.debug('Setup of "%s" via %s took %.6f seconds', desc, method,
+                seconds)
+
+
+# Called as func(desc, method, seconds) for every child process started.
+# method is 'fork', 'spawn' or 'zygote' and seconds is the time between
+# starting the process and the point where the child is about to run its
+# action.
+spawn_timing_hook = _log_spawn_timing
+
+
+def set_spawn_timing_hook(func):
+  """Sets the value of spawn_timing_hook."""
+  global spawn_timing_hook
+  spawn_timing_hook = func
+
+
+def set_default_reaper(obj):
+  """Sets the value of default_reaper."""
+  global default_reaper
+  default_reaper = obj
+
+
+def set_default_registry(obj):
+  """Sets the value of default_registry."""
+  global default_registry
+  default_registry = obj
+
+
+def _from_zookeeper(func):
+  """Decorator that moves zookeeper callbacks onto the reactor thread.
+
+  The zookeeper module calls watchers and completions from its own thread.
+  Wrapping those entry points with this ensures that all state changes and
+  forks happen on the main loop.
+  """
+  @functools.wraps(func)
+  def wrapper(*args):
+    if default_reactor is None:
+      return func(*args)
+    default_reactor.run_in_reactor(func, *args)
+  return wrapper
 
 
 QUEUE = 1
 PARALLEL = 2
 DISCARD = 3
+PERSISTENT = 4
+RESTART = 5
+BATCH = 6
 
 WATCH_DATA = 1
 WATCH_CHILDREN = 2
 
+STDIN_PIPE = 1
+STDIN_MEMFD = 2
+
 class UnknownUserError(Exception):
   pass
 
@@ -59,6 +173,45 @@ class UnknownGroupError(Exception):
   pass
 
 
+class ObjectRegistry(object):
+  """Tracks the TwitcherObjects that are currently loaded.
+
+  Config files add and remove their objects as they are reloaded or deleted
+  so the set of active watches never has to be rebuilt by walking every
+  config file. Nothing in the main loop iterates this registry; events are
+  routed to objects through the reactor, the reaper and timers, so idle
+  watches cost nothing per wakeup.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._objects = set()
+
+  def __len__(self):
+    return len(self._objects)
+
+  def descriptions(self):
+    """Returns the descriptions of every registered TwitcherObject."""
+    self._lock.acquire()
+    r = [o._description for o in self._objects]
+    self._lock.release()
+    return r
+
+  def replace(self, old, new):
+    """Swaps one set of objects for another.
+
+    Args:
+      old: An iterable of objects being unloaded.
+      new: An iterable of objects being loaded.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    self._objects.difference_update(old)
+    self._objects.update(new)
+    self._lock.release()
+
+
 class MinimalSubprocess(object):
   """Wraps much of the functionality from subprocess.
 
@@ -74,28 +227,52 @@ class MinimalSubprocess(object):
 
   Args:
     desc: The string description of this subprocess.
-    data: The data we should write to stdin of the forked process.
+    data: The data we should write to stdin of the forked process. This may
+          be a string or a payload.Payload shared with other processes.
+    timeout: The number of seconds before the process is terminated.
+    on_exit: Called with this object once the default reaper has collected
+             the exit status of the process.
+    stdin_mode: STDIN_PIPE to pump data through a pipe or STDIN_MEMFD to
+                give the child a sealed memfd holding the data.
+    capture: An optional capture.OutputCapture which receives the child's
+             stdout and stderr. Otherwise they go to /dev/null.
+    job: The scheduler.Job this process was started for, if any.
+    lease: The semaphore.Lease this process holds, if any.
+    resources: A resources.ResourceLimits applied to the child, if any.
+    kill_grace: The number of seconds between SIGTERM and SIGKILL when the
+                process is terminated.
+    env: A dictionary of environment variables added for the child.
   """
-  def __init__(self, desc, data, timeout=None):
+  # The zygote writes stdin and closes it, so it can't start children whose
+  # stdin stays open.
+  use_zygote = True
+
+  def __init__(self, desc, data, timeout=None, on_exit=None,
+               stdin_mode=None, capture=None, job=None, lease=None,
+               resources=None, kill_grace=DEFAULT_KILL_GRACE, env=None):
     logging.debug('Creating MinimalSubprocess (%s): %s', self, desc)
     self.stdin = None
     self.pid = -1
     self.desc = desc
-    self.data = data
+    self.payload = payload.for_data(data)
+    self.stdin_mode = stdin_mode or STDIN_PIPE
+    self._offset = 0
+    self.capture = capture
+    self.job = job
+    self.lease = lease
+    self.resources = resources
+    self.env = env
     self.sigterm_sent = False
-    if timeout is None:
-      self.timeout_secs = sys.maxint
-    else:
-      self.timeout_secs = time.time() + timeout
+    self.returncode = None
+    self._timeout = timeout
+    self._kill_grace = kill_grace
+    self._timer = None
+    self._on_exit = on_exit
 
   def __del__(self):
     """Verifies that the file descriptors all get closed properly."""
     logging.debug('Reaping MinimalSubprocess "%s" (%s)', self.desc, self)
-    if self.stdin is not None:
-      try:
-        os.close(self.stdin)
-      except OSError:
-        pass
+    self._close_stdin()
 
   def signal(self, signal):
     """Sends the given signal to the child process.
@@ -103,88 +280,123 @@ class MinimalSubprocess(object):
     Args:
       signal: The signal to send to the child, (see the signal module).
     """
+    if self.pid <= 0:
+      return
     try:
       os.kill(self.pid, signal)
     except:
       pass
 
-  def timeout(self):
-    """Returns the number of seconds until this process times out.
+  def signal_group(self, signal):
+    """Sends the given signal to everything the child process started.
 
-    This function returns the timeout that was specified in the
-    constructor, or if timeout was not specified then sys.maxint will be
-    returned. This allows timeouts to always functionally exist. If this
-    returns a negative value then the timeout has expired by the given
-    number of seconds.
+    Every child leads its own process group, so this reaches grandchildren
+    such as the command run by 'sh -c'. If the child runs in a cgroup then
+    every process in it is signaled as well.
 
-    Returns:
-      The number of seconds until (or since if negative) the process is
-      considered timed out.
+    Args:
+      signal: The signal to send, (see the signal module).
     """
-    return self.timeout_secs - time.time()
-
-  def terminate(self):
+    if self.pid <= 0:
+      return
+    try:
+      os.killpg(self.pid, signal)
+    except OSError:
+      self.signal(signal)
+    if self.resources is not None:
+      self.resources.signal_cgroup(self.pid, signal)
+
+  def _start_timer(self):
+    """Registers the process timeout with the default reactor."""
+    if self._timeout is not None and default_reactor is not None:
+      self._timer = default_reactor.call_later(self._timeout, self.terminate)
+
+  def _cancel_timer(self):
+    """Cancels any pending timeout for this process."""
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+  def terminate(self, reason='timeout'):
     """Called to terminate the child process.
 
     Calling this function will start the cycle of terminating the child
-    process. Initially this will sent a SIGTERM, then after 5 seconds it will
-    send a SIGKILL. Once a SIGKILL has been sent the timeout will be
-    removed and the natural process termination cycle is assumed to be
-    in progress.
+    process and everything it started. Initially this will sent a SIGTERM,
+    then after kill_grace seconds it will send a SIGKILL. Once a SIGKILL has
+    been sent the timeout will be removed and the natural process
+    termination cycle is assumed to be in progress.
+
+    Args:
+      reason: Why the process is being terminated, used when logging.
     """
+    self._cancel_timer()
+    if self.returncode is not None:
+      return
     if self.sigterm_sent:
-      logging.warning('Killing "%s" (timeout)', self.desc)
-      os.kill(self.pid, signal.SIGKILL)
-      self.timeout_secs = sys.maxint
+      logging.warning('Killing "%s" (%s)', self.desc, reason)
+      self.signal_group(signal.SIGKILL)
     else:
-      logging.warning('Attempting to terminate "%s" (timeout)', self.desc)
-      self.sigterm_sent
-      os.kill(self.pid, signal.SIGTERM)
-      self.timeout_secs = time.time() + 5
-
-  def poll(self):
-    """Tests to see if the process has exited.
-
-    This function mimics subprocess.Popen.poll(). It returns None if the
-    process has not exited yet and if it has it will set returncode and
-    return the value.
-
-    Once this call has returned a value other than None further calls will
-    result in a OSError being thrown.
+      logging.warning('Attempting to terminate "%s" (%s)', self.desc, reason)
+      self.sigterm_sent = True
+      self.signal_group(signal.SIGTERM)
+      if default_reactor is not None:
+        self._timer = default_reactor.call_later(self._kill_grace,
+                                                 self.terminate, reason)
+
+  def _reaped(self, pid, status):
+    """Called by the reaper once the process has exited."""
+    self.returncode = status
+    self._cancel_timer()
+    if self.resources is not None:
+      self.resources.cleanup(pid)
+    if self._on_exit is not None:
+      self._on_exit(self)
+
+  def _close_stdin(self):
+    """Unregisters stdin from the reactor and closes it."""
+    if self.stdin is None:
+      return
+    if default_reactor is not None:
+      default_reactor.unregister(self.stdin)
+    try:
+      os.close(self.stdin)
+    except OSError:
+      pass
+    self.stdin = None
 
-    Returns:
-      None or a return code.
-    """
-    logging.debug('Polling for process "%s" (%s)', self.desc, self.pid)
-    r = os.waitpid(self.pid, os.WNOHANG)
-    if r == (0, 0):
-      return None
-    self.returncode = r[1]
-    return r[1]
+  def _stdin_ready(self, fd, events):
+    """Called by the reactor when stdin is writable."""
+    self.write_buffer()
 
   def write_buffer(self):
     """Attempts to write data to stdin.
 
     This will attempt to write the data passed into the constructor to
     stdin. If the data is written completely then stdin will be closed,
-    otherwise it will retain the remainder of data that has not been written
-    for further calls.
-
-    Throws:
-      OSError: If called after a non None value is returned.
+    otherwise it will remember how far it got for further calls. The data
+    is never copied; writes come from a memoryview of the shared payload.
+    stdin is non blocking so this never waits on the child.
 
     Returns:
       Nothing.
     """
-    if self.stdin is not None:
-      written = os.write(self.stdin, self.data)
-      self.data = self.data[written:]
-      if not self.data:
-        self.data = None
-        os.close(self.stdin)
-        self.stdin = None
+    if self.stdin is None:
+      return
+    try:
+      written = os.write(self.stdin, self.payload.view[self._offset:])
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return
+      # The child closed stdin (EPIPE) or exited without reading it.
+      logging.info('Unable to write stdin for "%s": %s', self.desc, e)
+      self._close_stdin()
+      return
+    self._offset += written
+    if self._offset >= len(self.payload):
+      self._close_stdin()
 
-  def _child_exec(self, stdin_fd, func, uid=None, gid=None):
+  def _child_exec(self, stdin_fd, func, uid=None, gid=None, timing_fd=None,
+                  started=None, output_fds=None, resources=None, env=None):
     """Called to setup the child after the fork.
 
     This function handles all client operations post fork. The main
@@ -198,6 +410,13 @@ class MinimalSubprocess(object):
       func: The function we should run once setup properly.
       uid: The userid (int) to switch to after forking.
       gid: The groupid (int) to switch to after forking.
+      timing_fd: If given, the time setup finished is written here so the
+                 parent can report how long setup took.
+      started: The time the parent started the fork.
+      output_fds: An optional (stdout, stderr) tuple of file descriptors.
+                  /dev/null is used for any that are None.
+      resources: An optional resources.ResourceLimits to apply.
+      env: An optional dictionary of environment variables to set.
 
     Throws:
       OSError: Any error during the dup/close cycle.
@@ -205,20 +424,28 @@ class MinimalSubprocess(object):
     Returns:
       Nothing.
     """
+    # Lead a new process group so a timeout can kill everything we start.
+    os.setpgid(0, 0)
     os.dup2(stdin_fd, 0)
-    f = os.open('/dev/null', os.O_WRONLY)
-    os.dup2(f, 1)
-    os.dup2(f, 2)
-
-    # Close all open file descriptors besides stdin/stdout/stderr
-    maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-    if (maxfd == resource.RLIM_INFINITY):
-      maxfd = MAXFD
-    for fd in xrange(3, maxfd):
-      try:
-        os.close(fd)
-      except OSError:
-        pass
+    if output_fds is None:
+      output_fds = (None, None)
+    for fd, target in zip(output_fds, (1, 2)):
+      if fd is None:
+        fd = os.open('/dev/null', os.O_WRONLY)
+      os.dup2(fd, target)
+    if timing_fd is not None:
+      os.dup2(timing_fd, 3)
+
+    # Close all open file descriptors besides stdin/stdout/stderr (and the
+    # timing pipe which is closed below).
+    if timing_fd is None:
+      fds.close_fds_from(3)
+    else:
+      fds.close_fds_from(4)
+
+    # Limits have to be applied while we are still root.
+    if resources is not None:
+      resources.apply()
 
     # Switch the userid if needed.
     if gid:
@@ -226,9 +453,189 @@ class MinimalSubprocess(object):
     if uid:
       os.setuid(uid)
 
+    if env:
+      os.environ.update(env)
+
+    if timing_fd is not None:
+      os.write(3, repr(time.time() - started))
+      os.close(3)
+
     # Run our function.
     func()
 
+  def _resolve_ids(self, uid, gid):
+    """Converts string based user names and group names into integers.
+
+    Throws:
+      UnknownUserError: If the user doesn't exist.
+      UnknownGroupError: If the group doesn't exist.
+
+    Returns:
+      A (uid, gid) tuple.
+    """
+    if type(uid) == types.StringType:
+      try:
+        uid = pwd.getpwnam(uid).pw_uid
+      except KeyError:
+        raise UnknownUserError()
+    if type(gid) == types.StringType:
+      try:
+        gid = grp.getgrnam(gid).gr_gid
+      except KeyError:
+        raise UnknownGroupError()
+    return (uid, gid)
+
+  def _open_stdin(self):
+    """Creates the child's stdin.
+
+    Returns:
+      A tuple of (child_fd, parent_fd). child_fd should become the child's
+      stdin and be closed in the parent once the child has started. parent_fd
+      is the end of the pipe we write to, or None in STDIN_MEMFD mode.
+    """
+    if self.stdin_mode == STDIN_MEMFD:
+      return (self.payload.open_stdin(), None)
+    stdin = os.pipe()
+    fds.set_cloexec(stdin[1])
+    return stdin
+
+  def _started(self, pid, stdin_fd):
+    """Tracks a newly started child in the parent process.
+
+    Args:
+      pid: The pid of the child.
+      stdin_fd: The write end of the child's stdin pipe, or None.
+
+    Returns:
+      Nothing.
+    """
+    self.pid = pid
+    if default_reaper is not None:
+      default_reaper.register(pid, self._reaped)
+    self._start_timer()
+    if stdin_fd is None:
+      return
+    self.stdin = stdin_fd
+    reactor.set_nonblocking(self.stdin)
+    if not len(self.payload):
+      self._close_stdin()
+    elif default_reactor is not None:
+      default_reactor.register(self.stdin, reactor.WRITE, self._stdin_ready)
+    else:
+      self.write_buffer()
+
+  def start(self, func, uid=None, gid=None):
+    """Starts the child process using the cheapest method available.
+
+    Actions created by Exec() are handed to the zygote if one is running,
+    otherwise they are started with posix_spawn when possible. Everything
+    else goes through fork_exec().
+
+    Args:
+      func: The action function.
+      uid: The userid (int or string) to run as.
+      gid: The groupid (int or string) to run as.
+
+    Throws:
+      OSError: Any kind of error while starting the process.
+
+    Returns:
+      Nothing.
+    """
+    uid, gid = self._resolve_ids(uid, gid)
+    if self.resources is not None:
+      try:
+        self.resources.prepare()
+      except (IOError, OSError), e:
+        logging.error('Unable to set up the cgroup for "%s": %s', self.desc,
+                      e)
+        raise OSError(e.errno, str(e))
+    if (isinstance(func, spawn.ExecAction) and self.capture is None and
+        self.use_zygote and default_zygote is not None and
+        default_zygote.available()):
+      self.zygote_exec(func.argv, uid, gid)
+    elif spawn.can_spawn(func, uid, gid) and self.resources is None:
+      self.spawn_exec(func.argv)
+    else:
+      self.fork_exec(func, uid, gid)
+
+  def zygote_exec(self, argv, uid=None, gid=None):
+    """Asks the default zygote to start argv.
+
+    The zygote writes stdin itself so nothing is pumped from this process.
+    The pid is filled in by zygote_started() once the zygote replies.
+
+    Args:
+      argv: The argument vector to execute.
+      uid: The userid (int) to run as.
+      gid: The groupid (int) to run as.
+
+    Returns:
+      Nothing.
+    """
+    default_zygote.spawn(self, argv, uid, gid, self.payload.data,
+                         self.stdin_mode, self.resources, self.env)
+    self._start_timer()
+
+  def zygote_started(self, pid):
+    """Called when the zygote reports the pid of our child.
+
+    The child belongs to the zygote, which reports its exit by request, so
+    the pid isn't registered with our reaper where a child of this process
+    could reuse it.
+    """
+    self.pid = pid
+
+  def spawn_exec(self, argv):
+    """Starts argv with posix_spawn rather than fork.
+
+    Args:
+      argv: The argument vector to execute.
+
+    Throws:
+      OSError: Any kind of error while spawning.
+
+    Returns:
+      Nothing.
+    """
+    stdin = self._open_stdin()
+    output = (None, None)
+    if self.capture is not None:
+      output = self.capture.child_fds()
+    env = None
+    if self.env:
+      env = dict(os.environ)
+      env.update(self.env)
+    started = time.time()
+    try:
+      pid = spawn.spawn(argv, stdin[0], output[0], output[1], env)
+    except OSError, e:
+      for fd in stdin:
+        if fd is not None:
+          os.close(fd)
+      if self.capture is not None:
+        self.capture.close()
+      logging.error('OSError while spawning for "%s": %s', self.desc, e)
+      raise
+    spawn_timing_hook(self.desc, 'spawn', time.time() - started)
+    os.close(stdin[0])
+    if self.capture is not None:
+      self.capture.started()
+    self._started(pid, stdin[1])
+
+  def _read_setup_time(self, fd, events):
+    """Reads the setup time reported by a forked child."""
+    try:
+      data = os.read(fd, 64)
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return
+      data = ''
+    default_reactor.unregister(fd)
+    os.close(fd)
+    if data:
+      spawn_timing_hook(self.desc, 'fork', float(data))
+
   def fork_exec(self, func, uid=None, gid=None):
     """Calls fork and mimics exec.
 
@@ -248,37 +655,51 @@ class MinimalSubprocess(object):
       Nothing.
     """
     try:
-      # Convert string based user names and group names into integers.
-      if type(uid) == types.StringType:
-        ud = pwd.getpwnam(uid)
-        if not ud:
-          raise UnknownUserError()
-        uid = ud.pw_uid
-      if type(gid) == types.StringType:
-        groups = pwd.getpwall()
-        gd = grp.getgrnam(gid)
-        if not gd:
-          raise UnknownGroupError()
-        gid = gd.gr_gid
-
-      stdin = os.pipe()
+      uid, gid = self._resolve_ids(uid, gid)
+      stdin = self._open_stdin()
+      output = None
+      if self.capture is not None:
+        output = self.capture.child_fds()
+      timing = None
+      if default_reactor is not None:
+        timing = os.pipe()
+        fds.set_cloexec(timing[0])
+      started = time.time()
       pid = os.fork()
       if pid < 0:
         raise OSError('Unknown problem with fork()')
       elif pid == 0:
-        # Child.
-        r = self._child_exec(stdin[0], func, uid=uid, gid=gid)
-        if type(r) == int:
-          os._exit(r)
-        elif r is None:
-          os._exit(0)
+        # Child. Nothing may escape from here back into the daemon's stack.
+        try:
+          r = self._child_exec(stdin[0], func, uid=uid, gid=gid,
+                               timing_fd=timing and timing[1],
+                               started=started, output_fds=output,
+                               resources=self.resources, env=self.env)
+          if type(r) == int:
+            os._exit(r)
+          elif r is None:
+            os._exit(0)
+        except:
+          pass
         os._exit(1)
       else:
-        # Parent
-        self.pid = pid
-        self.stdin = stdin[1]
+        # Parent. The child also does this; whichever runs first wins.
+        try:
+          os.setpgid(pid, pid)
+        except OSError:
+          pass
         os.close(stdin[0])
+        if self.capture is not None:
+          self.capture.started()
+        if timing is not None:
+          os.close(timing[1])
+          reactor.set_nonblocking(timing[0])
+          default_reactor.register(timing[0], reactor.READ,
+                                   self._read_setup_time)
+        self._started(pid, stdin[1])
     except OSError, e:
+      if self.capture is not None:
+        self.capture.close()
       logging.error('OSError while forking for "%s": %s', self.desc, e)
       raise
 
@@ -302,7 +723,9 @@ class TwitcherObject(object):
                 stdin.
     run_on_load: Should this script be run when this config is loaded.
                  If this is True (default) then the script will be started
-                 when twitcher loads and when watches fire.
+                 when twitcher loads and when watches fire. If this is
+                 'if_changed' then it is only started on load if the data
+                 differs from the last run recorded in default_state.
     run_mode: This defines how Twitcher should react when a watch is updated
               while the script is currently running. This should be one of
               the following:
@@ -313,6 +736,13 @@ class TwitcherObject(object):
               core.PARALLEL: Run scripts in parallel.
               core.DISCARD: Discard requests received while the script is
                             currently running.
+              core.PERSISTENT: Keep one worker process running and send it
+                               each update (see the worker argument).
+              core.RESTART: Terminate the running script when the watch
+                            fires and run it again with the latest data.
+              core.BATCH: Keep every version received while the script is
+                          running and give them all to the next run (see
+                          the batch argument).
     uid: The user id the process should run as.
     gid: The group id the process should run as.
     notify_signal: If set this signal will be sent to the currently running
@@ -320,16 +750,52 @@ class TwitcherObject(object):
     timeout: The number of seconds that the script should be allowed to
              execute before being killed.
     description: The basic description of this command (ex: command line)
+    stdin_mode: How the znode contents reach stdin, either core.STDIN_PIPE
+                (the default) or core.STDIN_MEMFD.
+    capture_output: If True then stdout and stderr of the process are logged.
+    capture_buffer_size: The most bytes buffered per stream when capturing.
+    capture_line_rate: The most lines per second logged for this watch.
+    priority: The scheduler priority of this watch's actions; one of
+              scheduler.HIGH, scheduler.NORMAL or scheduler.LOW.
+    max_concurrent: The most processes of this watch that may run at once.
+    group: The scheduler group (config file) this watch belongs to.
+    quiet_period: If set then notifications are collected and the action is
+                  run once this many seconds after the last one.
+    max_delay: If set then collected notifications are never held for more
+               than this many seconds after the first one.
+    splay: If set, a splay.Splay giving the delay this host waits before
+           acting on a notification.
+    semaphore: If set, a semaphore.DistributedSemaphore a slot of which must
+               be held while the process runs.
+    resources: If set, a resources.ResourceLimits applied to every process.
+    worker: In PERSISTENT mode, the worker.PersistentWorker updates are
+            delivered to.
+    in_process: If True then run_func is called with the data on the
+                default thread pool rather than in a child process.
+    kill_grace: The number of seconds between SIGTERM and SIGKILL when a
+                process is terminated.
+    batch: In BATCH mode, the batch.Batch versions are buffered in.
+    skip_unchanged: If True then the action isn't run when the contents of
+                    the znode are the same as they were for the last run.
   """
   def __init__(self, path, run_func,
                pipe_stdin=True, run_on_load=True,
                run_mode=QUEUE, uid=None, gid=None,
                notify_signal=None, timeout=None,
-               description='generic object'):
+               description='generic object', stdin_mode=STDIN_PIPE,
+               capture_output=False,
+               capture_buffer_size=capture.DEFAULT_BUFFER_SIZE,
+               capture_line_rate=capture.DEFAULT_LINE_RATE,
+               priority=scheduler.NORMAL, max_concurrent=None, group=None,
+               quiet_period=None, max_delay=None, splay=None,
+               semaphore=None, resources=None, worker=None,
+               in_process=False, kill_grace=DEFAULT_KILL_GRACE,
+               batch=None, skip_unchanged=False):
     self._path = path
     self._run_func = run_func
     self._pipe_stdin = pipe_stdin
     self._run_on_load = run_on_load
+    self._check_state = run_on_load == 'if_changed'
     self._run_mode = run_mode
     self._processes = []
     self._description = description
@@ -337,7 +803,34 @@ class TwitcherObject(object):
     self._gid = gid
     self._notify_signal = notify_signal
     self._timeout = timeout
+    self._stdin_mode = stdin_mode
+    self._capture_output = capture_output
+    self._capture_buffer_size = capture_buffer_size
+    self._capture_limiter = capture.LineRateLimiter(capture_line_rate)
+    self._priority = priority
+    self._max_concurrent = max_concurrent
+    self._group = group
+    self._quiet_period = quiet_period
+    self._max_delay = max_delay
+    self._debounce_timer = None
+    self._debounce_deadline = None
+    self._splay = splay
+    self._splay_timer = None
+    self._semaphore = semaphore
+    self._leases = []
+    self._deferrals = []
+    self._resources = resources
+    self._worker = worker
+    self._in_process = in_process
+    self._kill_grace = kill_grace
+    self._batch = batch
+    self._skip_unchanged = skip_unchanged
+    self._last_digest = None
+    self._closed = False
+    self._jobs = []
     self._unhandled_watch = None
+    # The zkwrapper.Subscription held for each watched znode.
+    self._subscriptions = {}
     self._lock = threading.Lock()
 
   def init(self):
@@ -351,148 +844,276 @@ class TwitcherObject(object):
       Nothing.
     """
     logging.debug('Initializing %s', self._description)
-    self._register_watch(handler=self._run_on_load)
+    self._register_watch(handler=bool(self._run_on_load))
 
-  def get_fds(self):
-    """Returns a list of all file descriptors of subprocesses.
+  def close(self):
+    """Called when this object is unloaded.
 
-    This is used for select() calls. It should return a list of all child
-    process file descriptors as a tuple ([r1, r2], [w1, w1]).
+    Stops any persistent worker, forgets runs that haven't started yet and
+    releases this object's watches. Later notifications for this object are
+    ignored. Processes that are already running are left to finish.
 
     Returns:
-      A 2 element tuple containing a list of read file descriptors, and
-      write file descriptors.
+      Nothing.
     """
-    r_fds = []
-    w_fds = []
-    self._lock.acquire()
-    for p in self._processes:
-      if p.stdin is not None:
-        w_fds.append(p.stdin)
-    self._lock.release()
-    return (r_fds, w_fds)
-
-  def next_timeout(self):
-    """Returns the number of seconds until the next timeout.
+    logging.debug('Closing %s', self._description)
+    self._closed = True
+    for timer in (self._debounce_timer, self._splay_timer):
+      if timer is not None:
+        timer.cancel()
+    self._debounce_timer = None
+    self._splay_timer = None
+    for deferral in self._deferrals:
+      default_admission.cancel(deferral)
+    self._deferrals = []
+    for lease in self._leases:
+      lease.release()
+    self._leases = []
+    for job in self._jobs:
+      default_scheduler.cancel(job)
+    self._jobs = []
+    self._unhandled_watch = None
+    if self._batch is not None:
+      self._batch.clear()
+    if self._worker is not None:
+      self._worker.stop()
+    if self._splay is not None:
+      self._splay.close()
+    for subscription in self._subscriptions.itervalues():
+      subscription.release()
+    self._subscriptions = {}
+
+  def _subscription(self, path, watch_type=WATCH_DATA):
+    """Returns this object's zkwrapper.Subscription for a znode."""
+    subscription = self._subscriptions.get(path)
+    if subscription is None:
+      subscription = default_zkwrapper.subscribe(path, watch_type)
+      self._subscriptions[path] = subscription
+    return subscription
+
+  def _process_exited(self, p, version=None):
+    """Called by the reaper when one of our processes has exited.
 
-    This function will return the next timeout value for all children or
-    sys.maxint if no children are impending timeout.
+    Args:
+      p: The MinimalSubprocess, or threadpool.InProcessRun, that exited.
+      version: The (mzxid, version, digest) of the data it was given, or
+               None.
 
     Returns:
-      The number of seconds until the next child process times out.
+      Nothing.
     """
-    return min([x.timeout() for x in self._processes] + [sys.maxint])
+    logging.warning('Process "%s" (%s) exited with code %s',
+                    p.desc, p.pid, p.returncode)
+    self._lock.acquire()
+    try:
+      self._processes.remove(p)
+    except ValueError:
+      pass
+    self._lock.release()
+    if p.job is not None:
+      default_scheduler.release(p.job)
+    if p.lease is not None:
+      p.lease.release()
+    if default_state is not None and version is not None:
+      default_state.record(self._description, self._path, version[1],
+                           version[2], p.returncode)
+    self._post_exec()
+
+  def _busy(self):
+    """Returns True if a process is running or waiting to be started."""
+    return bool(self._processes or self._jobs or self._leases or
+                self._deferrals)
+
+  def _register_watch(self, handler=True, watch=True):
+    """Called to actually register a watch (and perform a get if needed.)
 
-  def timeout(self):
-    """Called when select times out.
+    This function will wrap the zookeeper calls in order to make it easy to
+    register a watch and fetch data regardless of the options we have
+    been configured with.
 
-    This function is called when select() times out. Select will timeout
-    based on the next lowest value of all the returned values from
-    next_timeout(). It is expected that this function will look for timed out
-    processes and start the process of killing them off.
+    Args:
+      handler: Optional. If true (default) then self._handler will be called
+               when new data is received, otherwise nothing will be called.
+      watch: Optional. If true (default) then self._watch will be called
+             when the znode next changes.
 
     Returns:
       Nothing.
     """
-    # Double check that a child process has not exited cleanly by
-    # pretending that we received a SIGCHLD.
-    self.sigchld()
-    for p in self._processes:
-      if p.timeout() <= 0:
-        p.terminate()
+    if self._closed:
+      return
+    if handler is True:
+      h = self._handler
+    else:
+      h = None
+    if watch:
+      w = self._watch
+    else:
+      w = None
+    default_zkwrapper.aget(self._path, handler=h, watcher=w,
+                           subscription=self._subscription(self._path))
 
-  def sigchld(self):
-    """Called when SIGCHLD is received.
+  def _exec(self, data, version=None):
+    """Starts the registered function as a second process
 
-    This should call poll on all subprocesses in order to find out if they
-    have exited. This is used to clear out child processes that have completed.
+    The default admission controller may first defer the run while the
+    host is under pressure. If the watch uses a cluster wide semaphore then
+    a slot is acquired next. The run is then submitted to the default
+    scheduler which will start it once the daemon wide, per file and per
+    watch limits allow. This shouldn't block on anything.
 
-    This function shouldn't block.
+    Args:
+      data: The data that should be written to stdin on the sub process.
+      version: The (mzxid, version, digest) of the data, or None.
 
     Returns:
       Nothing.
     """
-    removed = []
-    self._lock.acquire()
-    for p in self._processes:
-      r = p.poll()
-      if r is not None:
-        logging.warning('Process "%s" (%s) exited with code %s',
-                        p.desc, p.pid, r)
-        self._processes.remove(p)
-        removed.append(p)
-    self._lock.release()
-    if removed:
-      self._post_exec()
-
-  def select(self, r, w):
-    """Called when a socket is read/writable.
-
-    This should check to see if any of the sockets listed in r and w are
-    attached to any subprocess so we can read/write to them.
+    if self._closed:
+      return
+    if self._worker is not None:
+      self._worker.deliver(data)
+      return
+    if default_admission is None:
+      self._admitted(None, data, version)
+      return
+    deferral = default_admission.admit(
+        self._priority, self._description,
+        lambda deferral: self._admitted(deferral, data, version))
+    if deferral is not None:
+      self._deferrals.append(deferral)
 
-    This function shouldn't block.
+  def _admitted(self, deferral, data, version=None):
+    """Called once the admission controller lets a run go ahead.
 
     Args:
-      r: A list of file descriptors that can be read from.
-      w: A list of file descriptors that can be written too.
+      deferral: The admission.Deferral if the run was deferred, or None.
+      data: The data that should be written to stdin on the sub process.
+      version: The (mzxid, version, digest) of the data, or None.
 
     Returns:
       Nothing.
     """
-    self._lock.acquire()
-    for p in self._processes:
-      if p.stdin in w:
-        p.write_buffer()
-    self._lock.release()
+    if deferral is not None:
+      self._deferrals.remove(deferral)
+    if self._closed:
+      return
+    if self._semaphore is None:
+      self._submit(data, None, version)
+      return
+    logging.info('"%s" is waiting for a cluster semaphore slot.',
+                 self._description)
+    self._leases.append(
+        self._semaphore.acquire(
+            lambda lease: self._granted(lease, data, version)))
 
-  def _register_watch(self, handler=True):
-    """Called to actually register a watch (and perform a get if needed.)
+  def _granted(self, lease, data, version=None):
+    """Called once a slot of the cluster wide semaphore is held."""
+    self._leases.remove(lease)
+    self._submit(data, lease, version)
 
-    This function will wrap the zookeeper calls in order to make it easy to
-    register a watch and fetch data regardless of the options we have
-    been configured with.
+  def _submit(self, data, lease, version=None):
+    """Hands a run to the default scheduler.
 
     Args:
-      handler: Optional. If true (default) then self._handler will be called
-               when new data is received, otherwise nothing will be called.
+      data: The data that should be written to stdin on the sub process.
+      lease: The semaphore.Lease held for the run, or None.
+      version: The (mzxid, version, digest) of the data, or None.
 
     Returns:
       Nothing.
     """
-    if handler is True:
-      h = self._handler
-    else:
-      h = None
-    default_zkwrapper.aget(self._path, handler=h, watcher=self._watch)
-
-  def _exec(self, data):
+    if default_scheduler is None:
+      self._start(None, data, lease, version)
+      return
+    job = scheduler.Job((lambda job: self._start(job, data, lease, version)),
+                        self._description, priority=self._priority,
+                        group=self._group, watch=self,
+                        watch_limit=self._max_concurrent)
+    self._jobs.append(job)
+    default_scheduler.submit(job)
+
+  def _start(self, job, data, lease=None, version=None):
     """Starts the registered function as a second process
 
     This will fork and start the registered function on a second process.
     This shouldn't block on anything. It merely starts then returns.
 
     Args:
+      job: The scheduler.Job that allowed this to start, or None.
       data: The data that should be written to stdin on the sub process.
+      lease: The semaphore.Lease held for this run, or None.
+      version: The (mzxid, version, digest) of the data, or None.
 
     Returns:
       Nothing.
     """
+    if job is not None:
+      self._jobs.remove(job)
+    if self._in_process:
+      self._start_in_process(job, data, lease, version)
+      return
     logging.warning('Executing process: %s' % self._description)
+    started = False
     try:
-      p = MinimalSubprocess(self._description, data, timeout=self._timeout)
-      p.fork_exec(self._run_func, self._uid, self._gid)
+      output = None
+      if self._capture_output and default_reactor is not None:
+        output = capture.OutputCapture(self._description,
+                                       self._capture_limiter,
+                                       self._capture_buffer_size,
+                                       default_reactor)
+      p = MinimalSubprocess(self._description, data, timeout=self._timeout,
+                            on_exit=(lambda p:
+                                     self._process_exited(p, version)),
+                            stdin_mode=self._stdin_mode, capture=output,
+                            job=job, lease=lease, resources=self._resources,
+                            kill_grace=self._kill_grace,
+                            env=self._environment(version))
+      p.start(self._run_func, self._uid, self._gid)
       self._lock.acquire()
       self._processes.append(p)
       self._lock.release()
-      if default_ping_fd is not None:
-        os.write(default_ping_fd, '\0')
+      started = True
     except UnknownUserError:
       logging.error('%s: Unable to find user %s', self._description,
                     self._uid)
     except UnknownGroupError:
       logging.error('%s: Unable to find group %s', self._description,
                     self._gid)
+    except OSError:
+      # MinimalSubprocess has already logged the failure.
+      pass
+    if not started:
+      if job is not None:
+        default_scheduler.release(job)
+      if lease is not None:
+        lease.release()
+      self._post_exec()
+
+  def _start_in_process(self, job, data, lease, version=None):
+    """Runs the registered function on the default thread pool.
+
+    Args:
+      job: The scheduler.Job that allowed this to start, or None.
+      data: The data the function is called with.
+      lease: The semaphore.Lease held for this run, or None.
+      version: The (mzxid, version, digest) of the data, or None.
+
+    Returns:
+      Nothing.
+    """
+    logging.info('Running in process: %s', self._description)
+    if isinstance(data, payload.Payload):
+      data = data.data
+    run = threadpool.InProcessRun(self._description, self._run_func, data,
+                                  timeout=self._timeout,
+                                  on_exit=(lambda p:
+                                           self._process_exited(p, version)),
+                                  job=job, lease=lease)
+    self._lock.acquire()
+    self._processes.append(run)
+    self._lock.release()
+    default_thread_pool.submit(run)
 
   def _post_exec(self):
     """Run once the script has finished executing.
@@ -507,12 +1128,17 @@ class TwitcherObject(object):
     Returns:
       Nothing.
     """
+    if self._batch is not None:
+      if self._batch and not self._busy():
+        self._exec(self._batch.take())
+      return
     if self._unhandled_watch:
       if self._run_mode == DISCARD:
         # If we are in discard mode we simply discard the data we will
         # get back from zookeeper.
+        self._unhandled_watch = None
         self._register_watch(handler=False)
-      elif self._run_mode == QUEUE:
+      elif self._run_mode == QUEUE or self._run_mode == RESTART:
         # Re run the watch that we missed as though we just received it. We do
         # this by passing the arguments back into the mix.
         logging.debug('Processing queued watches on %s',
@@ -525,6 +1151,7 @@ class TwitcherObject(object):
         # FIXME(brady):
         logging.error('_run_mode is invalid in %s' % self)
 
+  @_from_zookeeper
   def _watch(self, zh, path):
     """Called when a zookeeper node we are watching updates.
 
@@ -544,25 +1171,135 @@ class TwitcherObject(object):
       Nothing.
     """
     logging.info('Received watch notification for %s', path)
-    if self._processes and self._run_mode != PARALLEL:
+    if self._closed:
+      return
+    if self._batch is not None and self._busy():
+      # Fetch this version now so that it is kept for the next run.
+      self._register_watch()
+      return
+    if self._busy() and self._run_mode != PARALLEL:
       logging.warning('Postponing processing of "%s" '
                       '(a script is already running).', self._description)
       self._unhandled_watch = (zh, path)
       if self._notify_signal is not None:
         for i in self._processes:
           i.signal(self._notify_signal)
+      if self._run_mode == RESTART:
+        self._restart()
+      return
+    if self._splay_timer is not None:
+      # The splayed run will fetch the latest data; just keep watching.
+      self._register_watch(handler=False)
+      return
+    if self._quiet_period is not None or self._max_delay is not None:
+      self._debounce()
+      return
+    if self._splay is not None:
+      self._register_watch(handler=False)
+      self._start_splay()
       return
     self._register_watch()
     if not self._pipe_stdin:
       # We don't need to wait for the data to arrive to execute in this mode
       self._exec('')
 
+  def _restart(self):
+    """Terminates the running processes so the latest data runs sooner.
+
+    The pending notification is kept in _unhandled_watch, so however many
+    times the watch fires only one new run happens once they have exited.
+    Processes that have already been asked to stop are left alone so that
+    repeated notifications don't skip the grace period.
+
+    Returns:
+      Nothing.
+    """
+    # The interrupted run didn't finish, so its data must run again even if
+    # it turns out to be unchanged.
+    self._last_digest = None
+    for p in self._processes:
+      if not p.sigterm_sent:
+        p.terminate('restarting with newer data')
+
+  def _debounce(self):
+    """Collects a notification until the watch has been quiet for a while.
+
+    The watch is re-armed straight away, without fetching the data, so that
+    further notifications keep pushing the run back. The run happens
+    quiet_period seconds after the last notification, but never more than
+    max_delay seconds after the first one.
+
+    Returns:
+      Nothing.
+    """
+    self._register_watch(handler=False)
+    now = time.time()
+    if self._debounce_deadline is None and self._max_delay is not None:
+      self._debounce_deadline = now + self._max_delay
+    if self._quiet_period is not None:
+      fire_at = now + self._quiet_period
+      if self._debounce_deadline is not None:
+        fire_at = min(fire_at, self._debounce_deadline)
+    else:
+      fire_at = self._debounce_deadline
+    if self._debounce_timer is not None:
+      self._debounce_timer.cancel()
+    self._debounce_timer = default_reactor.call_at(fire_at,
+                                                   self._debounce_expired)
+
+  def _debounce_expired(self):
+    """Runs the action for the notifications collected by _debounce()."""
+    logging.info('Processing collected notifications for %s', self._path)
+    self._debounce_timer = None
+    self._debounce_deadline = None
+    if self._splay is not None:
+      self._start_splay()
+    else:
+      self._run_collected()
+
+  def _start_splay(self):
+    """Waits for this host's splay offset before running the action."""
+    offset = self._splay.offset()
+    if offset <= 0:
+      self._run_collected()
+      return
+    logging.info('Delaying "%s" by %.1f seconds (splay).', self._description,
+                 offset)
+    self._splay_timer = default_reactor.call_later(offset,
+                                                   self._splay_expired)
+
+  def _splay_expired(self):
+    """Called once this host's splay offset has passed."""
+    self._splay_timer = None
+    self._run_collected()
+
+  def _run_collected(self):
+    """Runs the action for notifications collected while waiting.
+
+    The watch is already armed when this is called, so only the latest
+    data is fetched.
+
+    Returns:
+      Nothing.
+    """
+    if (self._busy() and self._run_mode != PARALLEL and
+        self._batch is None):
+      # A run started while we were waiting; treat this like any other
+      # notification received while busy.
+      self._unhandled_watch = (default_zkwrapper, self._path)
+      return
+    if self._pipe_stdin:
+      self._register_watch(watch=False)
+    else:
+      self._exec('')
+
   def _handler(self, zh, rc, data, path):
     """Called with the data after an aget() request.
 
-    This function is called by the ZKWrapper object once the data for a
-    znode has been fetched. In all cases we should exec the script unless
-    something has gone wrong.
+    This function is called by the ZKWrapper object, on the zookeeper
+    thread, once the data for a znode has been fetched. The version of the
+    data is read straight away, while it still matches, and the rest
+    happens in _received() on the reactor thread.
 
     Args:
       zh: The ZKWrapper object that is calling us.
@@ -573,15 +1310,77 @@ class TwitcherObject(object):
     Returns:
       Nothing.
     """
+    version = None
     if rc == zookeeper.OK:
-      self._exec(data)
-    else:
+      version = zh.version(path)
+    self._received(rc, data, path, version)
+
+  @_from_zookeeper
+  def _received(self, rc, data, path, version):
+    """Called with the data of the znode on the reactor thread.
+
+    In all cases we should exec the script unless something has gone
+    wrong, skip_unchanged is set and the contents are the same as they
+    were for the last run, or this is the data fetched on load with
+    run_on_load='if_changed' and the state file shows that the last run
+    before restarting had the same data and succeeded.
+
+    Args:
+      rc: The return code from zookeeper.
+      data: The contents of the znode.
+      path: The znode that updated.
+      version: The (mzxid, version, digest) of the data, or None.
+
+    Returns:
+      Nothing.
+    """
+    if rc != zookeeper.OK:
       # Failure!
       # FIXME(brady)
       return
-  
+    if self._closed:
+      return
+    if self._batch is not None:
+      stat_version = -1
+      if version is not None and version[1] is not None:
+        stat_version = version[1]
+      self._batch.add(stat_version, data)
+      if not self._busy():
+        self._exec(self._batch.take())
+      return
+    if version is not None:
+      digest = version[2]
+      if self._skip_unchanged and digest == self._last_digest:
+        logging.info('Not running "%s": %s is unchanged.', self._description,
+                     path)
+        stats.increment('dedupe.skipped')
+        return
+      if (self._check_state and default_state is not None and
+          default_state.unchanged(self._description, self._path, digest)):
+        logging.info('Not running "%s": %s is unchanged since the last run '
+                     'before restarting.', self._description, path)
+        self._check_state = False
+        self._last_digest = digest
+        stats.increment('state.skipped')
+        return
+      self._last_digest = digest
+    self._check_state = False
+    self._exec(data, version)
+
+  def _environment(self, version):
+    """Returns the environment variables describing a version, or None."""
+    if version is None:
+      return None
+    mzxid, stat_version, _ = version
+    env = {'TWITCHER_ZNODE': self._path}
+    if mzxid is not None:
+      env['TWITCHER_MZXID'] = str(mzxid)
+    if stat_version is not None:
+      env['TWITCHER_VERSION'] = str(stat_version)
+    return env
+
 class TwitcherChildrenObject(TwitcherObject):
-  def _register_watch(self, handler=True):
+  def _register_watch(self, handler=True, watch=True):
     """Called to actually register a watch (and perform a get_children if needed.)
 
     This function will wrap the zookeeper calls in order to make it easy to
@@ -591,15 +1390,141 @@ class TwitcherChildrenObject(TwitcherObject):
     Args:
       handler: Optional. If true (default) then self._handler will be called
                when new data is received, otherwise nothing will be called.
+      watch: Optional. If true (default) then self._watch will be called
+             when the child nodes next change.
 
     Returns:
       Nothing.
     """
+    if self._closed:
+      return
     if handler is True:
       h = self._handler
     else:
       h = None
-    default_zkwrapper.aget_children(self._path, handler=h, watcher=self._watch)
+    if watch:
+      w = self._watch
+    else:
+      w = None
+    subscription = self._subscription(self._path, WATCH_CHILDREN)
+    default_zkwrapper.aget_children(self._path, handler=h, watcher=w,
+                                    subscription=subscription)
+
+  def _handler(self, zh, rc, children, path):
+    """Called with the children after an aget_children() request.
+
+    Children have no stat, so only a digest of the list identifies them.
+    """
+    version = None
+    if rc == zookeeper.OK:
+      version = (None, None,
+                 hashlib.sha1('\n'.join(sorted(children))).hexdigest())
+    self._received(rc, children, path, version)
     
-  def _exec(self, data):
-      super(TwitcherChildrenObject, self)._exec("\n".join(data))
\ No newline at end of file
+  def _exec(self, data, version=None):
+      super(TwitcherChildrenObject, self)._exec("\n".join(data), version)
+
+
+class TwitcherGroupObject(TwitcherObject):
+  """Runs one action for changes to any znode in a group.
+
+  Every znode in the group is watched. A notification on any of them
+  goes through the normal run_mode, debounce and splay handling, but for
+  the group as a whole: the run that follows is given every znode that
+  changed since the last run, with its current data, on stdin (see
+  batch.encode_paths). Notifications received while the action runs are
+  queued or discarded for the group.
+
+  Args:
+    paths: The list of znodes in the group.
+    run_func: The function that should be run in the subprocess.
+    group_format: batch.LENGTH_PREFIXED or batch.JSON_LINES.
+    Any other TwitcherObject argument.
+  """
+  def __init__(self, paths, run_func, group_format=batch.LENGTH_PREFIXED,
+               **kwargs):
+    TwitcherObject.__init__(self, paths[0], run_func, **kwargs)
+    self._paths = list(paths)
+    self._group_format = group_format
+    # Znodes with a watch registered, and those changed since the last run.
+    self._armed = set()
+    self._dirty = set()
+    if self._run_on_load:
+      self._dirty.update(self._paths)
+    # While data is being fetched, the results so far and the number of
+    # znodes still outstanding.
+    self._fetched = None
+    self._outstanding = 0
+
+  def _busy(self):
+    """Returns True if a run is in progress, including fetching its data."""
+    return (TwitcherObject._busy(self) or self._fetched is not None)
+
+  def _register_watch(self, handler=True, watch=True):
+    """Registers watches and fetches the data of the changed znodes.
+
+    Args:
+      handler: Optional. If true (default) then the data of every znode
+               changed since the last run is fetched and the action run.
+      watch: Optional. If true (default) then every znode without a watch
+             gets one.
+
+    Returns:
+      Nothing.
+    """
+    if self._closed:
+      return
+    fetch = set()
+    if handler is True and self._fetched is None and self._dirty:
+      fetch = self._dirty
+      self._dirty = set()
+      self._fetched = {}
+      self._outstanding = len(fetch)
+    for path in self._paths:
+      w = None
+      if watch and path not in self._armed:
+        self._armed.add(path)
+        w = self._watch
+      h = None
+      if path in fetch:
+        h = self._group_handler
+      if w is not None or h is not None:
+        default_zkwrapper.aget(path, handler=h, watcher=w,
+                               subscription=self._subscription(path))
+
+  @_from_zookeeper
+  def _watch(self, zh, path):
+    """Notes which znode changed, then handles the notification."""
+    self._armed.discard(path)
+    self._dirty.add(path)
+    TwitcherObject._watch(self, zh, path)
+
+  @_from_zookeeper
+  def _group_handler(self, zh, rc, data, path):
+    """Collects the data of one changed znode and runs once all arrived."""
+    if self._fetched is None:
+      return
+    if rc == zookeeper.OK:
+      self._fetched[path] = data or ''
+    else:
+      logging.error('Unable to fetch %s for "%s": %s', path,
+                    self._description, rc)
+    self._outstanding -= 1
+    if self._outstanding > 0:
+      return
+    fetched = self._fetched
+    self._fetched = None
+    if self._closed:
+      return
+    if not fetched:
+      self._post_exec()
+      return
+    logging.info('"%s": %d znodes changed', self._description, len(fetched))
+    self._exec(batch.encode_paths(sorted(fetched.items()),
+                                  self._group_format))
+
+  def _post_exec(self):
+    """Forgets changed znodes as well when discarding."""
+    if self._unhandled_watch and self._run_mode == DISCARD:
+      self._dirty.clear()
+    TwitcherObject._post_exec(self)
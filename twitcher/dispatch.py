@@ -0,0 +1,205 @@
+#!/usr/bin/python26
+
+"""Limits the number of zookeeper requests outstanding at once.
+
+The zookeeper client sends every asynchronous request as soon as it is
+made. Starting thousands of run_on_load watches at once therefore puts
+thousands of requests on the wire together, and a server that falls behind
+drops the connection, failing all of them. Every request ZKWrapper makes
+goes through a RequestDispatcher instead. At most max_outstanding requests
+are sent at a time and the rest wait in order. Requests that register a
+watch go ahead of plain reads, since a watch that isn't registered misses
+changes.
+
+A request that fails with CONNECTIONLOSS is sent again after a delay that
+doubles each time, and keeps its place among the outstanding requests while
+it waits. After max_retries attempts the failure is handed to the caller.
+Creates aren't retried, since one that succeeded just before the
+connection dropped would be made twice. A request the client refuses to
+send is completed with CONNECTIONLOSS straight away.
+The number of waiting and outstanding requests, the time spent waiting and
+the latency of each attempt are recorded in the stats module.
+"""
+
+import collections
+import logging
+import threading
+import time
+import zookeeper
+
+# twitcher modules
+import stats
+
+
+# The most requests outstanding at once when no limit is given.
+DEFAULT_MAX_OUTSTANDING = 128
+
+# The delay before the first retry, doubled for each retry after that.
+RETRY_BASE = 0.1
+
+# The longest delay between retries.
+RETRY_MAX = 10.0
+
+# The number of times a request is retried before the failure is returned.
+DEFAULT_MAX_RETRIES = 6
+
+
+class _Request(object):
+  """A request waiting to be sent, or outstanding."""
+  def __init__(self, call, completion, error_args, retry):
+    self.call = call
+    self.completion = completion
+    self.error_args = error_args
+    self.retry = retry
+    self.queued = time.time()
+    self.sent = None
+    self.attempts = 0
+
+
+class RequestDispatcher(object):
+  """Sends zookeeper requests, at most max_outstanding at a time.
+
+  Requests may be made from any thread. Completions are called on the
+  zookeeper completion thread, or on the thread that made or retried the
+  request if the client refused to send it.
+
+  Args:
+    reactor_obj: The reactor retries are scheduled on.
+    max_outstanding: The most requests outstanding at once.
+    max_retries: The number of times a request failing with CONNECTIONLOSS
+                 is sent again.
+  """
+  def __init__(self, reactor_obj, max_outstanding=DEFAULT_MAX_OUTSTANDING,
+               max_retries=DEFAULT_MAX_RETRIES):
+    self._reactor = reactor_obj
+    self._max_outstanding = max_outstanding
+    self._max_retries = max_retries
+    self._lock = threading.Lock()
+    self._watches = collections.deque()
+    self._reads = collections.deque()
+    self._outstanding = 0
+    self._pumping = False
+    self._repump = False
+    stats.set_gauge('zkwrapper.queued',
+                    lambda: len(self._watches) + len(self._reads))
+    stats.set_gauge('zkwrapper.outstanding', lambda: self._outstanding)
+
+  def send(self, call, completion=None, error_args=(), watch=False,
+           retry=True):
+    """Queues a request.
+
+    Args:
+      call: Sends the request. Called with the completion function to give
+            the zookeeper client, which takes (zh, rc, ...).
+      completion: Called with the zookeeper completion arguments once the
+                  request is done, or None.
+      error_args: The arguments after rc given to completion when the
+                  request couldn't be sent, e.g. (None, None) for aget.
+      watch: If True then the request registers a watch and is sent ahead
+             of requests that don't.
+      retry: If False then CONNECTIONLOSS is returned rather than retried.
+
+    Returns:
+      Nothing.
+    """
+    request = _Request(call, completion, error_args, retry)
+    stats.increment('zkwrapper.requests')
+    self._lock.acquire()
+    if watch:
+      self._watches.append(request)
+    else:
+      self._reads.append(request)
+    self._lock.release()
+    self._pump()
+
+  def _pump(self):
+    """Sends waiting requests while there is room for them.
+
+    Only one call sends at a time. A call made while another is sending, for
+    example by a request that couldn't be sent freeing its slot, has the
+    sending call look at the queue again, so a long run of failures loops
+    here rather than recursing.
+    """
+    self._lock.acquire()
+    if self._pumping:
+      self._repump = True
+      self._lock.release()
+      return
+    self._pumping = True
+    self._repump = True
+    try:
+      while self._repump:
+        self._repump = False
+        start = []
+        while self._outstanding < self._max_outstanding:
+          if self._watches:
+            request = self._watches.popleft()
+          elif self._reads:
+            request = self._reads.popleft()
+          else:
+            break
+          self._outstanding += 1
+          start.append(request)
+        self._lock.release()
+        try:
+          for request in start:
+            stats.record('zkwrapper.queue_time', time.time() - request.queued)
+            self._send(request)
+        finally:
+          self._lock.acquire()
+    finally:
+      self._pumping = False
+      self._lock.release()
+
+  def _send(self, request):
+    """Makes one attempt at an outstanding request."""
+    request.attempts += 1
+    request.sent = time.time()
+    try:
+      request.call(lambda zh, rc, *args:
+                   self._completed(request, zh, rc, *args))
+      return
+    except Exception, e:
+      # The request never reached the client's queue, so nothing else will
+      # complete it. CONNECTIONLOSS sends the caller down the same path as
+      # a request lost with the connection.
+      logging.error('Unable to send a zookeeper request: %r', e)
+      stats.increment('zkwrapper.failures')
+    self._finish(request, None, zookeeper.CONNECTIONLOSS, *request.error_args)
+
+  def _completed(self, request, zh, rc, *args):
+    """Called by the zookeeper client once an attempt completes."""
+    stats.record('zkwrapper.latency', time.time() - request.sent)
+    if rc == zookeeper.CONNECTIONLOSS and self._retry(request):
+      return
+    self._finish(request, zh, rc, *args)
+
+  def _retry(self, request):
+    """Sends a request again after a backoff delay, if it may be retried.
+
+    Returns:
+      True if the request will be retried.
+    """
+    if not request.retry:
+      return False
+    if request.attempts > self._max_retries:
+      stats.increment('zkwrapper.failures')
+      return False
+    delay = min(RETRY_MAX, RETRY_BASE * (2 ** (request.attempts - 1)))
+    stats.increment('zkwrapper.retries')
+    self._reactor.call_later(delay, self._send, request)
+    return True
+
+  def _finish(self, request, zh, rc, *args):
+    """Completes a request and frees its slot for the next one."""
+    try:
+      if request.completion is not None:
+        request.completion(zh, rc, *args)
+    except Exception:
+      logging.exception('Unhandled exception in zookeeper completion %r',
+                        request.completion)
+    finally:
+      self._lock.acquire()
+      self._outstanding -= 1
+      self._lock.release()
+      self._pump()
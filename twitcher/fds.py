@@ -0,0 +1,102 @@
+#!/usr/bin/python26
+
+"""File descriptor hygiene for child processes.
+
+Children must not inherit the daemon's file descriptors: the signal pipe,
+inotify directory handles, the zookeeper socket and the stdin pipes of every
+other child. Closing every descriptor up to RLIMIT_NOFILE makes a child issue
+up to a million failing close() calls before it can run its action, so this
+module closes only what is actually open:
+
+  1. close_range(2) closes the whole range with a single syscall.
+  2. Otherwise /proc/self/fd is listed and only open descriptors are closed.
+  3. Otherwise nothing is closed and we rely on the daemon having marked its
+     own descriptors close-on-exec with set_cloexec().
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+
+
+# close_range() was added after the syscall tables were unified so it has the
+# same number on every architecture Linux supports.
+_NR_CLOSE_RANGE = 436
+_MAX_FD = 0xffffffff
+
+
+def _load_libc():
+  """Returns the C library, or None if it can't be loaded."""
+  try:
+    return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+  except OSError:
+    return None
+
+
+_libc = _load_libc()
+
+# Set to False the first time close_range() is found to be unsupported.
+_close_range_supported = _libc is not None
+
+
+def set_cloexec(fd):
+  """Marks a file descriptor as close-on-exec."""
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def open_fds(low=3):
+  """Returns the file descriptors open in this process at or above low.
+
+  Returns:
+    A list of file descriptors, or None if /proc is not available.
+  """
+  try:
+    names = os.listdir('/proc/self/fd')
+  except OSError:
+    return None
+  return [fd for fd in (int(n) for n in names) if fd >= low]
+
+
+def close_range(low):
+  """Closes every descriptor from low upwards with close_range(2).
+
+  Returns:
+    True if the syscall succeeded, False if it is not supported.
+  """
+  global _close_range_supported
+  if not _close_range_supported:
+    return False
+  rc = _libc.syscall(ctypes.c_long(_NR_CLOSE_RANGE), ctypes.c_uint(low),
+                     ctypes.c_uint(_MAX_FD), ctypes.c_uint(0))
+  if rc == 0:
+    return True
+  _close_range_supported = False
+  return False
+
+
+def close_fds_from(low):
+  """Closes every open file descriptor at or above low.
+
+  This is intended to be called in a freshly forked child. It doesn't
+  raise if a descriptor can't be closed.
+
+  Args:
+    low: The lowest file descriptor to close.
+
+  Returns:
+    The name of the method that was used.
+  """
+  if close_range(low):
+    return 'close_range'
+  fds = open_fds(low)
+  if fds is not None:
+    for fd in fds:
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+    return 'proc'
+  return 'cloexec'
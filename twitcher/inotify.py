@@ -6,10 +6,10 @@ The classes in this module  will watch a list of subdirectories for file
 updates. A class is passed in at object initialization time and is used to
 create objects as new files are discovered. If a file is updated then the
 reload() function on that class will be called. If the file is removed the
-class will be deleted.
+unload() function will be called and the object will be deleted.
 
-It is important to verify that __init__, __del__, and reload() are all
-defined properly.
+It is important to verify that __init__, __del__, reload() and unload() are
+all defined properly.
 
 A simple example of this module use looks like this:
     class watcher(object):
@@ -20,6 +20,8 @@ A simple example of this module use looks like this:
         print 'Del: %s' % self._filename
       def reload(self):
         print 'reload: %s' % self._filename
+      def unload(self):
+        print 'unload: %s' % self._filename
 
     x = inotify.InotifyWatcher(['/tmp/bar'], watcher)
 
@@ -52,6 +54,10 @@ class WatchClass(object):
     """Called when the file is updated on disk."""
     pass
 
+  def unload(self):
+    """Called when the file has been removed from disk."""
+    pass
+
 
 class InotifyWatcher(object):
   """Watches a list of directories for updates to the files in them.
@@ -66,6 +72,10 @@ class InotifyWatcher(object):
                   footprint takes a single parameter (the filename) and returns
                   True/False if it should be watched or not. If this is not
                   given then all files will be watched.
+
+  SIGIO and SIGHUP only mark a rescan as needed, since reloading takes locks
+  the interrupted code may hold. The main loop must call rescan_if_needed()
+  after every signal.
   """
   def __init__(self, watch_directories, watch_class, file_pattern=None):
     if file_pattern is None:
@@ -75,6 +85,7 @@ class InotifyWatcher(object):
     self._file_pattern = file_pattern
     self._watch_fds = {}
     self._watch_files = {}
+    self._rescan_needed = False
     signal.signal(signal.SIGIO, self._inotify)
     signal.signal(signal.SIGHUP, self._inotify)
     self.rescan()
@@ -105,6 +116,7 @@ class InotifyWatcher(object):
     logging.info('Registering a inotify watch on %s' % dir)
     try:
       fd = os.open(dir, os.O_RDONLY)
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
       fcntl.fcntl(fd, fcntl.F_NOTIFY, WATCH_MASK)
       self._watch_fds[dir] = fd
     except IOError, e:
@@ -122,7 +134,13 @@ class InotifyWatcher(object):
     logging.info('Received SIGHUP or a file update notification.')
     signal.signal(signal.SIGIO, self._inotify)
     signal.signal(signal.SIGHUP, self._inotify)
-    self.rescan()
+    self._rescan_needed = True
+
+  def rescan_if_needed(self):
+    """Rescans if a signal asked for it since the last call."""
+    if self._rescan_needed:
+      self._rescan_needed = False
+      self.rescan()
 
   def _mtime(self, filename):
     """Returns the mtime of the given file (in seconds)."""
@@ -167,7 +185,7 @@ class InotifyWatcher(object):
     # Walk through all files that no longer exist.
     for file in set(self._watch_files).difference(new_files):
       logging.info('File deleted (%s): Removing its object.', file)
-      del self._watch_files[file]
+      self._watch_files.pop(file)[1].unload()
 
     for file in new_files:
       if file not in self._watch_files:
@@ -0,0 +1,145 @@
+#!/usr/bin/python26
+
+"""Shared, immutable stdin payloads for child processes.
+
+Every watch of a znode receives the same data object from ZKWrapper when a
+new version is fetched. for_data() wraps that object in a single Payload so
+all the children started for that version share one buffer. Children that
+are fed through a pipe each keep an offset into a memoryview of the payload
+rather than slicing off a fresh copy of the remainder after every write.
+
+A payload can also be copied once into a sealed memfd (or an unlinked
+temporary file where memfd_create() doesn't exist). Each child then gets its
+own read only descriptor of that file as stdin and the main loop doesn't
+have to pump any data at all.
+"""
+
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+
+# twitcher modules
+import fds
+
+
+# Constants from linux/memfd.h and linux/fcntl.h.
+MFD_CLOEXEC = 0x1
+MFD_ALLOW_SEALING = 0x2
+F_ADD_SEALS = 1033
+F_SEAL_SEAL = 0x1
+F_SEAL_SHRINK = 0x2
+F_SEAL_GROW = 0x4
+F_SEAL_WRITE = 0x8
+
+# The number of recent payloads kept by for_data().
+_CACHE_SIZE = 16
+
+
+_memfd_create = getattr(fds._libc, 'memfd_create', None)
+
+
+class Payload(object):
+  """An immutable block of data delivered to one or more children.
+
+  Args:
+    data: The string to deliver.
+  """
+  def __init__(self, data):
+    self.data = data
+    self.view = memoryview(data)
+    self._fd = None
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.data)
+
+  def __del__(self):
+    if self._fd is not None:
+      try:
+        os.close(self._fd)
+      except OSError:
+        pass
+
+  def _create_file(self):
+    """Returns a close-on-exec descriptor for a file holding the data."""
+    if _memfd_create is not None:
+      fd = _memfd_create('twitcher-stdin', MFD_CLOEXEC | MFD_ALLOW_SEALING)
+      if fd >= 0:
+        self._write_all(fd)
+        try:
+          fcntl.fcntl(fd, F_ADD_SEALS, F_SEAL_SEAL | F_SEAL_SHRINK |
+                      F_SEAL_GROW | F_SEAL_WRITE)
+        except IOError, e:
+          logging.debug('Unable to seal stdin memfd: %s', e)
+        return fd
+    f = tempfile.TemporaryFile(prefix='twitcher-stdin')
+    fd = os.dup(f.fileno())
+    f.close()
+    fds.set_cloexec(fd)
+    self._write_all(fd)
+    return fd
+
+  def _write_all(self, fd):
+    """Writes the whole payload into fd."""
+    offset = 0
+    while offset < len(self.data):
+      offset += os.write(fd, self.view[offset:])
+
+  def open_stdin(self):
+    """Returns a new read only descriptor positioned at the start of the data.
+
+    The file backing the payload is created on first use and shared by every
+    caller. Each call returns a separate open file so children don't share
+    a file offset. The caller owns the returned descriptor.
+
+    Returns:
+      A close-on-exec file descriptor.
+    """
+    self._lock.acquire()
+    try:
+      if self._fd is None:
+        self._fd = self._create_file()
+    finally:
+      self._lock.release()
+    try:
+      fd = os.open('/proc/self/fd/%d' % self._fd, os.O_RDONLY)
+    except OSError:
+      # Without /proc the children share an offset, which is only safe if
+      # they don't run concurrently.
+      fd = os.dup(self._fd)
+      os.lseek(fd, 0, os.SEEK_SET)
+    fds.set_cloexec(fd)
+    return fd
+
+
+_cache_lock = threading.Lock()
+_cache = []
+
+
+def for_data(data):
+  """Returns the shared Payload for a data object.
+
+  Watches of the same znode are handed the same string object for a given
+  version, so the identity of the object is enough to find its payload.
+
+  Args:
+    data: The string that should be delivered, or a Payload.
+
+  Returns:
+    A Payload object.
+  """
+  if isinstance(data, Payload):
+    return data
+  _cache_lock.acquire()
+  try:
+    for p in _cache:
+      if p.data is data:
+        return p
+    p = Payload(data)
+    _cache.insert(0, p)
+    del _cache[_CACHE_SIZE:]
+    return p
+  finally:
+    _cache_lock.release()
@@ -0,0 +1,323 @@
+#!/usr/bin/python26
+
+"""An epoll based event loop for twitcher.
+
+The Reactor object in this module replaces the select() loop that used to
+live in twitcher.py. Rather than rebuilding lists of file descriptors on every
+pass of the main loop, file descriptors are registered once when they are
+created and unregistered when they are closed. Each wakeup only costs as much
+as the number of descriptors that are actually ready.
+
+The reactor also owns a heap of timers. Process timeouts and other deadlines
+are registered with call_later() so each pass of the loop only has to peek at
+the earliest deadline rather than asking every watch for its next timeout.
+
+The reactor is also the place that work is handed to when it must run on the
+main loop. The zookeeper module calls back into twitcher from its own thread,
+so call_soon() allows those callbacks to be moved onto the main thread where
+forking and the rest of the state machines are single threaded.
+"""
+
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+# twitcher modules
+import fds
+
+
+# Event masks accepted by Reactor.register().
+READ = select.EPOLLIN
+WRITE = select.EPOLLOUT
+ERROR = select.EPOLLERR | select.EPOLLHUP
+
+
+def set_nonblocking(fd):
+  """Sets O_NONBLOCK on the given file descriptor."""
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+  """A handle for a function scheduled with Reactor.call_later().
+
+  Args:
+    when: The time (in seconds since the epoch) the timer should fire.
+    func: The function to call.
+    args: The arguments to pass to func.
+  """
+  def __init__(self, when, func, args):
+    self.when = when
+    self.func = func
+    self.args = args
+    self.cancelled = False
+    self._reactor = None
+
+  def cancel(self):
+    """Prevents the timer from firing. Safe to call more than once."""
+    if not self.cancelled:
+      self.cancelled = True
+      if self._reactor is not None:
+        self._reactor._timer_cancelled()
+
+
+class Reactor(object):
+  """Dispatches file descriptor events to registered callbacks.
+
+  Callbacks registered against a file descriptor are called with the
+  footprint:
+    func(fd, events)
+  where events is a mask of READ, WRITE and ERROR.
+
+  All public functions are safe to call from any thread. Callbacks are only
+  ever run from the thread calling poll().
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._epoll = select.epoll()
+    self._callbacks = {}
+    self._pending_calls = []
+    self._timers = []
+    self._timer_sequence = itertools.count()
+    self._cancelled_timers = 0
+    self._thread = None
+    self._waker = os.pipe()
+    for fd in self._waker:
+      set_nonblocking(fd)
+      fds.set_cloexec(fd)
+    self.register(self._waker[0], READ, self._drain_waker)
+
+  def register(self, fd, events, callback):
+    """Starts watching a file descriptor.
+
+    Args:
+      fd: The file descriptor to watch.
+      events: A mask of READ and WRITE.
+      callback: The function called when the descriptor is ready.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    try:
+      self._callbacks[fd] = callback
+      self._epoll.register(fd, events | ERROR)
+    finally:
+      self._lock.release()
+
+  def modify(self, fd, events):
+    """Changes the events watched on an already registered descriptor."""
+    self._epoll.modify(fd, events | ERROR)
+
+  def unregister(self, fd):
+    """Stops watching a file descriptor.
+
+    This must be called before the descriptor is closed. Forked children may
+    still hold a copy of the descriptor, in which case epoll would continue
+    to report events for it after the close.
+
+    Args:
+      fd: The file descriptor to stop watching.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    try:
+      if self._callbacks.pop(fd, None) is not None:
+        try:
+          self._epoll.unregister(fd)
+        except (IOError, OSError):
+          pass
+    finally:
+      self._lock.release()
+
+  def wakeup_fd(self):
+    """Returns the write end of the wakeup pipe.
+
+    This is suitable for signal.set_wakeup_fd() so that signals interrupt
+    poll().
+    """
+    return self._waker[1]
+
+  def wakeup(self):
+    """Causes a blocked poll() call to return early."""
+    try:
+      os.write(self._waker[1], '\0')
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _drain_waker(self, fd, events):
+    """Empties the wakeup pipe."""
+    try:
+      while os.read(fd, 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def in_reactor_thread(self):
+    """Returns True if called from the thread running poll()."""
+    return self._thread == threading.current_thread()
+
+  def call_soon(self, func, *args):
+    """Queues a function to be called from the reactor thread.
+
+    Args:
+      func: The function to call.
+      args: The arguments to pass to func.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    self._pending_calls.append((func, args))
+    self._lock.release()
+    if not self.in_reactor_thread():
+      self.wakeup()
+
+  def run_in_reactor(self, func, *args):
+    """Calls func now if on the reactor thread, otherwise queues it."""
+    if self.in_reactor_thread():
+      func(*args)
+    else:
+      self.call_soon(func, *args)
+
+  def call_later(self, delay, func, *args):
+    """Schedules a function to be called after a delay.
+
+    Args:
+      delay: The number of seconds to wait before calling func.
+      func: The function to call.
+      args: The arguments to pass to func.
+
+    Returns:
+      A Timer object which can be used to cancel the call.
+    """
+    return self.call_at(time.time() + delay, func, *args)
+
+  def call_at(self, when, func, *args):
+    """Schedules a function to be called at a given time.
+
+    Args:
+      when: The time (in seconds since the epoch) to call func.
+      func: The function to call.
+      args: The arguments to pass to func.
+
+    Returns:
+      A Timer object which can be used to cancel the call.
+    """
+    timer = Timer(when, func, args)
+    self._lock.acquire()
+    timer._reactor = self
+    earliest = not self._timers or when < self._timers[0][0]
+    heapq.heappush(self._timers, (when, self._timer_sequence.next(), timer))
+    self._lock.release()
+    if earliest and not self.in_reactor_thread():
+      self.wakeup()
+    return timer
+
+  def _timer_cancelled(self):
+    """Called by Timer.cancel(). Compacts the heap if it is mostly dead."""
+    self._lock.acquire()
+    self._cancelled_timers += 1
+    if self._cancelled_timers > 64 and (
+        self._cancelled_timers * 2 > len(self._timers)):
+      self._timers = [t for t in self._timers if not t[2].cancelled]
+      heapq.heapify(self._timers)
+      self._cancelled_timers = 0
+    self._lock.release()
+
+  def next_timeout(self):
+    """Returns the number of seconds until the next timer, or None."""
+    self._lock.acquire()
+    try:
+      while self._timers and self._timers[0][2].cancelled:
+        heapq.heappop(self._timers)
+        self._cancelled_timers -= 1
+      if not self._timers:
+        return None
+      return max(self._timers[0][0] - time.time(), 0)
+    finally:
+      self._lock.release()
+
+  def _run_timers(self):
+    """Calls every timer that has expired."""
+    now = time.time()
+    expired = []
+    self._lock.acquire()
+    while self._timers and self._timers[0][0] <= now:
+      _, _, timer = heapq.heappop(self._timers)
+      if timer.cancelled:
+        self._cancelled_timers -= 1
+      else:
+        timer._reactor = None
+        expired.append(timer)
+    self._lock.release()
+    for timer in expired:
+      try:
+        timer.func(*timer.args)
+      except Exception:
+        logging.exception('Unhandled exception in timer %r', timer.func)
+
+  def _run_pending_calls(self):
+    """Runs every function queued with call_soon()."""
+    self._lock.acquire()
+    calls = self._pending_calls
+    self._pending_calls = []
+    self._lock.release()
+    for func, args in calls:
+      try:
+        func(*args)
+      except Exception:
+        logging.exception('Unhandled exception in reactor call %r', func)
+
+  def poll(self, timeout=None):
+    """Waits for events and dispatches them.
+
+    This waits until a file descriptor is ready, the next timer expires or
+    the given timeout passes, whichever comes first.
+
+    Args:
+      timeout: The maximum number of seconds to wait, or None to wait
+               until an event arrives.
+
+    Returns:
+      The number of file descriptor events dispatched.
+    """
+    self._thread = threading.current_thread()
+    self._run_pending_calls()
+    timer_timeout = self.next_timeout()
+    if timer_timeout is not None:
+      if timeout is None:
+        timeout = timer_timeout
+      else:
+        timeout = min(timeout, timer_timeout)
+    if self._pending_calls:
+      timeout = 0
+    elif timeout is None:
+      timeout = -1
+    try:
+      events = self._epoll.poll(timeout)
+    except IOError, e:
+      if e.errno != errno.EINTR:
+        raise
+      events = []
+    for fd, mask in events:
+      callback = self._callbacks.get(fd)
+      if callback is None:
+        continue
+      try:
+        callback(fd, mask)
+      except Exception:
+        logging.exception('Unhandled exception handling events on fd %d', fd)
+    self._run_timers()
+    self._run_pending_calls()
+    return len(events)
@@ -0,0 +1,131 @@
+#!/usr/bin/python26
+
+"""Reaps child processes for twitcher.
+
+Rather than polling every child process that twitcher owns whenever SIGCHLD
+is received, the Reaper drains all exited children with waitpid(-1) and uses
+a pid index to dispatch each exit status to whoever started the process. The
+cost of a SIGCHLD is therefore linear in the number of children that actually
+exited rather than the number of children that are running.
+
+waitpid(-1) also collects children that other code in the daemon started
+and is waiting for itself, such as a subprocess run by an in process action.
+While that can happen, reap(registered_only=True) waits for each registered
+pid in turn instead, and leaves other children for their owners.
+"""
+
+import errno
+import logging
+import os
+import threading
+
+
+class Reaper(object):
+  """Tracks child processes by pid and dispatches their exit statuses.
+
+  Callbacks registered against a pid are called with the footprint:
+    func(pid, status)
+  where status is the raw status returned by waitpid().
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._callbacks = {}
+
+  def __len__(self):
+    return len(self._callbacks)
+
+  def register(self, pid, callback):
+    """Registers the callback that will receive the exit status of pid.
+
+    Args:
+      pid: The process id of the child.
+      callback: The function to call once the child has exited.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    self._callbacks[pid] = callback
+    self._lock.release()
+
+  def unregister(self, pid):
+    """Stops tracking a pid without waiting for it."""
+    self._lock.acquire()
+    self._callbacks.pop(pid, None)
+    self._lock.release()
+
+  def dispatch(self, pid, status):
+    """Delivers an exit status to the callback registered for pid.
+
+    Args:
+      pid: The process id that exited.
+      status: The raw exit status of the process.
+
+    Returns:
+      True if a callback was registered for the pid.
+    """
+    self._lock.acquire()
+    callback = self._callbacks.pop(pid, None)
+    self._lock.release()
+    if callback is None:
+      logging.info('Reaped unknown child %d (status %d)', pid, status)
+      return False
+    try:
+      callback(pid, status)
+    except Exception:
+      logging.exception('Unhandled exception dispatching exit of %d', pid)
+    return True
+
+  def reap(self, registered_only=False):
+    """Collects every child that has exited so far.
+
+    This shouldn't block. It should be called after SIGCHLD is received
+    and periodically as a safety net.
+
+    Args:
+      registered_only: If True then only registered pids are waited for.
+
+    Returns:
+      The number of children reaped.
+    """
+    if registered_only:
+      return self._reap_registered()
+    reaped = 0
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno != errno.ECHILD:
+          raise
+        break
+      if pid == 0:
+        break
+      reaped += 1
+      self.dispatch(pid, status)
+    return reaped
+
+  def _reap_registered(self):
+    """Collects the registered children that have exited so far."""
+    self._lock.acquire()
+    pids = self._callbacks.keys()
+    self._lock.release()
+    reaped = 0
+    for pid in pids:
+      while True:
+        try:
+          pid, status = os.waitpid(pid, os.WNOHANG)
+        except OSError, e:
+          if e.errno == errno.EINTR:
+            continue
+          if e.errno != errno.ECHILD:
+            raise
+          # Not a child of this process (yet), e.g. one still being
+          # reparented after its parent died.
+          pid = 0
+        break
+      if pid != 0:
+        reaped += 1
+        self.dispatch(pid, status)
+    return reaped
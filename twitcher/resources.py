@@ -0,0 +1,263 @@
+#!/usr/bin/python26
+
+"""Resource limits applied to actions before they run.
+
+By default actions run with the daemon's priority and limits, so a heavy
+action triggered on every host can starve the service that actually matters
+on the box. A ResourceLimits object describes what should be applied to a
+child between fork and exec:
+  - A nice value (setpriority).
+  - An I/O scheduling class and level (ioprio_set).
+  - A CPU affinity mask (sched_setaffinity).
+  - Resource limits (setrlimit).
+  - A cgroup v2 directory with cpu.max and memory.max.
+
+Each run is placed in its own leaf cgroup below the configured directory so
+a timeout can kill everything the run started, even processes that left the
+process group. The limits on the directory apply to all runs of the watch
+together.
+
+None of these can be expressed with posix_spawn, so children that need them
+are forked (by the zygote when one is running).
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import platform
+import resource
+import signal
+
+# twitcher modules
+import fds
+
+
+# I/O scheduling classes, from linux/ioprio.h.
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+# The ioprio_set system call number per architecture.
+_SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    }
+
+_PRIO_PROCESS = 0
+
+# The number of CPUs the affinity mask covers.
+_CPU_SETSIZE = 1024
+
+# Where the cgroup v2 hierarchy is mounted.
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# The period used when cpu_max is given as a number of CPUs.
+_CPU_PERIOD = 100000
+
+
+_libc = fds._libc
+
+
+def _libc_call(name, *args):
+  """Calls a libc function, raising OSError if it fails."""
+  if _libc is None:
+    raise OSError(errno.ENOSYS, '%s: no C library' % name)
+  if getattr(_libc, name)(*args) == -1:
+    e = ctypes.get_errno()
+    raise OSError(e, '%s: %s' % (name, os.strerror(e)))
+
+
+def _write(path, value):
+  """Writes value to a cgroup control file."""
+  f = open(path, 'w')
+  try:
+    f.write(value)
+  finally:
+    f.close()
+
+
+def rlimit_resource(name):
+  """Returns the resource module constant for a name such as 'nofile'."""
+  try:
+    return getattr(resource, 'RLIMIT_' + name.upper())
+  except AttributeError:
+    raise ValueError('Unknown resource limit: %s' % name)
+
+
+class ResourceLimits(object):
+  """The limits applied to every process of a watch.
+
+  Args:
+    nice: The nice value (-20 to 19) the action runs at.
+    ionice_class: One of IOPRIO_CLASS_RT, IOPRIO_CLASS_BE or
+                  IOPRIO_CLASS_IDLE.
+    ionice_level: The priority (0 to 7) within the I/O class.
+    cpu_affinity: A list of CPU numbers the action may run on.
+    rlimits: A dictionary mapping names such as 'nofile' or 'as' to either
+             a limit or a (soft, hard) tuple.
+    cgroup: A cgroup v2 directory, relative to CGROUP_ROOT, that runs are
+            placed under. It is created if needed.
+    cpu_max: The CPU bandwidth for the cgroup, either a number of CPUs or a
+             string written to cpu.max as is (for example '50000 100000').
+    memory_max: The memory limit for the cgroup in bytes, or a string
+                written to memory.max as is (for example '512M').
+  """
+  def __init__(self, nice=None, ionice_class=None, ionice_level=None,
+               cpu_affinity=None, rlimits=None, cgroup=None, cpu_max=None,
+               memory_max=None):
+    self.nice = nice
+    self.ionice_class = ionice_class
+    self.ionice_level = ionice_level
+    self.cpu_affinity = cpu_affinity
+    self.rlimits = {}
+    for name, value in (rlimits or {}).iteritems():
+      if not isinstance(value, tuple):
+        value = (value, value)
+      self.rlimits[rlimit_resource(name)] = value
+    self.cgroup = None
+    if cgroup is not None:
+      self.cgroup = os.path.join(CGROUP_ROOT, cgroup.strip('/'))
+    self.cpu_max = cpu_max
+    self.memory_max = memory_max
+    self._prepared = False
+
+  def prepare(self):
+    """Creates the cgroup and sets its limits. Called in the daemon.
+
+    Throws:
+      OSError, IOError: If the cgroup can't be set up.
+
+    Returns:
+      Nothing.
+    """
+    if self._prepared or self.cgroup is None:
+      return
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+      raise OSError(errno.ENOTSUP, 'No cgroup v2 hierarchy at %s' %
+                    CGROUP_ROOT)
+    controllers = []
+    if self.cpu_max is not None:
+      controllers.append('cpu')
+    if self.memory_max is not None:
+      controllers.append('memory')
+    if controllers:
+      self._enable_controllers(controllers)
+    if not os.path.isdir(self.cgroup):
+      os.makedirs(self.cgroup)
+    if self.cpu_max is not None:
+      cpu_max = self.cpu_max
+      if not isinstance(cpu_max, str):
+        cpu_max = '%d %d' % (int(cpu_max * _CPU_PERIOD), _CPU_PERIOD)
+      _write(os.path.join(self.cgroup, 'cpu.max'), cpu_max)
+    if self.memory_max is not None:
+      _write(os.path.join(self.cgroup, 'memory.max'), str(self.memory_max))
+    self._prepared = True
+
+  def _enable_controllers(self, controllers):
+    """Enables controllers on every ancestor of the cgroup directory."""
+    value = ' '.join('+' + c for c in controllers)
+    path = CGROUP_ROOT
+    for part in os.path.dirname(self.cgroup)[len(CGROUP_ROOT):].split('/'):
+      path = os.path.join(path, part)
+      if not os.path.isdir(path):
+        os.mkdir(path)
+      try:
+        _write(os.path.join(path, 'cgroup.subtree_control'), value)
+      except IOError, e:
+        logging.error('Unable to enable %s in %s: %s', value, path, e)
+
+  def apply(self):
+    """Applies every limit to the current process. Called in the child.
+
+    This must be called before switching to another user.
+
+    Throws:
+      OSError, IOError: If a limit can't be applied.
+
+    Returns:
+      Nothing.
+    """
+    if self.cgroup is not None:
+      leaf = self.leaf(os.getpid())
+      os.mkdir(leaf)
+      _write(os.path.join(leaf, 'cgroup.procs'), '0')
+    if self.nice is not None:
+      _libc_call('setpriority', _PRIO_PROCESS, 0, self.nice)
+    if self.ionice_class is not None:
+      number = _SYS_IOPRIO_SET.get(platform.machine())
+      if number is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set: unknown architecture')
+      level = self.ionice_level
+      if level is None:
+        level = self.ionice_class != IOPRIO_CLASS_IDLE and 4 or 0
+      _libc_call('syscall', number, _IOPRIO_WHO_PROCESS, 0,
+                 (self.ionice_class << _IOPRIO_CLASS_SHIFT) | level)
+    if self.cpu_affinity is not None:
+      bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+      mask = (ctypes.c_ulong * (_CPU_SETSIZE / bits))()
+      for cpu in self.cpu_affinity:
+        mask[cpu / bits] |= 1 << (cpu % bits)
+      _libc_call('sched_setaffinity', 0, ctypes.sizeof(mask), mask)
+    for which, limits in self.rlimits.iteritems():
+      resource.setrlimit(which, limits)
+
+  def leaf(self, pid):
+    """Returns the cgroup directory of the run whose main process is pid."""
+    return os.path.join(self.cgroup, 'run-%d' % pid)
+
+  def signal_cgroup(self, pid, sig):
+    """Sends a signal to every process in a run's cgroup.
+
+    Args:
+      pid: The pid of the run's main process.
+      sig: The signal to send.
+
+    Returns:
+      Nothing.
+    """
+    if self.cgroup is None:
+      return
+    leaf = self.leaf(pid)
+    if sig == signal.SIGKILL and os.path.exists(os.path.join(leaf,
+                                                             'cgroup.kill')):
+      try:
+        _write(os.path.join(leaf, 'cgroup.kill'), '1')
+        return
+      except IOError:
+        pass
+    try:
+      f = open(os.path.join(leaf, 'cgroup.procs'))
+      try:
+        pids = [int(line) for line in f if line.strip()]
+      finally:
+        f.close()
+    except IOError:
+      return
+    for p in pids:
+      # Never let a bogus entry turn into a signal for our own group.
+      if p <= 0:
+        continue
+      try:
+        os.kill(p, sig)
+      except OSError:
+        pass
+
+  def cleanup(self, pid):
+    """Removes a run's cgroup once its main process has exited."""
+    if self.cgroup is None:
+      return
+    try:
+      os.rmdir(self.leaf(pid))
+    except OSError, e:
+      if e.errno == errno.EBUSY:
+        logging.info('Processes started by %d are still running in %s', pid,
+                     self.leaf(pid))
+      elif e.errno != errno.ENOENT:
+        logging.error('Unable to remove %s: %s', self.leaf(pid), e)
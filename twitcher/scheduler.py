@@ -0,0 +1,185 @@
+#!/usr/bin/python26
+
+"""A daemon wide scheduler for starting actions.
+
+Without a scheduler every watch notification starts a process straight away
+so a hot znode, or many configs watching the same znode, can fork hundreds
+of processes at once. Every action is instead submitted to the Scheduler as
+a Job which is started once there is room for it:
+  - No more than max_running jobs run at once across the daemon.
+  - Each group (config file) may have its own limit.
+  - Each watch may have its own limit.
+Waiting jobs start in priority order (HIGH, NORMAL then LOW) and in the
+order they were submitted within a priority. Time spent queued is recorded
+in the stats module.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+
+# twitcher modules
+import stats
+
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+
+class Job(object):
+  """A unit of work waiting for permission to start.
+
+  Args:
+    run: Called with the job once it may start. Whoever started the work
+         must call Scheduler.release(job) when it is finished.
+    desc: The description used for logging.
+    priority: One of HIGH, NORMAL or LOW.
+    group: The group (config file) the job belongs to.
+    watch: The watch the job belongs to.
+    watch_limit: The most jobs of this watch that may run at once.
+  """
+  def __init__(self, run, desc, priority=NORMAL, group=None, watch=None,
+               watch_limit=None):
+    self.run = run
+    self.desc = desc
+    self.priority = priority
+    self.group = group
+    self.watch = watch
+    self.watch_limit = watch_limit
+    self.submitted = None
+    self.started = None
+    self.running = False
+    self.cancelled = False
+
+
+class Scheduler(object):
+  """Decides when submitted jobs may start.
+
+  All functions are expected to be called from the reactor thread.
+
+  Args:
+    max_running: The most jobs that may run at once, or None for no limit.
+  """
+  def __init__(self, max_running=None):
+    self._max_running = max_running
+    self._group_limits = {}
+    self._running = 0
+    self._running_by_group = {}
+    self._running_by_watch = {}
+    self._queue = []
+    self._queued = 0
+    self._sequence = itertools.count()
+    self._pumping = False
+    self._repump = False
+    stats.set_gauge('scheduler.running', lambda: self._running)
+    stats.set_gauge('scheduler.queued', lambda: self._queued)
+
+  def set_group_limit(self, group, limit):
+    """Sets the most jobs of a group that may run at once.
+
+    Args:
+      group: The group (normally a config file name).
+      limit: The limit, or None to remove it.
+
+    Returns:
+      Nothing.
+    """
+    if limit is None:
+      self._group_limits.pop(group, None)
+    else:
+      self._group_limits[group] = limit
+    self._pump()
+
+  def submit(self, job):
+    """Queues a job and starts it if there is room."""
+    job.submitted = time.time()
+    heapq.heappush(self._queue, (job.priority, self._sequence.next(), job))
+    self._queued += 1
+    stats.increment('scheduler.submitted')
+    self._pump()
+
+  def cancel(self, job):
+    """Removes a job that has not started yet from the queue."""
+    if not job.cancelled and not job.running and job.started is None:
+      job.cancelled = True
+      self._queued -= 1
+
+  def release(self, job):
+    """Marks a running job as finished, freeing its slot."""
+    if not job.running:
+      return
+    job.running = False
+    self._running -= 1
+    self._running_by_group[job.group] -= 1
+    self._running_by_watch[job.watch] -= 1
+    if not self._running_by_group[job.group]:
+      del self._running_by_group[job.group]
+    if not self._running_by_watch[job.watch]:
+      del self._running_by_watch[job.watch]
+    self._pump()
+
+  def _can_run(self, job):
+    """Returns True if the group and watch limits allow job to start."""
+    limit = self._group_limits.get(job.group)
+    if limit is not None and self._running_by_group.get(job.group, 0) >= limit:
+      return False
+    if (job.watch_limit is not None and
+        self._running_by_watch.get(job.watch, 0) >= job.watch_limit):
+      return False
+    return True
+
+  def _pump(self):
+    """Starts as many queued jobs as the limits allow."""
+    if self._pumping:
+      self._repump = True
+      return
+    self._pumping = True
+    try:
+      self._repump = True
+      while self._repump:
+        self._repump = False
+        self._pump_once()
+    finally:
+      self._pumping = False
+
+  def _pump_once(self):
+    """Walks the queue once in priority order starting what it can."""
+    blocked = []
+    while self._queue and (self._max_running is None or
+                           self._running < self._max_running):
+      entry = heapq.heappop(self._queue)
+      job = entry[2]
+      if job.cancelled:
+        continue
+      if not self._can_run(job):
+        blocked.append(entry)
+        continue
+      self._start(job)
+    for entry in blocked:
+      heapq.heappush(self._queue, entry)
+
+  def _start(self, job):
+    """Starts a job that has been given a slot."""
+    self._queued -= 1
+    job.running = True
+    job.started = time.time()
+    self._running += 1
+    self._running_by_group[job.group] = (
+        self._running_by_group.get(job.group, 0) + 1)
+    self._running_by_watch[job.watch] = (
+        self._running_by_watch.get(job.watch, 0) + 1)
+    wait = job.started - job.submitted
+    stats.record('scheduler.queue_wait', wait)
+    stats.record('scheduler.queue_wait.%s' % PRIORITY_NAMES[job.priority],
+                 wait)
+    if wait >= 1:
+      logging.info('"%s" waited %.1f seconds to start.', job.desc, wait)
+    try:
+      job.run(job)
+    except Exception:
+      logging.exception('Unhandled exception starting "%s"', job.desc)
+      self.release(job)
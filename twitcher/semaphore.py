@@ -0,0 +1,252 @@
+#!/usr/bin/python26
+
+"""A zookeeper based semaphore shared by every host running twitcher.
+
+Per host run modes can't stop a whole fleet from running a heavy action at
+the same moment. A DistributedSemaphore limits an action to at most 'limit'
+hosts at a time. Each request for a slot creates an ephemeral sequential
+node under the lock path, named with the session id and a unique id for
+the request:
+
+  /locks/reindex/lease-8f1c02a4e90001-5d0e...-0000000041
+  /locks/reindex/lease-8f1c02a4e90002-91b3...-0000000042
+  ...
+
+The nodes with the 'limit' lowest sequence numbers hold the slots. Everyone
+else waits for the children of the lock path to change and checks again.
+Releasing a slot deletes the node, and if a host dies its session expires
+and zookeeper removes its nodes for it.
+
+However many of our leases are waiting, the semaphore holds one watch on
+the lock path, has at most one listing of it outstanding, and drops the
+watch once none are waiting. If the connection drops before the create is
+acknowledged the node may still have been made, so the lock path is listed
+and a node with the request's id is adopted rather than queueing a second
+time.
+"""
+
+import logging
+import socket
+import uuid
+
+# twitcher modules
+import core
+import zookeeper
+
+
+_PREFIX = 'lease-'
+
+
+def _sequence(name):
+  """Returns the sequence number zookeeper appended to a lease node."""
+  if not name.startswith(_PREFIX):
+    return None
+  try:
+    return int(name.rsplit('-', 1)[-1])
+  except ValueError:
+    return None
+
+
+class Lease(object):
+  """A request for one slot of a DistributedSemaphore.
+
+  Args:
+    semaphore: The DistributedSemaphore the slot belongs to.
+    on_granted: Called with the lease once the slot is held.
+  """
+  def __init__(self, semaphore, on_granted):
+    self._semaphore = semaphore
+    self._on_granted = on_granted
+    self.id = '%x-%s' % (core.default_zkwrapper.session_id(),
+                         uuid.uuid4().hex)
+    self.node = None
+    self.granted = False
+    self.released = False
+
+  def release(self):
+    """Gives up the slot, or stops waiting for one."""
+    self._semaphore._release(self)
+
+
+class DistributedSemaphore(object):
+  """Hands out at most limit slots across every host using path.
+
+  All functions are expected to be called from the reactor thread.
+
+  Args:
+    path: The znode lease nodes are created under.
+    limit: The number of hosts that may hold a slot at once.
+  """
+  def __init__(self, path, limit):
+    self._path = path.rstrip('/')
+    self._limit = limit
+    self._waiting = []
+    # The watch on the lock path while any lease is waiting. _armed is set
+    # while its watcher is registered and _listing while a listing is
+    # outstanding; _relist asks for another once that returns.
+    self._subscription = None
+    self._armed = False
+    self._listing = False
+    self._relist = False
+
+  def acquire(self, on_granted):
+    """Asks for a slot.
+
+    Args:
+      on_granted: Called with the Lease once the slot is held.
+
+    Returns:
+      The Lease. Call release() on it when finished, even if it was never
+      granted.
+    """
+    lease = Lease(self, on_granted)
+    self._waiting.append(lease)
+    self._create(lease)
+    return lease
+
+  def _create(self, lease):
+    """Creates the node that queues a lease."""
+    core.default_zkwrapper.acreate(
+        '%s/%s%s-' % (self._path, _PREFIX, lease.id), socket.gethostname(),
+        zookeeper.EPHEMERAL | zookeeper.SEQUENCE,
+        lambda zh, rc, created: self._created(lease, rc, created))
+
+  @core._from_zookeeper
+  def _created(self, lease, rc, created):
+    """Called once the node for a lease has been created."""
+    if rc == zookeeper.NONODE:
+      core.default_zkwrapper.ensure_path(
+          self._path, core._from_zookeeper(lambda: self._create(lease)))
+      return
+    if rc == zookeeper.CONNECTIONLOSS:
+      # The create may have landed before the connection dropped.
+      core.default_zkwrapper.aget_children(
+          self._path,
+          handler=lambda zh, rc, children, path: self._find(lease, rc,
+                                                            children))
+      return
+    if rc != zookeeper.OK:
+      logging.error('Unable to queue for the semaphore at %s: %s',
+                    self._path, rc)
+      core.default_reactor.call_later(1, self._retry, lease)
+      return
+    self._queued(lease, created.rsplit('/', 1)[-1])
+
+  @core._from_zookeeper
+  def _find(self, lease, rc, children):
+    """Adopts the node of a lease whose create had its connection drop."""
+    if rc != zookeeper.OK:
+      core.default_reactor.call_later(1, self._created, lease,
+                                      zookeeper.CONNECTIONLOSS, None)
+      return
+    prefix = '%s%s-' % (_PREFIX, lease.id)
+    for child in children:
+      if child.startswith(prefix):
+        logging.info('Found semaphore node %s/%s after a connection loss.',
+                     self._path, child)
+        self._queued(lease, child)
+        return
+    core.default_reactor.call_later(1, self._retry, lease)
+
+  def _retry(self, lease):
+    """Creates the node for a lease again, unless it was released."""
+    if not lease.released:
+      self._create(lease)
+
+  def _queued(self, lease, node):
+    """Called once a lease's node exists."""
+    lease.node = node
+    if lease.released:
+      core.default_zkwrapper.adelete('%s/%s' % (self._path, node))
+      return
+    self._check()
+
+  def _check(self):
+    """Lists the queue, watching it for changes if it isn't already."""
+    if self._listing:
+      # The outstanding listing may predate whatever asked for this one.
+      self._relist = True
+      return
+    if self._subscription is None:
+      self._subscription = core.default_zkwrapper.subscribe(
+          self._path, core.WATCH_CHILDREN)
+    subscription = self._subscription
+    watcher = None
+    if not self._armed:
+      self._armed = True
+      watcher = lambda zh, path: self._changed(subscription)
+    self._listing = True
+    self._relist = False
+    core.default_zkwrapper.aget_children(
+        self._path, watcher=watcher,
+        handler=lambda zh, rc, children, path: self._children(
+            subscription, rc, children),
+        subscription=subscription)
+
+  @core._from_zookeeper
+  def _changed(self, subscription):
+    """Called when a lease is queued or released anywhere in the fleet."""
+    if subscription is not self._subscription:
+      return
+    self._armed = False
+    self._check()
+
+  def _unwatch(self):
+    """Drops the watch on the lock path once no lease is waiting."""
+    if self._waiting or self._subscription is None:
+      return
+    self._subscription.release()
+    self._subscription = None
+    self._armed = False
+    self._listing = False
+    self._relist = False
+
+  @core._from_zookeeper
+  def _children(self, subscription, rc, children):
+    """Handles a listing of the queue."""
+    if subscription is not self._subscription:
+      return
+    self._listing = False
+    if rc != zookeeper.OK:
+      logging.error('Unable to list the semaphore at %s: %s', self._path, rc)
+    else:
+      self._grant(children)
+    if self._relist and self._waiting:
+      self._check()
+    self._unwatch()
+
+  def _grant(self, children):
+    """Grants slots to any of our leases that are now at the front."""
+    queue = sorted((_sequence(c), c) for c in children
+                   if _sequence(c) is not None)
+    holders = set(c for _, c in queue[:self._limit])
+    present = set(c for _, c in queue)
+    newest = queue[-1][0] if queue else -1
+    for lease in list(self._waiting):
+      if lease.node is None:
+        continue
+      if lease.node in holders:
+        self._waiting.remove(lease)
+        lease.granted = True
+        logging.info('Acquired semaphore slot %s/%s', self._path, lease.node)
+        lease._on_granted(lease)
+      elif lease.node not in present and _sequence(lease.node) < newest:
+        # The list is newer than our node yet doesn't include it, so it was
+        # lost with an expired session. Queue again.
+        logging.warning('Semaphore node %s/%s disappeared; queueing again.',
+                        self._path, lease.node)
+        lease.node = None
+        self._create(lease)
+
+  def _release(self, lease):
+    """Deletes a lease's node and forgets about it."""
+    if lease.released:
+      return
+    lease.released = True
+    if lease in self._waiting:
+      self._waiting.remove(lease)
+      self._unwatch()
+    if lease.node is not None:
+      core.default_zkwrapper.adelete('%s/%s' % (self._path, lease.node))
+      if lease.granted:
+        logging.info('Released semaphore slot %s/%s', self._path, lease.node)
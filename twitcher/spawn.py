@@ -0,0 +1,186 @@
+#!/usr/bin/python26
+
+"""Fast process creation for Exec() actions.
+
+Forking the twitcher daemon copies the page tables of the entire python heap
+(zookeeper client, every config namespace and all the cached znode data) only
+to throw them away when the child calls exec. Actions built with Exec() are
+just an argument vector, so they can be started with posix_spawn() which
+glibc implements with a vfork style clone that never copies the parent.
+
+Python 2 doesn't expose posix_spawn so it is called through ctypes. If the C
+library doesn't provide it then available() returns False and callers should
+fall back to fork().
+"""
+
+import ctypes
+import os
+
+# twitcher modules
+import fds
+
+
+# Flags for posix_spawnattr_setflags(), from glibc's spawn.h.
+POSIX_SPAWN_SETPGROUP = 0x02
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+
+# These are opaque structures in the C library. The buffers are larger than
+# any known implementation needs.
+_FILE_ACTIONS_SIZE = 256
+_ATTR_SIZE = 1024
+_SIGSET_SIZE = 128
+
+
+class ExecAction(object):
+  """An action that executes a command, as returned by Exec().
+
+  Calling the object replaces the current process with the command, exactly
+  like the lambda Exec() used to return. Keeping the argument vector around
+  allows twitcher to start the command without forking.
+
+  Args:
+    argv: The argument vector to execute. argv[0] is searched for in PATH.
+  """
+  def __init__(self, argv):
+    self.argv = list(argv)
+
+  def __call__(self):
+    os.execvp(self.argv[0], self.argv)
+
+  def __repr__(self):
+    return 'ExecAction(%r)' % (self.argv,)
+
+
+_libc = fds._libc
+
+
+def _libc_function(name):
+  """Returns the named libc function or None if it doesn't exist."""
+  if _libc is None:
+    return None
+  return getattr(_libc, name, None)
+
+
+_posix_spawnp = _libc_function('posix_spawnp')
+_addclosefrom = _libc_function('posix_spawn_file_actions_addclosefrom_np')
+
+
+def available():
+  """Returns True if posix_spawn can be used on this system."""
+  return _posix_spawnp is not None
+
+
+def can_spawn(func, uid=None, gid=None):
+  """Returns True if func can be started with spawn() rather than fork().
+
+  posix_spawn can't change the user or group of the child so actions that
+  need to switch ids still have to go through fork.
+
+  Args:
+    func: The action function.
+    uid: The user id the action should run as.
+    gid: The group id the action should run as.
+
+  Returns:
+    True or False.
+  """
+  return (available() and isinstance(func, ExecAction) and
+          uid is None and gid is None)
+
+
+_devnull_fd = None
+
+
+def devnull_fd():
+  """Returns a close-on-exec file descriptor open to /dev/null."""
+  global _devnull_fd
+  if _devnull_fd is None:
+    fd = os.open('/dev/null', os.O_WRONLY)
+    fds.set_cloexec(fd)
+    _devnull_fd = fd
+  return _devnull_fd
+
+
+def _check(rc, name):
+  """Raises OSError if a posix_spawn helper returned an error."""
+  if rc != 0:
+    raise OSError(rc, '%s: %s' % (name, os.strerror(rc)))
+
+
+def spawn(argv, stdin_fd, stdout_fd=None, stderr_fd=None, env=None):
+  """Starts a command without forking the current process.
+
+  The child gets stdin_fd as its stdin, stdout_fd and stderr_fd (or
+  /dev/null) as stdout and stderr, every other descriptor closed and all
+  signal dispositions and the signal mask reset to their defaults. It leads
+  a new process group so that everything it starts can be signaled at once.
+
+  Args:
+    argv: The argument vector to execute. argv[0] is searched for in PATH.
+    stdin_fd: The file descriptor that should become stdin.
+    stdout_fd: The file descriptor that should become stdout.
+    stderr_fd: The file descriptor that should become stderr.
+    env: A dictionary of environment variables, os.environ by default.
+
+  Throws:
+    OSError: If the process could not be started.
+
+  Returns:
+    The pid of the new process.
+  """
+  if stdout_fd is None:
+    stdout_fd = devnull_fd()
+  if stderr_fd is None:
+    stderr_fd = devnull_fd()
+  if env is None:
+    env = os.environ
+
+  c_argv = (ctypes.c_char_p * (len(argv) + 1))(*(list(argv) + [None]))
+  env_list = ['%s=%s' % i for i in env.iteritems()]
+  c_env = (ctypes.c_char_p * (len(env_list) + 1))(*(env_list + [None]))
+
+  actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+  attr = ctypes.create_string_buffer(_ATTR_SIZE)
+  sigset = ctypes.create_string_buffer(_SIGSET_SIZE)
+  _check(_libc.posix_spawn_file_actions_init(actions),
+         'posix_spawn_file_actions_init')
+  try:
+    _check(_libc.posix_spawnattr_init(attr), 'posix_spawnattr_init')
+    try:
+      for fd, target in ((stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2)):
+        _check(_libc.posix_spawn_file_actions_adddup2(actions, fd, target),
+               'posix_spawn_file_actions_adddup2')
+      if _addclosefrom is not None:
+        _check(_addclosefrom(actions, 3),
+               'posix_spawn_file_actions_addclosefrom_np')
+      else:
+        # Without closefrom we close what is open right now. Anything this
+        # misses has been marked close-on-exec by the daemon.
+        for fd in fds.open_fds(3) or []:
+          _check(_libc.posix_spawn_file_actions_addclose(actions, fd),
+                 'posix_spawn_file_actions_addclose')
+
+      _libc.sigfillset(sigset)
+      _check(_libc.posix_spawnattr_setsigdefault(attr, sigset),
+             'posix_spawnattr_setsigdefault')
+      _libc.sigemptyset(sigset)
+      _check(_libc.posix_spawnattr_setsigmask(attr, sigset),
+             'posix_spawnattr_setsigmask')
+      _check(_libc.posix_spawnattr_setpgroup(attr, 0),
+             'posix_spawnattr_setpgroup')
+      _check(_libc.posix_spawnattr_setflags(
+                 attr, ctypes.c_short(POSIX_SPAWN_SETPGROUP |
+                                      POSIX_SPAWN_SETSIGDEF |
+                                      POSIX_SPAWN_SETSIGMASK)),
+             'posix_spawnattr_setflags')
+
+      pid = ctypes.c_int(0)
+      _check(_posix_spawnp(ctypes.byref(pid), argv[0], actions, attr,
+                           c_argv, c_env),
+             'posix_spawnp')
+      return pid.value
+    finally:
+      _libc.posix_spawnattr_destroy(attr)
+  finally:
+    _libc.posix_spawn_file_actions_destroy(actions)
@@ -0,0 +1,163 @@
+#!/usr/bin/python26
+
+"""Deterministic per host delays (splay) before running actions.
+
+When a popular znode changes every host running twitcher is notified within
+a few milliseconds of the others. If the action talks to a shared backend,
+git pull being the classic example, all of them arrive at once. A splay
+delays each host's run by an offset within a window. The offset is derived
+from a hash of the host name and the znode so it is stable across restarts
+and evenly spread across a fleet, but different for each watch.
+
+The adaptive variant has every host register an ephemeral node under a
+zookeeper path. Hosts are then ordered by name and given evenly spaced slots,
+and the window can grow with the number of hosts registered. The node is
+shared by every watch using the path and deleted once the last of them is
+unloaded.
+"""
+
+import hashlib
+import logging
+import socket
+
+# twitcher modules
+import core
+import zookeeper
+
+
+def _fraction(*parts):
+  """Returns a stable number in [0, 1) derived from the given strings."""
+  digest = hashlib.md5('\0'.join(parts)).hexdigest()
+  return int(digest[:8], 16) / float(1 << 32)
+
+
+class SplayGroup(object):
+  """Registers this host under a znode and tracks the other hosts there.
+
+  Args:
+    path: The znode hosts register under.
+    hostname: The name this host registers as.
+  """
+  def __init__(self, path, hostname):
+    self.path = path
+    self.hostname = hostname
+    self.members = []
+    self.refs = 0
+    self._node = '%s/%s' % (path.rstrip('/'), hostname)
+    self._subscription = None
+
+  def start(self):
+    """Registers this host. Must be called once zookeeper is available."""
+    core.default_zkwrapper.register_ephemeral(self._node,
+                                              on_created=self._registered)
+
+  def stop(self):
+    """Deletes this host's node and stops watching the other hosts."""
+    core.default_zkwrapper.unregister_ephemeral(self._node)
+    if self._subscription is not None:
+      self._subscription.release()
+
+  @core._from_zookeeper
+  def _registered(self):
+    """Called once our node exists, which means the path exists as well."""
+    if self._subscription is None:
+      self._subscription = core.default_zkwrapper.subscribe(
+          self.path, core.WATCH_CHILDREN)
+      self._watch_members()
+
+  def _watch_members(self):
+    """Fetches the list of hosts and watches it for changes."""
+    core.default_zkwrapper.aget_children(self.path, watcher=self._changed,
+                                         handler=self._received,
+                                         subscription=self._subscription)
+
+  @core._from_zookeeper
+  def _changed(self, zh, path):
+    """Called when hosts register or go away."""
+    self._watch_members()
+
+  @core._from_zookeeper
+  def _received(self, zh, rc, children, path):
+    """Called with the current list of hosts."""
+    if rc != zookeeper.OK:
+      logging.error('Unable to list splay hosts under %s: %s', path, rc)
+      return
+    self.members = sorted(children)
+    logging.info('%d hosts registered under %s', len(self.members), path)
+
+
+_groups = {}
+
+
+def get_group(path):
+  """Returns the started SplayGroup for a path, creating it if needed.
+
+  Each call must be matched by a call to release_group().
+  """
+  group = _groups.get(path)
+  if group is None:
+    group = SplayGroup(path, socket.gethostname())
+    _groups[path] = group
+    group.start()
+  group.refs += 1
+  return group
+
+
+def release_group(path):
+  """Drops a reference from get_group(), stopping the group after the last."""
+  group = _groups.get(path)
+  if group is None:
+    return
+  group.refs -= 1
+  if group.refs <= 0:
+    del _groups[path]
+    group.stop()
+
+
+class Splay(object):
+  """Computes the delay before a watch's action runs on this host.
+
+  Args:
+    key: A string identifying the watch, normally the znode.
+    window: The most seconds a run may be delayed.
+    path: If set then hosts register under this znode and are given evenly
+          spaced slots in the window.
+    interval: If set with path then the window is this many seconds per
+              registered host, capped at window if that is also set.
+  """
+  def __init__(self, key, window=None, path=None, interval=None):
+    self._key = key
+    self._window = window
+    self._interval = interval
+    self._hostname = socket.gethostname()
+    self._path = path
+    self._group = None
+    if path is not None:
+      self._group = get_group(path)
+
+  def close(self):
+    """Releases the host registration. Called when the watch is unloaded."""
+    if self._group is not None:
+      self._group = None
+      release_group(self._path)
+
+  def offset(self):
+    """Returns the number of seconds this host should wait."""
+    members = []
+    if self._group is not None:
+      members = self._group.members
+    if not members:
+      return (self._window or 0) * _fraction(self._hostname, self._key)
+    count = len(members)
+    window = self._window
+    if self._interval is not None:
+      window = count * self._interval
+      if self._window is not None:
+        window = min(window, self._window)
+    if self._hostname in members:
+      rank = members.index(self._hostname)
+    else:
+      rank = int(_fraction(self._hostname, self._key) * count)
+    # Rotate the slots per watch so the same host isn't always first.
+    rank = (rank + int(_fraction(self._key) * count)) % count
+    return window * rank / float(count)
@@ -0,0 +1,138 @@
+#!/usr/bin/python26
+
+"""Remembers what each watch last ran with, across restarts.
+
+With run_on_load=True every action runs when twitcher starts, so
+restarting the daemon on a fleet starts every action on every host at
+once even though nothing changed. The StateFile records, for each watch,
+the znode, the version and content digest of the data its last run was
+given, and that run's exit status. Watches with run_on_load='if_changed'
+compare the data fetched at startup against this and only run if it
+differs or the last run failed.
+
+The file is JSON, one entry per watch keyed by its description:
+
+  {"/etc/twitcher/web.twc-1": {"digest": "...", "status": 0,
+                               "version": 12, "znode": "/svc/web"}}
+
+Writes are batched on a short timer and replace the file atomically (a
+temporary file in the same directory is written, synced and renamed over
+it) so a crash never leaves a partial file behind. Entries for watches that
+are no longer loaded are dropped when the file is written.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+
+# twitcher modules
+import stats
+
+
+# The number of seconds changes are collected for before writing.
+WRITE_DELAY = 1.0
+
+
+class StateFile(object):
+  """The on disk record of each watch's last run.
+
+  All functions are expected to be called from the reactor thread.
+
+  Args:
+    path: The file the state is kept in.
+    reactor_obj: The reactor used to schedule writes.
+    loaded: A function returning the keys of the watches currently loaded,
+            or None to keep every entry.
+  """
+  def __init__(self, path, reactor_obj, loaded=None):
+    self._path = path
+    self._reactor = reactor_obj
+    self._loaded = loaded
+    self._entries = {}
+    self._timer = None
+    self.load()
+
+  def load(self):
+    """Reads the state file, if there is one."""
+    try:
+      f = open(self._path)
+      try:
+        entries = json.load(f)
+      finally:
+        f.close()
+    except IOError, e:
+      if e.errno != errno.ENOENT:
+        logging.error('Unable to read the state file %s: %s', self._path, e)
+      return
+    except ValueError, e:
+      logging.error('Ignoring the corrupt state file %s: %s', self._path, e)
+      return
+    if isinstance(entries, dict):
+      self._entries = entries
+    logging.info('Loaded the state of %d watches from %s',
+                 len(self._entries), self._path)
+
+  def unchanged(self, key, znode, digest):
+    """Returns True if the last run of a watch had this data and succeeded.
+
+    Args:
+      key: The watch's description.
+      znode: The znode the watch is on.
+      digest: The digest of the data just fetched.
+
+    Returns:
+      True or False.
+    """
+    entry = self._entries.get(key)
+    return (entry is not None and entry.get('znode') == znode and
+            entry.get('digest') == digest and entry.get('status') == 0)
+
+  def record(self, key, znode, version, digest, status):
+    """Records the result of a run.
+
+    Args:
+      key: The watch's description.
+      znode: The znode the watch is on.
+      version: The stat version of the data the run was given, or None.
+      digest: The digest of that data.
+      status: The exit status of the run.
+
+    Returns:
+      Nothing.
+    """
+    self._entries[key] = {'znode': znode, 'version': version,
+                          'digest': digest, 'status': status}
+    if self._timer is None:
+      self._timer = self._reactor.call_later(WRITE_DELAY, self.write)
+
+  def write(self):
+    """Atomically replaces the state file with the current state."""
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self._loaded is not None:
+      loaded = set(self._loaded())
+      for key in [k for k in self._entries if k not in loaded]:
+        del self._entries[key]
+        stats.increment('state.pruned')
+    directory = os.path.dirname(os.path.abspath(self._path))
+    try:
+      fd, tmp = tempfile.mkstemp(prefix='.twitcher-state', dir=directory)
+      try:
+        f = os.fdopen(fd, 'w')
+        try:
+          json.dump(self._entries, f, sort_keys=True, separators=(',', ':'))
+          f.flush()
+          os.fsync(f.fileno())
+        finally:
+          f.close()
+        os.rename(tmp, self._path)
+      except:
+        os.unlink(tmp)
+        raise
+    except (IOError, OSError), e:
+      logging.error('Unable to write the state file %s: %s', self._path, e)
+      return
+    stats.increment('state.writes')
@@ -0,0 +1,86 @@
+#!/usr/bin/python26
+
+"""Process wide counters and timings for twitcher.
+
+Modules record what they are doing here so operators can tune limits. The
+collected values are logged when twitcher receives SIGUSR1 and, if a stats
+file is configured, periodically written to disk as JSON.
+
+Three kinds of values are kept:
+  counters: Numbers that only go up (increment()).
+  timings: The count, total and maximum of a duration (record()).
+  gauges: Functions called when a snapshot is taken (set_gauge()).
+"""
+
+import json
+import logging
+import os
+import threading
+
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_gauges = {}
+
+
+def increment(name, value=1):
+  """Adds value to the named counter."""
+  _lock.acquire()
+  _counters[name] = _counters.get(name, 0) + value
+  _lock.release()
+
+
+def record(name, seconds):
+  """Records one occurrence of a duration under the given name."""
+  _lock.acquire()
+  t = _timings.setdefault(name, [0, 0.0, 0.0])
+  t[0] += 1
+  t[1] += seconds
+  t[2] = max(t[2], seconds)
+  _lock.release()
+
+
+def set_gauge(name, func):
+  """Registers a function whose return value is reported as name."""
+  _lock.acquire()
+  _gauges[name] = func
+  _lock.release()
+
+
+def snapshot():
+  """Returns a dictionary of every value currently recorded."""
+  _lock.acquire()
+  r = dict(_counters)
+  for name, (count, total, maximum) in _timings.iteritems():
+    r[name + '.count'] = count
+    r[name + '.total'] = total
+    r[name + '.max'] = maximum
+  gauges = _gauges.items()
+  _lock.release()
+  for name, func in gauges:
+    try:
+      r[name] = func()
+    except Exception, e:
+      logging.error('Unable to read gauge %s: %s', name, e)
+  return r
+
+
+def log_stats():
+  """Writes every value to the log."""
+  for name, value in sorted(snapshot().iteritems()):
+    logging.warning('stats: %s = %s', name, value)
+
+
+def write_stats(filename):
+  """Atomically replaces filename with a JSON snapshot of every value."""
+  tmp = '%s.tmp' % filename
+  try:
+    f = open(tmp, 'w')
+    try:
+      json.dump(snapshot(), f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+    os.rename(tmp, filename)
+  except (IOError, OSError), e:
+    logging.error('Unable to write stats to %s: %s', filename, e)
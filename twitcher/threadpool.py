@@ -0,0 +1,204 @@
+#!/usr/bin/python26
+
+"""A bounded pool of threads for running small Python actions in process.
+
+Many actions are a few lines of Python that write a file. Forking for each
+of those costs far more than the action itself: descriptor cleanup, the
+/dev/null dups, and reaping the child. Watches registered with
+in_process=True hand their action to the ThreadPool instead, which runs it
+on one of a fixed number of threads inside the daemon.
+
+The action is called with the contents of the znode as its only argument.
+It runs with the daemon's privileges and shares its memory, so it must be
+trusted, quick and thread safe. When it finishes the result is handed back
+to the reactor thread, where the watch treats it like a process exiting
+(0 if the function returned, 1 if it raised).
+
+Threads can't be killed, so a run that times out is abandoned: it is
+reported as finished (with -1) straight away and whatever the function
+returns later is discarded. The thread is only free for another run once
+the function actually returns.
+
+Processes an action starts, e.g. with subprocess, are children of the
+daemon. While any action is running the daemon only reaps the children it
+started itself, so the action's own wait() still sees the exit status.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+# twitcher modules
+import stats
+
+
+# The number of threads used when none is given.
+DEFAULT_SIZE = 4
+
+
+class InProcessRun(object):
+  """One run of an action on the thread pool.
+
+  This provides the parts of core.MinimalSubprocess that a watch uses, so
+  the two can be tracked and finished the same way.
+
+  Args:
+    desc: The description of the run, used when logging.
+    func: The function to call.
+    data: The string passed to func.
+    timeout: The number of seconds before the run is abandoned.
+    on_exit: Called with this object once the run has finished.
+    job: The scheduler.Job this run was started for, if any.
+    lease: The semaphore.Lease this run holds, if any.
+  """
+  def __init__(self, desc, func, data, timeout=None, on_exit=None, job=None,
+               lease=None):
+    self.desc = desc
+    self.pid = -1
+    self.job = job
+    self.lease = lease
+    self.returncode = None
+    self.sigterm_sent = False
+    self._func = func
+    self._data = data
+    self._timeout = timeout
+    self._on_exit = on_exit
+    self._timer = None
+    self._queued = time.time()
+
+  def signal(self, signal):
+    """Signals can't be delivered to a thread, so this only logs."""
+    logging.debug('Not sending signal %d to in process action "%s"', signal,
+                  self.desc)
+
+  def terminate(self, reason='timeout'):
+    """Abandons the run.
+
+    Args:
+      reason: Why the run is being abandoned, used when logging.
+    """
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self.returncode is not None:
+      return
+    self.sigterm_sent = True
+    logging.warning('Abandoning in process action "%s" (%s)', self.desc,
+                    reason)
+    if reason == 'timeout':
+      stats.increment('inprocess.timeouts')
+    self._finished(-1)
+
+  def _execute(self):
+    """Runs the function. Called on a pool thread."""
+    started = time.time()
+    stats.record('inprocess.queue_time', started - self._queued)
+    try:
+      try:
+        self._func(self._data)
+        return 0
+      except Exception:
+        logging.exception('Unhandled exception in in process action "%s"',
+                          self.desc)
+        stats.increment('inprocess.errors')
+        return 1
+    finally:
+      stats.record('inprocess.run_time', time.time() - started)
+
+  def _finished(self, returncode):
+    """Reports the result. Called on the reactor thread."""
+    if self.returncode is not None:
+      # Already reported when the run was abandoned; drop the late result.
+      stats.increment('inprocess.abandoned_returned')
+      return
+    self.returncode = returncode
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self._on_exit is not None:
+      self._on_exit(self)
+
+
+class ThreadPool(object):
+  """Runs InProcessRun objects on at most size threads.
+
+  submit() is expected to be called from the reactor thread. Threads are
+  started as they are needed and live for as long as the daemon.
+
+  Args:
+    reactor_obj: The reactor results and timeouts are handled on.
+    size: The number of threads.
+  """
+  def __init__(self, reactor_obj, size=DEFAULT_SIZE):
+    self._reactor = reactor_obj
+    self._size = size
+    self._threads = []
+    self._idle = 0
+    self._running = 0
+    self._queue = collections.deque()
+    self._cond = threading.Condition()
+    stats.set_gauge('inprocess.queued', lambda: len(self._queue))
+    stats.set_gauge('inprocess.running', lambda: self._running)
+
+  def running(self):
+    """Returns the number of runs executing on a thread, abandoned or not."""
+    return self._running
+
+  def submit(self, run):
+    """Queues a run and starts its timeout.
+
+    Args:
+      run: The InProcessRun to execute.
+
+    Returns:
+      Nothing.
+    """
+    stats.increment('inprocess.runs')
+    if run._timeout is not None:
+      run._timer = self._reactor.call_later(run._timeout, run.terminate)
+    self._cond.acquire()
+    try:
+      self._queue.append(run)
+      if not self._idle and len(self._threads) < self._size:
+        t = threading.Thread(target=self._loop,
+                             name='twitcher-action-%d' % len(self._threads))
+        t.daemon = True
+        self._threads.append(t)
+        t.start()
+      else:
+        self._cond.notify()
+    finally:
+      self._cond.release()
+
+  def _loop(self):
+    """The body of each pool thread."""
+    while True:
+      self._run_next()
+
+  def _run_next(self):
+    """Waits for a run and executes it."""
+    self._cond.acquire()
+    try:
+      while not self._queue:
+        self._idle += 1
+        try:
+          self._cond.wait()
+        finally:
+          self._idle -= 1
+      run = self._queue.popleft()
+    finally:
+      self._cond.release()
+    if run.returncode is not None:
+      # Timed out before it got a thread.
+      return
+    self._cond.acquire()
+    self._running += 1
+    self._cond.release()
+    try:
+      returncode = run._execute()
+    finally:
+      self._cond.acquire()
+      self._running -= 1
+      self._cond.release()
+    self._reactor.run_in_reactor(run._finished, returncode)
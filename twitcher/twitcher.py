@@ -3,7 +3,7 @@
 """Main loop for the twitcher binary.
 
 This class contains the main "Twitcher" object which is a simple wrapper for
-the main loop functionality. It catches SIGCHLD, and manages the select loop.
+the main loop functionality. It catches SIGCHLD, and runs the reactor loop.
 It also creates the top level zookeeper and config directory watcher objects.
 
 Author: Brady Catherman (brady@twitter.com)
@@ -12,15 +12,27 @@ Author: Brady Catherman (brady@twitter.com)
 import errno
 import logging
 import os
-import select
 import signal
-import sys
 
 # Twitcher modules
 from inotify import InotifyWatcher
 from config import ConfigFile
+import admission
 import core
+import dispatch
+import fds
+import reactor
+import reaper
+import scheduler
+import state
+import stats
+import threadpool
 import zkwrapper
+import zygote
+
+
+# The number of seconds between writes of the stats file.
+STATS_INTERVAL = 60
 
 
 class Twitcher(object):
@@ -29,17 +41,87 @@ class Twitcher(object):
   Args:
     zkservers: A comma separated list of zookeeper servers to connect too.
     config_path: The path to (recursively) read config files from.
+    use_zygote: If True then Exec() actions are started by a zygote process
+                forked before the zookeeper client is created.
+    max_children: The most actions that may run at once, or None.
+    stats_file: If set then stats are written to this file every minute.
+    admission_limits: If set, a dictionary of AdmissionController arguments
+                      (cpu, memory, io, load, max_deferral). Low priority
+                      runs are then deferred while the host is under
+                      pressure.
+    action_threads: The number of threads that run in process actions.
+    state_file: If set then the result of each watch's last run is kept in
+                this file, for run_on_load='if_changed'.
+    rearm_window: The most watch re-registrations outstanding at once after
+                  the zookeeper session expires.
+    rearm_rate: The most watch re-registrations started per second.
+    zk_max_outstanding: The most zookeeper requests outstanding at once.
   """
-  def __init__(self, zkservers, config_path):
+  def __init__(self, zkservers, config_path, use_zygote=False,
+               max_children=None, stats_file=None, admission_limits=None,
+               action_threads=threadpool.DEFAULT_SIZE, state_file=None,
+               rearm_window=zkwrapper.DEFAULT_REARM_WINDOW,
+               rearm_rate=zkwrapper.DEFAULT_REARM_RATE,
+               zk_max_outstanding=dispatch.DEFAULT_MAX_OUTSTANDING):
+    # The zygote must be forked before anything else exists in this process.
+    self._zygote = None
+    if use_zygote:
+      self._zygote = zygote.Zygote()
+      self._zygote.start()
+    self._reactor = reactor.Reactor()
+    core.set_default_reactor(self._reactor)
+    self._reaper = reaper.Reaper()
+    core.set_default_reaper(self._reaper)
+    if self._zygote is not None:
+      self._zygote.connect(self._reactor)
+      self._reaper.register(self._zygote.pid, self._zygote_exited)
+      core.set_default_zygote(self._zygote)
+    core.set_default_registry(core.ObjectRegistry())
+    core.set_default_scheduler(scheduler.Scheduler(max_children))
+    stats.set_gauge('registry.objects', lambda: len(core.default_registry))
+    core.set_default_thread_pool(
+        threadpool.ThreadPool(self._reactor, action_threads))
+    if state_file:
+      core.set_default_state(state.StateFile(
+          state_file, self._reactor,
+          loaded=core.default_registry.descriptions))
+    if admission_limits:
+      core.set_default_admission(
+          admission.AdmissionController(self._reactor, **admission_limits))
     self._signal_notifier = os.pipe()
+    for fd in self._signal_notifier:
+      reactor.set_nonblocking(fd)
+      fds.set_cloexec(fd)
+    self._reactor.register(self._signal_notifier[0], reactor.READ,
+                           self._drain_signal_notifier)
     signal.set_wakeup_fd(self._signal_notifier[1])
     signal.signal(signal.SIGCHLD, self._sigchld)
-    zh = zkwrapper.ZKWrapper(zkservers)
+    signal.signal(signal.SIGUSR1, self._sigusr1)
+    zh = zkwrapper.ZKWrapper(zkservers, rearm_window=rearm_window,
+                             rearm_rate=rearm_rate,
+                             max_outstanding=zk_max_outstanding)
     core.set_default_zkwrapper(zh)
-    core.set_default_ping_fd(self._signal_notifier[1])
     self._inotify_watcher = InotifyWatcher([config_path], ConfigFile,
                                            self._is_config_file)
     self._sigchld_received = False
+    self._sigusr1_received = False
+    self._stats_file = stats_file
+    if stats_file:
+      self._reactor.call_later(STATS_INTERVAL, self._write_stats)
+
+  def _zygote_exited(self, pid, status):
+    """Called when the zygote process exits."""
+    logging.error('Zygote process %d exited with status %d', pid, status)
+
+  def _reap(self):
+    """Collects exited children.
+
+    A child started by an in process action belongs to the thread that
+    waits for it, so only registered children are reaped while any action
+    is running.
+    """
+    self._reaper.reap(
+        registered_only=core.default_thread_pool.running() > 0)
 
   def _is_config_file(self, filename):
     """Returns True if the file name is a twitcher config file."""
@@ -50,48 +132,44 @@ class Twitcher(object):
     signal.signal(signal.SIGCHLD, self._sigchld)
     self._sigchld_received = True
 
-  def _get_all_config_objects(self):
-    """Returns a list of all config objects loaded."""
-    watch_files = self._inotify_watcher.files()
-    r = []
-    for w in watch_files:
-      r += w.get_configurations()
-    return r
+  def _sigusr1(self, sig, frame):
+    """Called when a SIGUSR1 signal has been received."""
+    self._sigusr1_received = True
+
+  def _write_stats(self):
+    """Writes the stats file and schedules the next write."""
+    stats.write_stats(self._stats_file)
+    self._reactor.call_later(STATS_INTERVAL, self._write_stats)
+
+  def _drain_signal_notifier(self, fd, events):
+    """Empties the pipe that signal handlers write to."""
+    try:
+      while os.read(fd, 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
 
   def run(self):
     """The main running loop of the twitcher process. Doesn't return."""
     while True:
-      # If we received SIGCHLD then we should allow our config modules
-      # to reap all children.
+      # If we received SIGCHLD then collect every exited child. The reaper
+      # hands each exit status to the process that owns it.
       if self._sigchld_received:
-        for c in self._get_all_config_objects():
-          c.sigchld()
         self._sigchld_received = False
+        self._reap()
+
+      # SIGHUP or SIGIO (a config directory changed) asks for a rescan.
+      self._inotify_watcher.rescan_if_needed()
+
+      # SIGUSR1 asks for a dump of the current stats.
+      if self._sigusr1_received:
+        self._sigusr1_received = False
+        stats.log_stats()
 
-      # We add our notified file descriptor by default so select will exit
-      # when sigchld is received.
-      r_fds = [self._signal_notifier[0]]
-      w_fds = []
-      # We automatically check process timeouts every 5 minutes if no other
-      # action has happened. This ensures that processes clean up.
-      timeout = 60
-      for c in self._get_all_config_objects():
-        timeout = min((timeout, c.next_timeout()))
-        cr, cw = c.get_fds()
-        r_fds += cr
-        w_fds += cw
-
-      try:
-        iready, oready, e = select.select(r_fds, w_fds, [], timeout)
-        if not iready and not oready and not e:
-          logging.debug('select loop timed out without updates.')
-          for c in self._get_all_config_objects():
-            c.timeout()
-        else:
-          if self._signal_notifier[0] in iready:
-            os.read(self._signal_notifier[0], 1)
-          for c in self._get_all_config_objects():
-            c.select(iready, oready)
-      except select.error, v:
-        if v[0] != errno.EINTR:
-          raise
+      # Process timeouts are timers inside the reactor. We still wake up
+      # every minute without any activity to double check that no child
+      # exited without us noticing.
+      if self._reactor.poll(60) == 0 and self._reaper:
+        logging.debug('reactor loop timed out without updates.')
+        self._reap()
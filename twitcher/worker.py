@@ -0,0 +1,337 @@
+#!/usr/bin/python26
+
+"""Long running worker processes for the PERSISTENT run mode.
+
+Starting a process for every update is the main cost of watching a busy
+znode, and many actions pay for expensive startup (loading a large data set
+for example) every time. In PERSISTENT mode a watch keeps one worker process
+running and writes each new version of the znode to its stdin as a frame:
+
+  4 byte big endian length, followed by that many bytes of data.
+
+If acks are enabled the worker writes one line to stdout after handling
+each frame and twitcher doesn't send the next frame until it sees it.
+Updates that arrive while a frame is outstanding are coalesced so the
+worker only ever receives the most recent data next.
+
+The watch's timeout applies to each frame: a worker that doesn't take (or
+ack) a frame in time is terminated. Workers that exit are started again,
+with exponential backoff, and are handed the latest data that they had not
+finished with.
+"""
+
+import errno
+import logging
+import os
+import struct
+import time
+
+# twitcher modules
+import capture
+import core
+import fds
+import reactor
+import stats
+
+
+_HEADER = struct.Struct('>I')
+
+# The delay before the first restart, doubled for each failure in a row.
+BACKOFF_BASE = 1.0
+
+# The longest delay between restarts.
+BACKOFF_MAX = 60.0
+
+# A worker that has run for this many seconds is considered healthy again.
+HEALTHY_AFTER = 60.0
+
+_READ_SIZE = 4096
+
+
+class WorkerProcess(core.MinimalSubprocess):
+  """A child process whose stdin stays open after it starts.
+
+  Args:
+    desc: The description of the process, used when logging.
+    on_exit: Called with this object once the process exits.
+    output: The capture object giving the child its stdout and stderr.
+    resources: A resources.ResourceLimits applied to the child, if any.
+  """
+  use_zygote = False
+
+  def __init__(self, desc, on_exit, output=None, resources=None):
+    core.MinimalSubprocess.__init__(self, desc, '', on_exit=on_exit,
+                                    capture=output, resources=resources)
+
+  def _open_stdin(self):
+    """Always gives the worker a pipe, since frames are written over time."""
+    stdin = os.pipe()
+    fds.set_cloexec(stdin[1])
+    return stdin
+
+  def _started(self, pid, stdin_fd):
+    """Tracks the worker but leaves stdin to the PersistentWorker."""
+    self.pid = pid
+    if core.default_reaper is not None:
+      core.default_reaper.register(pid, self._reaped)
+    self.stdin = stdin_fd
+    reactor.set_nonblocking(self.stdin)
+
+
+class _AckOutput(object):
+  """Gives a worker an ack pipe as stdout, and captured or no stderr.
+
+  This implements the same interface as capture.OutputCapture.
+
+  Args:
+    on_data: Called with each chunk read from the worker's stdout.
+    output: An OutputCapture for stderr, or None.
+    reactor_obj: The reactor the pipe is registered with.
+  """
+  def __init__(self, on_data, output, reactor_obj):
+    self._on_data = on_data
+    self._output = output
+    self._reactor = reactor_obj
+    self._read_fd = None
+    self._write_fd = None
+
+  def child_fds(self):
+    """Creates the ack pipe and returns the (stdout, stderr) child ends."""
+    self._read_fd, self._write_fd = os.pipe()
+    fds.set_cloexec(self._read_fd)
+    fds.set_cloexec(self._write_fd)
+    reactor.set_nonblocking(self._read_fd)
+    stderr = None
+    if self._output is not None:
+      stderr = self._output.child_fds()[1]
+    return (self._write_fd, stderr)
+
+  def started(self):
+    """Closes the child's end and starts reading acks."""
+    os.close(self._write_fd)
+    self._write_fd = None
+    self._reactor.register(self._read_fd, reactor.READ, self._ready)
+    if self._output is not None:
+      self._output.started()
+
+  def _ready(self, fd, events):
+    """Called by the reactor when the worker wrote to stdout."""
+    try:
+      data = os.read(fd, _READ_SIZE)
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return
+      data = ''
+    if not data:
+      self.close()
+      return
+    self._on_data(data)
+
+  def close(self):
+    """Closes every descriptor."""
+    if self._write_fd is not None:
+      os.close(self._write_fd)
+      self._write_fd = None
+    if self._read_fd is not None:
+      self._reactor.unregister(self._read_fd)
+      os.close(self._read_fd)
+      self._read_fd = None
+    if self._output is not None:
+      self._output.close()
+
+
+class PersistentWorker(object):
+  """Keeps one worker process running for a watch and feeds it updates.
+
+  All functions are expected to be called from the reactor thread.
+
+  Args:
+    desc: The description of the watch, used when logging.
+    func: The action that starts the worker.
+    uid: The user id the worker runs as.
+    gid: The group id the worker runs as.
+    ack: If True then the worker acknowledges each frame with a line on
+         stdout.
+    timeout: The number of seconds the worker has to take (or ack) a frame.
+    capture_output: If True then the worker's stderr, and stdout when acks
+                    are off, is logged.
+    capture_buffer_size: The most bytes buffered per stream when capturing.
+    capture_line_rate: The most lines per second logged.
+    resources: A resources.ResourceLimits applied to the worker, if any.
+  """
+  def __init__(self, desc, func, uid=None, gid=None, ack=False, timeout=None,
+               capture_output=False,
+               capture_buffer_size=capture.DEFAULT_BUFFER_SIZE,
+               capture_line_rate=capture.DEFAULT_LINE_RATE, resources=None):
+    self._desc = desc
+    self._func = func
+    self._uid = uid
+    self._gid = gid
+    self._ack = ack
+    self._timeout = timeout
+    self._capture_output = capture_output
+    self._capture_buffer_size = capture_buffer_size
+    self._capture_limiter = capture.LineRateLimiter(capture_line_rate)
+    self._resources = resources
+    self._process = None
+    self._inflight = None
+    self._pending = None
+    self._frame = None
+    self._offset = 0
+    self._timer = None
+    self._restart_timer = None
+    self._failures = 0
+    self._started_at = None
+    self._closed = False
+
+  def deliver(self, data):
+    """Sends a new version of the znode to the worker.
+
+    Args:
+      data: The contents of the znode.
+
+    Returns:
+      Nothing.
+    """
+    if self._closed:
+      return
+    if self._pending is not None:
+      stats.increment('worker.coalesced')
+    self._pending = data
+    if self._process is None:
+      if self._restart_timer is None:
+        self._spawn()
+      return
+    self._pump()
+
+  def stop(self):
+    """Stops the worker for good. Used when the watch is unloaded."""
+    self._closed = True
+    self._cancel_timer()
+    if self._restart_timer is not None:
+      self._restart_timer.cancel()
+      self._restart_timer = None
+    if self._process is not None:
+      logging.warning('Stopping worker "%s"', self._desc)
+      self._process._close_stdin()
+      self._process.terminate()
+
+  def _spawn(self):
+    """Starts the worker process."""
+    output = None
+    if self._capture_output:
+      streams = ('stdout', 'stderr')
+      if self._ack:
+        streams = ('stderr',)
+      output = capture.OutputCapture(self._desc, self._capture_limiter,
+                                     self._capture_buffer_size,
+                                     core.default_reactor, streams=streams)
+    if self._ack:
+      output = _AckOutput(self._acked, output, core.default_reactor)
+    p = WorkerProcess(self._desc, self._exited, output=output,
+                      resources=self._resources)
+    logging.warning('Starting worker: %s', self._desc)
+    try:
+      p.start(self._func, self._uid, self._gid)
+    except (OSError, core.UnknownUserError, core.UnknownGroupError), e:
+      logging.error('Unable to start worker "%s": %s', self._desc, e)
+      self._schedule_restart()
+      return
+    self._process = p
+    self._started_at = time.time()
+    stats.increment('worker.starts')
+    self._pump()
+
+  def _pump(self):
+    """Writes the next frame if the worker is ready for one."""
+    if (self._process is None or self._inflight is not None or
+        self._pending is None):
+      return
+    self._inflight = self._pending
+    self._pending = None
+    self._frame = _HEADER.pack(len(self._inflight)) + self._inflight
+    self._offset = 0
+    if self._timeout is not None:
+      self._timer = core.default_reactor.call_later(self._timeout,
+                                                    self._timed_out)
+    core.default_reactor.register(self._process.stdin, reactor.WRITE,
+                                  self._write_ready)
+
+  def _write_ready(self, fd, events):
+    """Called by the reactor when the worker's stdin is writable."""
+    try:
+      self._offset += os.write(fd, buffer(self._frame, self._offset))
+    except OSError, e:
+      if e.errno == errno.EAGAIN:
+        return
+      # The worker went away; _exited() takes care of the rest.
+      core.default_reactor.unregister(fd)
+      return
+    if self._offset < len(self._frame):
+      return
+    core.default_reactor.unregister(fd)
+    self._frame = None
+    if not self._ack:
+      self._frame_done()
+
+  def _acked(self, data):
+    """Called with output from the worker when acks are enabled."""
+    for _ in xrange(data.count('\n')):
+      if self._inflight is not None and self._frame is None:
+        self._frame_done()
+
+  def _frame_done(self):
+    """Called once the worker has taken the in flight frame."""
+    self._cancel_timer()
+    self._inflight = None
+    self._failures = 0
+    stats.increment('worker.frames')
+    self._pump()
+
+  def _cancel_timer(self):
+    """Cancels the per frame timeout."""
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+  def _timed_out(self):
+    """Called when the worker didn't handle a frame in time."""
+    self._timer = None
+    logging.warning('Worker "%s" did not handle an update within %s seconds.',
+                    self._desc, self._timeout)
+    stats.increment('worker.timeouts')
+    if self._process is not None:
+      self._process.terminate()
+
+  def _exited(self, p):
+    """Called once the worker process has been reaped."""
+    logging.warning('Worker "%s" (%s) exited with code %s', self._desc, p.pid,
+                    p.returncode)
+    p._close_stdin()
+    self._process = None
+    self._cancel_timer()
+    self._frame = None
+    # Hand whatever the worker hadn't finished to the next one.
+    if self._inflight is not None and self._pending is None:
+      self._pending = self._inflight
+    self._inflight = None
+    if self._closed:
+      return
+    if time.time() - self._started_at >= HEALTHY_AFTER:
+      self._failures = 0
+    self._schedule_restart()
+
+  def _schedule_restart(self):
+    """Starts the worker again after a backoff delay."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** self._failures))
+    self._failures += 1
+    logging.warning('Restarting worker "%s" in %.0f seconds.', self._desc,
+                    delay)
+    self._restart_timer = core.default_reactor.call_later(delay,
+                                                          self._restart)
+
+  def _restart(self):
+    """Called once the backoff delay has passed."""
+    self._restart_timer = None
+    if not self._closed:
+      self._spawn()
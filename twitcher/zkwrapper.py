@@ -16,13 +16,55 @@ be created and destroyed often.
 Author: Brady Catherman (brady@twitter.com)
 """
 
+import collections
 import core
+import hashlib
 import logging
 import os
 import socket
 import threading
+import time
 import zookeeper
 
+# twitcher modules
+import dispatch
+import stats
+
+
+# The ACL given to nodes created by twitcher.
+OPEN_ACL = [{'perms': 0x1f, 'scheme': 'world', 'id': 'anyone'}]
+
+# The most watch re-registrations outstanding at once after a new session.
+DEFAULT_REARM_WINDOW = 64
+
+# The most watch re-registrations started per second after a new session.
+DEFAULT_REARM_RATE = 500
+
+
+class Subscription(object):
+  """A subscriber's hold on the watches of one znode.
+
+  Watchers and handlers passed to aget() or aget_children() along with a
+  subscription belong to it, and release() removes all of them at once.
+  The ZKWrapper counts subscriptions per (path, watch type); once the last
+  one is released the path is no longer re-armed.
+
+  Args:
+    zkwrapper: The ZKWrapper that created the subscription.
+    path: The znode.
+    watch_type: core.WATCH_DATA or core.WATCH_CHILDREN.
+  """
+  def __init__(self, zkwrapper, path, watch_type):
+    self._zkwrapper = zkwrapper
+    self.path = path
+    self.watch_type = watch_type
+    self.released = False
+
+  def release(self):
+    """Removes every callback of this subscription. Safe to call twice."""
+    self._zkwrapper._release(self)
+
+
 class ZKWrapper(object):
   """Wraps all zookeeper functionality into a simple wrapper.
 
@@ -31,10 +73,27 @@ class ZKWrapper(object):
   also allows us to unregister watches which is something the normal zookeeper
   library doesn't support.
 
+  When a session expires every watch is lost with it. Once a new session is
+  established the watched paths are registered again, but at most
+  rearm_window requests are outstanding at a time and at most rearm_rate
+  are started each second so that an ensemble blip doesn't turn into a
+  request storm. Paths whose version changed while the session was down
+  notify their watchers; unchanged paths don't. (Watches survive a
+  connection loss within a session; the client library restores those
+  itself.)
+
+  Every request is sent through a dispatch.RequestDispatcher, which limits
+  how many are outstanding and retries those failing with CONNECTIONLOSS.
+
   Args:
     servers: the list of zookeeper servers to connect too.
+    rearm_window: The most re-registrations outstanding at once.
+    rearm_rate: The most re-registrations started per second.
+    max_outstanding: The most requests outstanding at once.
   """
-  def __init__(self, servers):
+  def __init__(self, servers, rearm_window=DEFAULT_REARM_WINDOW,
+               rearm_rate=DEFAULT_REARM_RATE,
+               max_outstanding=dispatch.DEFAULT_MAX_OUTSTANDING):
     logging.debug('Creating ZKwrapper against %s', ','.join(servers))
     self._servers = []
     for s in servers:
@@ -53,7 +112,30 @@ class ZKWrapper(object):
     self._children_handlers = {}
     self._zookeeper = None
     self._clientid = None
+    self._dispatcher = dispatch.RequestDispatcher(core.default_reactor,
+                                                  max_outstanding)
     self._pending_gets = []
+    self._ephemerals = {}
+    self._versions = {}
+    self._children_versions = {}
+    # Re-registration after a new session. The queue holds
+    # (watch type, path) tuples, and (None, path, watcher, handler) for
+    # gets that failed before the session was established. Requests from
+    # an older session are ignored by comparing _rearm_session.
+    self._rearm_lock = threading.Lock()
+    self._rearm_window = rearm_window
+    self._rearm_rate = rearm_rate
+    self._rearm_queue = collections.deque()
+    self._rearm_inflight = 0
+    self._rearm_session = 0
+    self._rearm_tokens = 0.0
+    self._rearm_refilled = time.time()
+    self._rearm_timer = None
+    stats.set_gauge('zkwrapper.rearm_queued', lambda: len(self._rearm_queue))
+    # The number of live subscriptions per (path, watch type).
+    self._subscribers = {}
+    stats.set_gauge('zkwrapper.subscriptions',
+                    lambda: sum(self._subscribers.itervalues()))
     self._connect()
 
   def _global_watch(self, zh, event, state, path):
@@ -68,16 +150,180 @@ class ZKWrapper(object):
         logging.debug('Session reconnection.')
       else:
         self._clientid = zookeeper.client_id(self._zookeeper)
-        logging.debug('Registering watches to reestablish expired session')
-        for path in self._watches.iterkeys():
-          logging.debug('Registering watch against: %s' % path)
-          h = self._handler_wrapper(path)
-          zookeeper.aget(self._zookeeper, path, self._watcher, h)
+        self._reestablish()
+
+        # Ephemeral nodes went away with the old session.
+        self._lock.acquire()
+        ephemerals = self._ephemerals.items()
+        self._lock.release()
+        for path, (data, on_created) in ephemerals:
+          self._create_ephemeral(path, data, on_created)
+
+  def _reestablish(self):
+    """Queues every watch, and every failed get, for the new session."""
+    logging.debug('Registering watches to reestablish expired session')
+    self._lock.acquire()
+    queue = [(core.WATCH_DATA, p) for p, w in self._watches.iteritems() if w]
+    pending = self._pending_gets
+    self._pending_gets = []
+    self._lock.release()
+    self._children_lock.acquire()
+    queue.extend((core.WATCH_CHILDREN, p)
+                 for p, w in self._children_watches.iteritems() if w)
+    self._children_lock.release()
+    # Catch up all gets requested before we were able to connect. Paths
+    # being re-registered get their handlers called by that instead.
+    rearmed = set(p for t, p in queue if t is core.WATCH_DATA)
+    for path, w, h in pending:
+      if path not in rearmed:
+        queue.append((None, path, w, h))
+    self._rearm_lock.acquire()
+    self._rearm_session += 1
+    self._rearm_queue = collections.deque(queue)
+    self._rearm_inflight = 0
+    self._rearm_tokens = 0.0
+    self._rearm_refilled = time.time()
+    if self._rearm_timer is not None:
+      self._rearm_timer.cancel()
+      self._rearm_timer = None
+    self._rearm_lock.release()
+    logging.info('Re-registering %d watches', len(queue))
+    stats.increment('zkwrapper.rearm.sessions')
+    self._rearm_next()
+
+  def _rearm_next(self):
+    """Starts queued re-registrations allowed by the window and rate."""
+    start = []
+    self._rearm_lock.acquire()
+    self._rearm_timer = None
+    now = time.time()
+    self._rearm_tokens = min(float(self._rearm_rate), self._rearm_tokens +
+                             (now - self._rearm_refilled) * self._rearm_rate)
+    self._rearm_refilled = now
+    while (self._rearm_queue and
+           self._rearm_inflight + len(start) < self._rearm_window):
+      if self._rearm_tokens < 1:
+        delay = (1 - self._rearm_tokens) / self._rearm_rate
+        self._rearm_timer = core.default_reactor.call_later(delay,
+                                                            self._rearm_next)
+        break
+      self._rearm_tokens -= 1
+      start.append(self._rearm_queue.popleft())
+    self._rearm_inflight += len(start)
+    session = self._rearm_session
+    self._rearm_lock.release()
+    for item in start:
+      self._rearm(item, session)
+
+  def _rearm(self, item, session):
+    """Sends one re-registration request."""
+    watch_type, path = item[:2]
+    if watch_type is core.WATCH_CHILDREN:
+      if not self._children_watches.get(path):
+        self._rearm_done(session)
+        return
+      logging.debug('Registering child watch against: %s', path)
+      h = (lambda zh, rc, children:
+           self._children_rearmed(zh, rc, children, path, item, session))
+      self._dispatcher.send(
+          lambda c: zookeeper.aget_children(self._zookeeper, path,
+                                            self._children_watcher, c),
+          h, error_args=(None,), watch=True)
+    elif watch_type is core.WATCH_DATA:
+      if not self._watches.get(path):
+        self._rearm_done(session)
+        return
+      logging.debug('Registering watch against: %s', path)
+      h = (lambda zh, rc, data, stat:
+           self._rearmed(zh, rc, data, stat, path, item, session))
+      self._dispatcher.send(
+          lambda c: zookeeper.aget(self._zookeeper, path, self._watcher, c),
+          h, error_args=(None, None), watch=True)
+    else:
+      # A get that failed before the session was established. Paths whose
+      # last subscription was released since are dropped.
+      _, path, w, h = item
+      if path not in self._watches and path not in self._handlers:
+        self._rearm_done(session)
+        return
+      def done(zh, rc, data, stat):
+        self._rearm_done(session)
+        h(zh, rc, data, stat)
+      self._dispatcher.send(
+          lambda c: zookeeper.aget(self._zookeeper, path, w, c), done,
+          error_args=(None, None), watch=w is not None)
+
+  def _rearm_done(self, session, retry=None):
+    """Called as each re-registration completes.
 
-        # Catch up all gets requested before we were able to connect.
-        while self._pending_gets:
-          path, w, h = self._pending_gets.pop()
-          zookeeper.aget(self._zookeeper, path, w, h)
+    Args:
+      session: The _rearm_session the request was sent in.
+      retry: If given, the queue item to send again.
+    """
+    self._rearm_lock.acquire()
+    current = session == self._rearm_session
+    if current:
+      self._rearm_inflight -= 1
+      if retry is not None:
+        self._rearm_queue.append(retry)
+    self._rearm_lock.release()
+    if current:
+      self._rearm_next()
+
+  def _rearmed(self, zh, rc, data, stat, path, item, session):
+    """Handles the result of re-registering a data watch."""
+    if rc == zookeeper.CONNECTIONLOSS:
+      self._rearm_done(session, retry=item)
+      return
+    self._rearm_done(session)
+    if rc != zookeeper.OK:
+      logging.error('Unable to re-register the watch on %s: %s', path, rc)
+      return
+    previous = self._versions.get(path)
+    self._handler(zh, rc, data, stat, path)
+    if previous is None or previous == self._versions.get(path):
+      stats.increment('zkwrapper.rearm.unchanged')
+      return
+    logging.info('%s changed while the session was down', path)
+    stats.increment('zkwrapper.rearm.changed')
+    self._notify(path, self._watches, self._lock, self._watcher_lock)
+
+  def _children_rearmed(self, zh, rc, children, path, item, session):
+    """Handles the result of re-registering a child watch."""
+    if rc == zookeeper.CONNECTIONLOSS:
+      self._rearm_done(session, retry=item)
+      return
+    self._rearm_done(session)
+    if rc != zookeeper.OK:
+      logging.error('Unable to re-register the child watch on %s: %s', path,
+                    rc)
+      return
+    previous = self._children_versions.get(path)
+    self._children_handler(zh, rc, children, path)
+    if previous is None or previous == self._children_versions.get(path):
+      stats.increment('zkwrapper.rearm.unchanged')
+      return
+    logging.info('Child nodes of %s changed while the session was down', path)
+    stats.increment('zkwrapper.rearm.changed')
+    self._notify(path, self._children_watches, self._children_lock,
+                 self._children_watcher_lock)
+
+  def _notify(self, path, watches, lock, watcher_lock):
+    """Calls the watchers of a path whose watch is already registered again.
+
+    The path is left with an empty list so that watchers re-registering
+    themselves don't send another request for a watch that is in place.
+    """
+    lock.acquire()
+    callbacks = watches.pop(path, None)
+    if callbacks:
+      watches[path] = []
+    lock.release()
+    watcher_lock.acquire()
+    while callbacks:
+      _, callback = callbacks.pop()
+      callback(self, path)
+    watcher_lock.release()
 
   _DEFAULT_TIMEOUT = 10000
 
@@ -121,7 +367,60 @@ class ZKWrapper(object):
     """
     return (lambda z, r, d, s: self._handler(z, r, d, s, path))
 
-  def aget(self, path, watcher=None, handler=None):
+  def subscribe(self, path, watch_type=None):
+    """Returns a new Subscription for a znode.
+
+    Args:
+      path: The znode.
+      watch_type: core.WATCH_DATA (the default) or core.WATCH_CHILDREN.
+
+    Returns:
+      A Subscription to pass to aget() or aget_children().
+    """
+    if watch_type is None:
+      watch_type = core.WATCH_DATA
+    key = (path, watch_type)
+    self._lock.acquire()
+    self._subscribers[key] = self._subscribers.get(key, 0) + 1
+    self._lock.release()
+    return Subscription(self, path, watch_type)
+
+  def _release(self, subscription):
+    """Forgets every callback of a subscription and drops its reference.
+
+    Once the last subscription of a path is released its entries are
+    removed, so the path is not re-armed when the session is re-established
+    and the next aget() registers a fresh watch.
+    """
+    if subscription.released:
+      return
+    subscription.released = True
+    path = subscription.path
+    if subscription.watch_type is core.WATCH_CHILDREN:
+      lock = self._children_lock
+      tables = (self._children_watches, self._children_handlers)
+    else:
+      lock = self._lock
+      tables = (self._watches, self._handlers)
+    lock.acquire()
+    for table in tables:
+      entries = [e for e in table.get(path, []) if e[0] is not subscription]
+      if entries:
+        table[path] = entries
+      else:
+        table.pop(path, None)
+    lock.release()
+    key = (path, subscription.watch_type)
+    self._lock.acquire()
+    count = self._subscribers.get(key, 0) - 1
+    if count > 0:
+      self._subscribers[key] = count
+    else:
+      self._subscribers.pop(key, None)
+      logging.debug('Last subscription for %s released', path)
+    self._lock.release()
+
+  def aget(self, path, watcher=None, handler=None, subscription=None):
     """A simple wrapper for zookeeper async get function.
 
     This function wraps the zookeeper aget call which allows the caller
@@ -141,19 +440,22 @@ class ZKWrapper(object):
                  zh will be this object and path will be the znode path.
                  rc is the return code from zookeeper.
                  data is the contents of the znode.
+      subscription: The Subscription the callbacks belong to, if any.
 
     Returns:
       Nothing.
     """
+    if subscription is not None and subscription.released:
+      return
     register = False
     get = False
     self._lock.acquire()
     if watcher:
       register = path not in self._watches
-      self._watches.setdefault(path, []).append(watcher)
+      self._watches.setdefault(path, []).append((subscription, watcher))
     if handler:
       get = path not in self._handlers
-      self._handlers.setdefault(path, []).append(handler)
+      self._handlers.setdefault(path, []).append((subscription, handler))
     self._lock.release()
     if register or get:
       if register:
@@ -162,9 +464,12 @@ class ZKWrapper(object):
         w = None
       h = self._handler_wrapper(path)
       logging.debug('Performing a get against %s', path)
-      zookeeper.aget(self._zookeeper, path, w, h)
+      self._dispatcher.send(
+          lambda c: zookeeper.aget(self._zookeeper, path, w, c), h,
+          error_args=(None, None), watch=register)
       
-  def aget_children(self, path, watcher=None, handler=None):
+  def aget_children(self, path, watcher=None, handler=None,
+                    subscription=None):
     """A simple wrapper for zookeeper async get_children function.
 
     This function wraps the zookeeper aget_children call which allows the caller
@@ -184,19 +489,24 @@ class ZKWrapper(object):
                  zh will be this object and path will be the znode path.
                  rc is the return code from zookeeper.
                  children is the list of child nodes after the create/delete.
+      subscription: The Subscription the callbacks belong to, if any.
 
     Returns:
       Nothing.
     """
+    if subscription is not None and subscription.released:
+      return
     register = False
     get = False
     self._children_lock.acquire()
     if watcher:
       register = path not in self._children_watches
-      self._children_watches.setdefault(path, []).append(watcher)
+      self._children_watches.setdefault(path, []).append(
+          (subscription, watcher))
     if handler:
       get = path not in self._children_handlers
-      self._children_handlers.setdefault(path, []).append(handler)
+      self._children_handlers.setdefault(path, []).append(
+          (subscription, handler))
     self._children_lock.release()
     if register or get:
       if register:
@@ -208,7 +518,153 @@ class ZKWrapper(object):
       h = (lambda zh, rc, data: self._children_handler(zh, rc, data, path))
       # FIXME(error handling)
       logging.debug('Performing a get_children against %s', path)
-      zookeeper.aget_children(self._zookeeper, path, w, h)
+      self._dispatcher.send(
+          lambda c: zookeeper.aget_children(self._zookeeper, path, w, c), h,
+          error_args=(None,), watch=register)
+
+  def acreate(self, path, data='', flags=0, handler=None):
+    """A simple wrapper for the zookeeper async create function.
+
+    Args:
+      path: The znode to create.
+      data: The contents of the new znode.
+      flags: zookeeper.EPHEMERAL and/or zookeeper.SEQUENCE.
+      handler: Called once the create completes. The basic footprint of this
+               function is:
+                 func(zh, rc, path)
+                 zh will be this object, rc is the return code from zookeeper
+                 and path is the name of the created node.
+
+    A create that fails with CONNECTIONLOSS isn't retried, since it may
+    have succeeded; the handler must check.
+
+    Returns:
+      Nothing.
+    """
+    def completion(zh, rc, created):
+      if handler:
+        handler(self, rc, created)
+    logging.debug('Creating %s', path)
+    self._dispatcher.send(
+        lambda c: zookeeper.acreate(self._zookeeper, path, data, OPEN_ACL,
+                                    flags, c),
+        completion, error_args=(None,), retry=False)
+
+  def adelete(self, path, handler=None):
+    """A simple wrapper for the zookeeper async delete function.
+
+    Args:
+      path: The znode to delete.
+      handler: Called once the delete completes. The basic footprint of this
+               function is:
+                 func(zh, rc, path)
+
+    Returns:
+      Nothing.
+    """
+    def completion(zh, rc):
+      if handler:
+        handler(self, rc, path)
+    logging.debug('Deleting %s', path)
+    self._dispatcher.send(
+        lambda c: zookeeper.adelete(self._zookeeper, path, -1, c), completion)
+
+  def register_ephemeral(self, path, data='', on_created=None):
+    """Keeps an ephemeral znode in place for the life of this process.
+
+    Missing parent nodes are created as regular nodes. The node is created
+    again whenever the session has to be re-established.
+
+    Args:
+      path: The znode to create.
+      data: The contents of the znode.
+      on_created: Called with no arguments each time the node is created.
+
+    Returns:
+      Nothing.
+    """
+    self._lock.acquire()
+    self._ephemerals[path] = (data, on_created)
+    connected = self._clientid is not None
+    self._lock.release()
+    if connected:
+      self._create_ephemeral(path, data, on_created)
+
+  def unregister_ephemeral(self, path):
+    """Deletes a node previously given to register_ephemeral()."""
+    self._lock.acquire()
+    registered = self._ephemerals.pop(path, None) is not None
+    self._lock.release()
+    if registered:
+      self.adelete(path)
+
+  def _create_ephemeral(self, path, data, on_created):
+    """Creates a registered ephemeral node, fixing up what's in the way."""
+    def retry(*args):
+      self._create_ephemeral(path, data, on_created)
+    def created(zh, rc, created_path):
+      if path not in self._ephemerals:
+        return
+      if rc == zookeeper.OK:
+        if on_created:
+          on_created()
+      elif rc == zookeeper.NONODE:
+        # Create the parent then try again.
+        self.ensure_path(os.path.dirname(path), retry)
+      elif rc == zookeeper.NODEEXISTS:
+        # Most likely left behind by our own expired session.
+        self.adelete(path, retry)
+      elif rc == zookeeper.CONNECTIONLOSS:
+        # The create may have landed; if so the retry finds it in the way.
+        core.default_reactor.call_later(dispatch.RETRY_MAX, retry)
+      else:
+        logging.error('Unable to create %s: %s', path, rc)
+    self.acreate(path, data, zookeeper.EPHEMERAL, created)
+
+  def ensure_path(self, path, then):
+    """Creates path and any missing parents as regular nodes.
+
+    Args:
+      path: The znode that should exist.
+      then: Called with no arguments once the path exists.
+
+    Returns:
+      Nothing.
+    """
+    def created(zh, rc, created_path):
+      if rc == zookeeper.NONODE:
+        self.ensure_path(os.path.dirname(path),
+                         lambda: self.ensure_path(path, then))
+      elif rc == zookeeper.OK or rc == zookeeper.NODEEXISTS:
+        then()
+      elif rc == zookeeper.CONNECTIONLOSS:
+        core.default_reactor.call_later(dispatch.RETRY_MAX,
+                                        self.ensure_path, path, then)
+      else:
+        logging.error('Unable to create %s: %s', path, rc)
+    self.acreate(path, '', 0, created)
+
+  def session_id(self):
+    """Returns the id of the current session, or 0 before one exists."""
+    if self._clientid is None:
+      return 0
+    return self._clientid[0]
+
+  def version(self, path):
+    """Returns what identifies the most recent data received for a znode.
+
+    Handlers are called straight after the version is recorded, so those
+    that call this straight away get the version of the data they were
+    passed.
+
+    Args:
+      path: The znode.
+
+    Returns:
+      A (mzxid, version, digest) tuple where digest is the SHA-1 of the
+      contents, or None if nothing was received.
+    """
+    return self._versions.get(path)
 
   def unregister(self, path, watch_type=None, watcher=None, handler=None):
     """Removes an existing watch or handler.
@@ -235,18 +691,10 @@ class ZKWrapper(object):
         watches = self._watches
         handlers = self._handlers
     
-    if watcher:
-      try:
-        while True:
-          watches.get(path, []).remove(watcher)
-      except ValueError:
-        pass
-    if handler:
-      try:
-        while True:
-          handlers.get(path, []).remove(handler)
-      except ValueError:
-        pass
+    if watcher and path in watches:
+      watches[path] = [w for w in watches[path] if w[1] != watcher]
+    if handler and path in handlers:
+      handlers[path] = [h for h in handlers[path] if h[1] != handler]
 
   def _watcher(self, zh, event, state, path):
     """Internal function called by zookeeper when a node updates.
@@ -277,7 +725,7 @@ class ZKWrapper(object):
     # requests so we can reduce load on the zookeeper servers.
     self._watcher_lock.acquire()
     while watches:
-      callback = watches.pop()
+      _, callback = watches.pop()
       callback(self, path)
     self._watcher_lock.release()
 
@@ -302,13 +750,16 @@ class ZKWrapper(object):
     if rc == zookeeper.OK:
       logging.info('Received znode contents for %s', path)
       logging.debug('Contents of %s\n"""%s""".', path, data)
+      stat = stat or {}
+      self._versions[path] = (stat.get('mzxid'), stat.get('version'),
+                              hashlib.sha1(data or '').hexdigest())
       # This lock means that we will not process the handler until all
       # watchers have been notified.
       self._watcher_lock.acquire()
       handlers = self._handlers.pop(path, None)
       self._watcher_lock.release()
       while handlers:
-        handler = handlers.pop()
+        _, handler = handlers.pop()
         handler(self, rc, data, path)
     elif rc == zookeeper.CONNECTIONLOSS:
       logging.info('Watch event triggered for %s: Connection loss.', path)
@@ -331,7 +782,7 @@ class ZKWrapper(object):
     watches = self._children_watches.pop(path, None)
     self._children_watcher_lock.acquire()
     while watches:
-      callback = watches.pop()
+      _, callback = watches.pop()
       callback(self, path)
     self._children_watcher_lock.release()
 
@@ -352,9 +803,12 @@ class ZKWrapper(object):
     """      
     logging.info('Received child nodes of %s', path)
     logging.debug('Child nodes of %s %r.', path, children)
+    if rc == zookeeper.OK:
+      self._children_versions[path] = hashlib.sha1(
+          '\n'.join(sorted(children))).hexdigest()
     self._children_watcher_lock.acquire()
     handlers = self._children_handlers.pop(path, None)
     self._children_watcher_lock.release()
     while handlers:
-      handler = handlers.pop()
+      _, handler = handlers.pop()
       handler(self, rc, children, path)
@@ -0,0 +1,358 @@
+#!/usr/bin/python26
+
+"""A small helper process that starts children on behalf of twitcher.
+
+Once running, the main twitcher process holds the zookeeper client threads,
+every config namespace and the contents of every watched znode. Forking it
+for an action copies all of that and is risky with threads running. The
+zygote is forked when twitcher starts, before any of that exists, and then
+starts Exec() actions from its own small image.
+
+The two processes talk over a Unix socket pair using length prefixed pickled
+tuples. The main process sends:
+  ('spawn', request_id, argv, uid, gid, stdin_data, stdin_mode, resources,
+   env)
+and the zygote answers with:
+  ('started', request_id, pid)
+  ('failed', request_id, message)
+  ('exited', request_id, pid, status)
+Exit statuses are handed to the main process's Reaper so they are dispatched
+exactly as if the main process had reaped the child itself.
+
+The main process makes itself a child subreaper before forking the zygote.
+If the zygote dies, the children it started keep running and become
+children of the main process, which waits for them itself. Without
+subreaper support they are reported as exited once they are gone. Any other
+orphaned descendant, such as an action that daemonizes, is reaped by the
+main process as an unknown child rather than by init.
+"""
+
+import cPickle
+import errno
+import logging
+import os
+import signal
+import socket
+import struct
+import time
+
+# twitcher modules
+import core
+import fds
+import reactor
+import reaper
+import spawn
+
+
+# The exit status reported for requests the zygote could not start.
+FAILED_STATUS = 127 << 8
+
+# How often a child orphaned by the zygote is checked for when it can't be
+# waited for.
+ORPHAN_POLL = 1.0
+
+# The prctl() option that makes orphaned descendants children of the caller.
+_PR_SET_CHILD_SUBREAPER = 36
+
+_libc = fds._libc
+
+_HEADER = struct.Struct('>I')
+
+
+def _set_child_subreaper():
+  """Makes this process the parent of its orphaned descendants.
+
+  Returns:
+    True if it worked, False if the kernel doesn't support it.
+  """
+  if _libc is None or _libc.prctl(_PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == -1:
+    logging.warning('Unable to become a child subreaper; actions running '
+                    'when the zygote dies can not be waited for.')
+    return False
+  return True
+
+
+def _alive(pid):
+  """Returns True if a process with the given pid exists."""
+  try:
+    os.kill(pid, 0)
+  except OSError, e:
+    return e.errno != errno.ESRCH
+  return True
+
+
+class Channel(object):
+  """A non blocking, message framed connection over a socket.
+
+  Args:
+    sock: The connected socket.
+    reactor_obj: The Reactor the socket should be registered with.
+    on_message: Called with each message received.
+    on_close: Called once when the other end goes away.
+  """
+  def __init__(self, sock, reactor_obj, on_message, on_close):
+    self._sock = sock
+    self._fd = sock.fileno()
+    self._reactor = reactor_obj
+    self._on_message = on_message
+    self._on_close = on_close
+    self._inbuf = ''
+    self._outbuf = []
+    self._writing = False
+    self.closed = False
+    sock.setblocking(False)
+    self._reactor.register(self._fd, reactor.READ, self._ready)
+
+  def send(self, message):
+    """Queues a message for the other end."""
+    if self.closed:
+      return
+    data = cPickle.dumps(message, 2)
+    self._outbuf.append(_HEADER.pack(len(data)) + data)
+    self._flush()
+
+  def _flush(self):
+    """Writes as much of the output buffer as the socket will take."""
+    while self._outbuf:
+      try:
+        written = self._sock.send(self._outbuf[0])
+      except socket.error, e:
+        if e.errno == errno.EAGAIN:
+          break
+        self.close()
+        return
+      if written == len(self._outbuf[0]):
+        self._outbuf.pop(0)
+      else:
+        self._outbuf[0] = self._outbuf[0][written:]
+    want_write = bool(self._outbuf)
+    if want_write != self._writing:
+      self._writing = want_write
+      events = reactor.READ
+      if want_write:
+        events |= reactor.WRITE
+      self._reactor.modify(self._fd, events)
+
+  def _ready(self, fd, events):
+    """Called by the reactor when the socket is readable or writable."""
+    if events & reactor.WRITE:
+      self._flush()
+    if not events & (reactor.READ | reactor.ERROR):
+      return
+    try:
+      data = self._sock.recv(65536)
+    except socket.error, e:
+      if e.errno == errno.EAGAIN:
+        return
+      data = ''
+    if not data:
+      self.close()
+      return
+    self._inbuf += data
+    while len(self._inbuf) >= _HEADER.size:
+      length = _HEADER.unpack_from(self._inbuf)[0]
+      if len(self._inbuf) < _HEADER.size + length:
+        break
+      message = cPickle.loads(self._inbuf[_HEADER.size:_HEADER.size + length])
+      self._inbuf = self._inbuf[_HEADER.size + length:]
+      self._on_message(message)
+
+  def close(self):
+    """Closes the connection and notifies on_close."""
+    if self.closed:
+      return
+    self.closed = True
+    self._reactor.unregister(self._fd)
+    self._sock.close()
+    self._on_close()
+
+
+class Zygote(object):
+  """Starts and talks to the zygote helper process.
+
+  start() must be called before the zookeeper client is created so the
+  helper doesn't inherit its threads.
+  """
+  def __init__(self):
+    self.pid = None
+    self._channel = None
+    self._reactor = None
+    self._subreaper = False
+    self._sock = None
+    self._next_id = 0
+    self._requests = {}
+
+  def start(self):
+    """Forks the zygote process.
+
+    Returns:
+      Nothing.
+    """
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                socket.SOCK_STREAM)
+    fds.set_cloexec(parent_sock.fileno())
+    fds.set_cloexec(child_sock.fileno())
+    self._subreaper = _set_child_subreaper()
+    pid = os.fork()
+    if pid == 0:
+      try:
+        parent_sock.close()
+        _serve(child_sock)
+      except:
+        logging.exception('Zygote process failed')
+      os._exit(1)
+    child_sock.close()
+    self.pid = pid
+    self._sock = parent_sock
+    logging.info('Started zygote process %d', pid)
+
+  def connect(self, reactor_obj):
+    """Registers the connection to the zygote with a reactor.
+
+    Args:
+      reactor_obj: The reactor of the main loop.
+
+    Returns:
+      Nothing.
+    """
+    self._reactor = reactor_obj
+    self._channel = Channel(self._sock, reactor_obj, self._message,
+                            self._closed)
+
+  def available(self):
+    """Returns True if the zygote is able to accept requests."""
+    return self._channel is not None and not self._channel.closed
+
+  def spawn(self, process, argv, uid, gid, data, stdin_mode, resources=None,
+            env=None):
+    """Asks the zygote to start a process.
+
+    Args:
+      process: The MinimalSubprocess tracking the child in this process.
+      argv: The argument vector to execute.
+      uid: The user id (int) to run as, or None.
+      gid: The group id (int) to run as, or None.
+      data: The data the zygote should write to the child's stdin.
+      stdin_mode: core.STDIN_PIPE or core.STDIN_MEMFD.
+      resources: A resources.ResourceLimits for the child, or None.
+      env: A dictionary of environment variables for the child, or None.
+
+    Returns:
+      Nothing.
+    """
+    self._next_id += 1
+    self._requests[self._next_id] = (process, time.time())
+    self._channel.send(('spawn', self._next_id, argv, uid, gid, data,
+                        stdin_mode, resources, env))
+
+  def _message(self, message):
+    """Handles a message from the zygote."""
+    kind, request_id = message[:2]
+    process, requested = self._requests.get(request_id, (None, None))
+    if process is None:
+      logging.error('Zygote replied to unknown request %s', request_id)
+      return
+    if kind == 'started':
+      core.spawn_timing_hook(process.desc, 'zygote', time.time() - requested)
+      process.zygote_started(message[2])
+    elif kind == 'failed':
+      del self._requests[request_id]
+      logging.error('Zygote failed to start "%s": %s', process.desc,
+                    message[2])
+      process._reaped(-1, FAILED_STATUS)
+    elif kind == 'exited':
+      del self._requests[request_id]
+      pid, status = message[2:]
+      process._reaped(pid, status)
+
+  def _closed(self):
+    """Called when the connection to the zygote is lost."""
+    logging.error('Lost connection to the zygote process; children will be '
+                  'started by the main process.')
+    requests = self._requests
+    self._requests = {}
+    for process, _ in requests.itervalues():
+      if process.pid == -1:
+        # Never started, as far as this process knows.
+        process._reaped(-1, FAILED_STATUS)
+      elif self._subreaper:
+        # The child is, or is about to become, a child of this process.
+        core.default_reaper.register(process.pid, process._reaped)
+        if not _alive(process.pid):
+          # The zygote reaped it but the exit was lost with the connection.
+          core.default_reaper.unregister(process.pid)
+          process._reaped(process.pid, FAILED_STATUS)
+      else:
+        self._wait_for_orphan(process)
+
+  def _wait_for_orphan(self, process):
+    """Reports a child of the dead zygote as exited once it has gone."""
+    if _alive(process.pid):
+      self._reactor.call_later(ORPHAN_POLL, self._wait_for_orphan, process)
+    else:
+      process._reaped(process.pid, FAILED_STATUS)
+
+
+class _ZygoteServer(object):
+  """The request loop that runs inside the zygote process.
+
+  Args:
+    sock: The zygote's end of the socket pair.
+  """
+  def __init__(self, sock):
+    self._reactor = reactor.Reactor()
+    self._reaper = reaper.Reaper()
+    core.set_default_reactor(self._reactor)
+    core.set_default_reaper(self._reaper)
+    core.set_default_zygote(None)
+    self._processes = {}
+    self._running = True
+    self._channel = Channel(sock, self._reactor, self._message, self._closed)
+
+  def _closed(self):
+    """The main process went away so the zygote exits."""
+    self._running = False
+
+  def _message(self, message):
+    """Handles a request from the main process."""
+    if message[0] != 'spawn':
+      logging.error('Zygote received an unknown request: %r', message[0])
+      return
+    _, request_id, argv, uid, gid, data, stdin_mode, resources, env = message
+    p = core.MinimalSubprocess(
+        'zygote request %d' % request_id, data,
+        on_exit=lambda p: self._exited(request_id, p), stdin_mode=stdin_mode,
+        resources=resources, env=env)
+    try:
+      p.start(spawn.ExecAction(argv), uid, gid)
+    except Exception, e:
+      self._channel.send(('failed', request_id, str(e)))
+      return
+    self._processes[request_id] = p
+    self._channel.send(('started', request_id, p.pid))
+
+  def _exited(self, request_id, p):
+    """Reports a child's exit back to the main process."""
+    self._processes.pop(request_id, None)
+    self._channel.send(('exited', request_id, p.pid, p.returncode))
+
+  def run(self):
+    """Serves requests until the main process goes away."""
+    while self._running:
+      self._reactor.poll()
+      self._reaper.reap()
+
+
+def _noop_handler(signum, frame):
+  """Installed for SIGCHLD so that it wakes up the reactor."""
+  pass
+
+
+def _serve(sock):
+  """Entry point of the zygote process."""
+  server = _ZygoteServer(sock)
+  signal.signal(signal.SIGCHLD, _noop_handler)
+  signal.set_wakeup_fd(server._reactor.wakeup_fd())
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  server.run()
+  os._exit(0)